@@ -0,0 +1,725 @@
+#!/usr/bin/env python
+#
+# Updaterepo daemon benchmark
+#
+# Generates synthetic repositories and measures how fast updaterepod
+# synchronizes them, reconciles them on startup and processes storms of
+# events against them, without requiring anything but the daemon's own
+# dependencies.
+#
+
+import os
+import sys
+import re
+import time
+import random
+import struct
+import gzip
+import hashlib
+import json
+import shutil
+import tempfile
+import threading
+import contextlib
+import resource
+import logging
+import signal
+import multiprocessing
+from cStringIO import StringIO
+from optparse import OptionParser
+
+import pyinotify
+import updaterepod
+
+# header data types
+RPM_INT16 = 3
+RPM_INT32 = 4
+RPM_STRING = 6
+RPM_BIN = 7
+RPM_STRING_ARRAY = 8
+RPM_I18NSTRING = 9
+
+ALIGNMENT = {RPM_INT16: 2, RPM_INT32: 4}
+
+# region tags
+RPMTAG_HEADERSIGNATURES = 62
+RPMTAG_HEADERIMMUTABLE = 63
+
+RPMSENSE_LESS = 0x02
+RPMSENSE_EQUAL = 0x08
+RPMSENSE_RPMLIB = 0x1000000
+
+HEADER_MAGIC = '\x8e\xad\xe8\x01\x00\x00\x00\x00'
+LEAD_MAGIC = '\xed\xab\xee\xdb'
+
+# block of random data the contents of the files are sliced from, larger than
+# the gzip window so that the payloads do not compress
+DATA_BLOCK_SIZE = 256 * 1024
+
+PACKAGE_NAME = re.compile('^(.+)-[^-]+-[^-]+\.[^.]+\.rpm$')
+
+def rpmHeader(tags, region):
+  """Serializes tags, a list of (tag, type, value), as an RPM header structure
+     whose entries all belong to the immutable region"""
+  index = []
+  store = StringIO()
+  for (tag, kind, value) in sorted(tags):
+    align = ALIGNMENT.get(kind, 1)
+    store.write('\0' * ((align - store.tell() % align) % align))
+
+    if kind == RPM_INT16:
+      data = struct.pack('>%dH' % len(value), *value)
+      count = len(value)
+    elif kind == RPM_INT32:
+      data = struct.pack('>%dI' % len(value), *value)
+      count = len(value)
+    elif kind == RPM_STRING:
+      data = value + '\0'
+      count = 1
+    elif kind == RPM_BIN:
+      data = value
+      count = len(value)
+    else:
+      data = ''.join([v + '\0' for v in value])
+      count = len(value)
+
+    index.append((tag, kind, store.tell(), count))
+    store.write(data)
+
+  # the region trailer points back to the beginning of the index
+  index.insert(0, (region, RPM_BIN, store.tell(), 16))
+  store.write(struct.pack('>iiii', region, RPM_BIN, -len(index) * 16, 16))
+
+  data = store.getvalue()
+  return HEADER_MAGIC + struct.pack('>ii', len(index), len(data)) + ''.join([struct.pack('>iiii', *entry) for entry in index]) + data
+
+def cpioArchive(files):
+  """Builds a cpio (newc) archive of files, a list of (path, mode, mtime, data)"""
+  archive = StringIO()
+  for (ino, (path, mode, mtime, data)) in enumerate(files + [('TRAILER!!!', 0, 0, '')]):
+    name = path + '\0'
+    archive.write('070701' + ''.join(['%08x' % field for field in (ino + 1, mode, 0, 0, 1, mtime, len(data), 0, 0, 0, 0, len(name), 0)]))
+    archive.write(name)
+    archive.write('\0' * ((4 - archive.tell() % 4) % 4))
+    archive.write(data)
+    archive.write('\0' * ((4 - archive.tell() % 4) % 4))
+
+  return archive.getvalue()
+
+def gzipData(data):
+  buf = StringIO()
+  compressed = gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=1, mtime=0)
+  compressed.write(data)
+  compressed.close()
+  return buf.getvalue()
+
+class PackageGenerator(object):
+  """Builds synthetic, yet well-formed, RPM packages. The contents of a
+     package only depend on the seed, its path and its generation, so that
+     the same repository can be generated again."""
+
+  def __init__(self, seed = 0, files = 50, size = 65536):
+    self.seed = seed
+    self.files = files
+    self.size = size
+    rng = random.Random(seed)
+    self.data = ''.join([chr(rng.getrandbits(8)) for i in range(DATA_BLOCK_SIZE)])
+
+  def rng(self, href, generation):
+    return random.Random(int(hashlib.md5("%s:%s:%d" % (self.seed, href, generation)).hexdigest(), 16))
+
+  def build(self, href, generation = 0):
+    rng = self.rng(href, generation)
+    match = PACKAGE_NAME.match(os.path.basename(href))
+    if match is not None:
+      name = match.group(1)
+    else:
+      name = os.path.basename(href)[:-len('.rpm')]
+    version = '1.%d' % generation
+    release = '1'
+    arch = 'noarch'
+    buildtime = 1500000000 + generation * 3600
+
+    # realistic file lists: most packages ship a few files, some ship thousands
+    count = min(int(rng.expovariate(1.0 / self.files)) + 1, 20 * self.files)
+    total = int(rng.expovariate(1.0 / self.size)) if self.size > 0 else 0
+    dirnames = ['/usr/bin/', '/usr/share/doc/%s/' % name] + ['/usr/share/%s/%d/' % (name, i) for i in range(max(1, count / 20))]
+    files = []
+    for i in range(count):
+      if i == 0:
+        dirindex = 0
+      else:
+        dirindex = rng.randint(1, len(dirnames) - 1)
+      size = total / count
+      offset = rng.randint(0, DATA_BLOCK_SIZE - 1)
+      data = (self.data[offset:] + self.data[:offset]) * (size / DATA_BLOCK_SIZE + 1)
+      files.append((dirindex, '%s-%d' % (name, i) if i == 0 else 'file-%d.dat' % i, data[:size]))
+
+    payload = cpioArchive([('.' + dirnames[dirindex] + basename, 0100644, buildtime, data) for (dirindex, basename, data) in files])
+
+    requires = [('/bin/sh', 0, ''), ('rpmlib(CompressedFileNames)', RPMSENSE_LESS | RPMSENSE_EQUAL | RPMSENSE_RPMLIB, '3.0.4-1')]
+    requires.extend([('bench-%05d' % rng.randint(0, 99999), 0, '') for i in range(rng.randint(0, 5))])
+    provides = [(name, RPMSENSE_EQUAL, '%s-%s' % (version, release)), ('%s(bench)' % name, 0, '')]
+    changelog = [(buildtime - i * 86400, 'Benchmark <bench@example.com> - %s-%s' % (version, release), '- Synthetic change %d' % i) for i in range(rng.randint(1, 5))]
+
+    tags = [
+      (100, RPM_STRING_ARRAY, ['C']),
+      (1000, RPM_STRING, name),
+      (1001, RPM_STRING, version),
+      (1002, RPM_STRING, release),
+      (1004, RPM_I18NSTRING, ['Synthetic package %s' % name]),
+      (1005, RPM_I18NSTRING, ['Synthetic package generated by updaterepod-bench.\n' * rng.randint(1, 10)]),
+      (1006, RPM_INT32, [buildtime]),
+      (1007, RPM_STRING, 'bench.example.com'),
+      (1009, RPM_INT32, [sum([len(data) for (dirindex, basename, data) in files])]),
+      (1014, RPM_STRING, 'GPLv2'),
+      (1016, RPM_I18NSTRING, ['Development/Tools']),
+      (1020, RPM_STRING, 'https://example.com/%s' % name),
+      (1021, RPM_STRING, 'linux'),
+      (1022, RPM_STRING, arch),
+      (1028, RPM_INT32, [len(data) for (dirindex, basename, data) in files]),
+      (1030, RPM_INT16, [0100644] * count),
+      (1033, RPM_INT16, [0] * count),
+      (1034, RPM_INT32, [buildtime] * count),
+      (1035, RPM_STRING_ARRAY, [hashlib.md5(data).hexdigest() for (dirindex, basename, data) in files]),
+      (1036, RPM_STRING_ARRAY, [''] * count),
+      (1037, RPM_INT32, [0] * count),
+      (1039, RPM_STRING_ARRAY, ['root'] * count),
+      (1040, RPM_STRING_ARRAY, ['root'] * count),
+      (1044, RPM_STRING, '%s-%s-%s.src.rpm' % (name, version, release)),
+      (1045, RPM_INT32, [0xffffffff] * count),
+      (1047, RPM_STRING_ARRAY, [provide[0] for provide in provides]),
+      (1048, RPM_INT32, [require[1] for require in requires]),
+      (1049, RPM_STRING_ARRAY, [require[0] for require in requires]),
+      (1050, RPM_STRING_ARRAY, [require[2] for require in requires]),
+      (1064, RPM_STRING, '4.11.3'),
+      (1080, RPM_INT32, [entry[0] for entry in changelog]),
+      (1081, RPM_STRING_ARRAY, [entry[1] for entry in changelog]),
+      (1082, RPM_STRING_ARRAY, [entry[2] for entry in changelog]),
+      (1095, RPM_INT32, [1] * count),
+      (1096, RPM_INT32, range(1, count + 1)),
+      (1097, RPM_STRING_ARRAY, [''] * count),
+      (1112, RPM_INT32, [provide[1] for provide in provides]),
+      (1113, RPM_STRING_ARRAY, [provide[2] for provide in provides]),
+      (1116, RPM_INT32, [dirindex for (dirindex, basename, data) in files]),
+      (1117, RPM_STRING_ARRAY, [basename for (dirindex, basename, data) in files]),
+      (1118, RPM_STRING_ARRAY, dirnames),
+      (1124, RPM_STRING, 'cpio'),
+      (1125, RPM_STRING, 'gzip'),
+      (1126, RPM_STRING, '1'),
+    ]
+    header = rpmHeader(tags, RPMTAG_HEADERIMMUTABLE)
+    payload = gzipData(payload)
+
+    signature = rpmHeader([
+      (269, RPM_STRING, hashlib.sha1(header).hexdigest()),
+      (1000, RPM_INT32, [len(header) + len(payload)]),
+      (1004, RPM_BIN, hashlib.md5(header + payload).digest()),
+    ], RPMTAG_HEADERSIGNATURES)
+    signature += '\0' * ((8 - len(signature) % 8) % 8)
+
+    lead = struct.pack('>4sBBhh66shh16s', LEAD_MAGIC, 3, 0, 0, 1, '%s-%s-%s' % (name, version, release), 1, 5, '')
+
+    return lead + signature + header + payload
+
+  def write(self, directory, href, generation = 0):
+    pathname = os.path.join(directory, href)
+    if not os.path.isdir(os.path.dirname(pathname)):
+      os.makedirs(os.path.dirname(pathname))
+
+    f = open(pathname, 'wb')
+    try:
+      f.write(self.build(href, generation))
+    finally:
+      f.close()
+
+def packageHref(i):
+  return 'bench-%05d-1.0-1.noarch.rpm' % i
+
+def generateRepository(directory, generator, packages):
+  for i in range(packages):
+    generator.write(directory, packageHref(i))
+
+def syntheticEvents(packages, count, rate, mix, seed):
+  """Returns a storm of count operations on a repository of packages, as
+     (offset, operation, href[, destination]) tuples"""
+  rng = random.Random(seed)
+  existing = [packageHref(i) for i in range(packages)]
+  nextPackage = packages
+  choices = []
+  for (operation, weight) in mix:
+    choices.extend([operation] * weight)
+
+  events = []
+  offset = 0.0
+  for i in range(count):
+    operation = rng.choice(choices)
+    if len(existing) == 0:
+      operation = "add"
+
+    if operation == "add":
+      href = packageHref(nextPackage)
+      nextPackage += 1
+      existing.append(href)
+      events.append((offset, "write", href))
+    elif operation == "update":
+      events.append((offset, "write", rng.choice(existing)))
+    elif operation == "touch":
+      events.append((offset, "touch", rng.choice(existing)))
+    elif operation == "remove":
+      events.append((offset, "remove", existing.pop(rng.randrange(len(existing)))))
+    elif operation == "move":
+      src = existing.pop(rng.randrange(len(existing)))
+      dest = 'moved-%d-%s' % (i, os.path.basename(src))
+      existing.append(dest)
+      events.append((offset, "move", src, dest))
+
+    if rate > 0:
+      offset += rng.expovariate(rate)
+
+  return events
+
+def readEvents(filename):
+  events = []
+  for line in open(filename):
+    fields = line.split()
+    if len(fields) == 0 or fields[0].startswith('#'):
+      continue
+    events.append(tuple([float(fields[0])] + fields[1:]))
+
+  return events
+
+def writeEvents(filename, events):
+  f = open(filename, 'w')
+  try:
+    for event in events:
+      f.write("%.3f %s\n" % (event[0], " ".join(event[1:])))
+  finally:
+    f.close()
+
+def threadIO():
+  """Bytes read and written so far by the calling thread (or by the whole
+     process where per-thread accounting is not available)"""
+  for filename in ('/proc/thread-self/io', '/proc/self/io'):
+    try:
+      counters = dict([line.split(': ') for line in open(filename).read().splitlines()])
+      return (int(counters['rchar']), int(counters['wchar']))
+    except (IOError, OSError):
+      pass
+
+  return (0, 0)
+
+def peakRSS():
+  """Peak resident set size, in bytes, of this process and of its children"""
+  return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024)
+
+def percentile(values, p):
+  if len(values) == 0:
+    return None
+  values = sorted(values)
+  return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+class PhaseMetrics(updaterepod.Metrics):
+  """Metrics registry that also accounts for the time spent and the bytes
+     read and written in each phase, as seen by the thread running it"""
+
+  def __init__(self):
+    super(PhaseMetrics, self).__init__()
+    # phase -> [count, seconds, bytes read, bytes written]
+    self.phases = {}
+
+  @contextlib.contextmanager
+  def timer(self, name, **labels):
+    (read, written) = threadIO()
+    start = time.time()
+    try:
+      yield
+    finally:
+      elapsed = time.time() - start
+      self.observe(name, elapsed, **labels)
+      (nowRead, nowWritten) = threadIO()
+      with self.lock:
+        phase = self.phases.setdefault(labels.get('phase', name), [0, 0.0, 0, 0])
+        phase[0] += 1
+        phase[1] += elapsed
+        phase[2] += nowRead - read
+        phase[3] += nowWritten - written
+
+  def takePhases(self):
+    with self.lock:
+      phases = self.phases
+      self.phases = {}
+    return dict([(name, {'count': p[0], 'seconds': p[1], 'read_bytes': p[2], 'written_bytes': p[3]}) for (name, p) in phases.items()])
+
+class Benchmark(object):
+  def __init__(self, options):
+    self.logger = logging.getLogger("app.Benchmark")
+    self.options = options
+    self.generator = PackageGenerator(options.seed, options.files, options.size)
+    self.results = {}
+
+    if options.directory is not None:
+      self.workdir = os.path.abspath(options.directory)
+      if not os.path.isdir(self.workdir):
+        os.makedirs(self.workdir)
+    else:
+      self.workdir = tempfile.mkdtemp(prefix='updaterepod-bench.')
+    self.repo = os.path.join(self.workdir, 'repo')
+
+    self.metrics = PhaseMetrics()
+    for (name, (kind, help)) in updaterepod.metrics.definitions.items():
+      self.metrics.define(name, kind, help)
+    updaterepod.metrics = self.metrics
+
+    # href -> times at which the events on it were injected
+    self.injected = {}
+    self.latencies = []
+    self.updates = 0
+    self.lock = threading.Lock()
+    self.stopped = threading.Event()
+
+  def run(self):
+    try:
+      self.generate()
+      self.sync()
+      self.startDaemon()
+      try:
+        self.reconcile()
+        self.replay()
+      finally:
+        self.stopDaemon()
+    finally:
+      if not self.options.keep:
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    (rss, childrenRSS) = peakRSS()
+    self.results['peak_rss_bytes'] = rss
+    self.results['peak_children_rss_bytes'] = childrenRSS
+    return self.results
+
+  def scenario(self, name, start, operations, **extra):
+    elapsed = time.time() - start
+    result = {'operations': operations, 'seconds': elapsed, 'throughput': operations / elapsed if elapsed > 0 else None, 'phases': self.metrics.takePhases(), 'peak_rss_bytes': peakRSS()[0]}
+    result.update(extra)
+    self.results[name] = result
+    self.logger.info("%s: %d operations in %.2fs" % (name, operations, elapsed))
+
+  def generate(self):
+    if os.path.isdir(self.repo):
+      shutil.rmtree(self.repo)
+    os.makedirs(self.repo)
+
+    start = time.time()
+    generateRepository(self.repo, self.generator, self.options.packages)
+    size = sum([st.st_size for (href, st) in updaterepod.scanRpms(self.repo)])
+    self.logger.info("Generated %d packages (%d bytes) in %.2fs" % (self.options.packages, size, time.time() - start))
+    self.results['repository'] = {'packages': self.options.packages, 'bytes': size}
+
+  def sync(self):
+    """Builds the metadata from scratch, like updaterepod --sync"""
+    start = time.time()
+    updaterepod.sync_repo(self.repo, self.options.sync_workers)
+    self.scenario('sync', start, self.options.packages)
+
+  def startDaemon(self):
+    config = os.path.join(self.workdir, 'config.yaml')
+    f = open(config, 'w')
+    try:
+      f.write(json.dumps({
+        'watch': [self.repo],
+        'state_dir': os.path.join(self.workdir, 'state'),
+        'hot_copies': self.options.hot_copies,
+        'batch_quiet_period': self.options.quiet_period,
+        'batch_max_delay': self.options.max_delay,
+        'workers': self.options.workers,
+        'package_cache_size': self.options.cache_size,
+      }))
+    finally:
+      f.close()
+
+    self.daemon = updaterepod.Updaterepo_Daemon(config_file=config)
+    self.handler = updaterepod.iNotifyEventHandler(self.daemon.batcher, self.daemon.locate_package, self.daemon.reconcile_repos, self.daemon.watch_lost)
+
+    # accounts for the events processed by each update
+    update_repo = self.daemon.update_repo
+    def tracked_update_repo(directory, added, removed, moved, since, seq = None):
+      try:
+        update_repo(directory, added, removed, moved, since, seq)
+      finally:
+        self.processed(added + removed + [dest for (src, dest) in moved])
+    self.daemon.update_repo = tracked_update_repo
+
+    self.daemon.start_watching(self.repo)
+    self.loop = threading.Thread(target=self.eventLoop)
+    self.loop.daemon = True
+    self.loop.start()
+
+  def stopDaemon(self):
+    self.daemon.close_repos()
+    self.waitIdle()
+    self.stopped.set()
+    self.loop.join()
+
+  def eventLoop(self):
+    """Mimics the notifier loop of the daemon, only reading the events from
+       inotify when asked to"""
+    notifier = self.daemon.notifier
+    while not self.stopped.is_set():
+      if self.options.inotify:
+        notifier.process_events()
+        if notifier.check_events():
+          notifier.read_events()
+      else:
+        self.stopped.wait(self.daemon.BATCH_TICK / 1000.0)
+      self.daemon.batcher.flush()
+
+  def processed(self, hrefs):
+    now = time.time()
+    with self.lock:
+      self.updates += 1
+      for href in hrefs:
+        for injected in self.injected.pop(href, []):
+          self.latencies.append(now - injected)
+
+  def isIdle(self):
+    return len(self.daemon.batcher.pendingCounts()) == 0 and not self.daemon.workers.isBusy(self.repo)
+
+  def waitIdle(self):
+    idle = 0
+    # twice in a row, as batches are handed over to the workers in between
+    while idle < 2:
+      time.sleep(0.01)
+      if self.isIdle():
+        idle += 1
+      else:
+        idle = 0
+
+  def reconcile(self):
+    """Startup of the daemon: catching up with the repository"""
+    start = time.time()
+    self.daemon.reconcile_repos()
+    self.waitIdle()
+    self.scenario('reconcile', start, self.options.packages)
+
+  def inject(self, mask, pathname, src_pathname = None):
+    raw = {'wd': self.daemon.wd_fds[self.repo], 'mask': mask, 'cookie': 0, 'path': os.path.dirname(pathname), 'name': os.path.basename(pathname), 'dir': False}
+    if src_pathname is not None:
+      raw['src_pathname'] = src_pathname
+    self.handler(pyinotify.Event(raw))
+
+  def replay(self):
+    if self.options.events_file is not None:
+      events = readEvents(self.options.events_file)
+    else:
+      mix = [(operation, int(weight)) for (operation, weight) in [item.split('=') for item in self.options.mix.split(',')]]
+      events = syntheticEvents(self.options.packages, self.options.events, self.options.rate, mix, self.options.seed)
+    if self.options.save_events is not None:
+      writeEvents(self.options.save_events, events)
+
+    generations = {}
+    applied = 0
+    start = time.time()
+    for event in events:
+      delay = start + event[0] - time.time()
+      if delay > 0:
+        time.sleep(delay)
+
+      (operation, href) = event[1:3]
+      pathname = os.path.join(self.repo, href)
+      if operation != "write" and not os.path.exists(pathname):
+        self.logger.warning("Skipping %s of missing %s" % (operation, href))
+        continue
+
+      key = href
+      if operation == "write":
+        generations[href] = generations.get(href, 0) + 1
+        self.generator.write(self.repo, href, generations[href])
+        mask = pyinotify.IN_CLOSE_WRITE
+      elif operation == "touch":
+        data = open(pathname, 'rb').read()
+        f = open(pathname, 'wb')
+        f.write(data)
+        f.close()
+        mask = pyinotify.IN_CLOSE_WRITE
+      elif operation == "remove":
+        os.unlink(pathname)
+        mask = pyinotify.IN_DELETE
+      elif operation == "move":
+        key = event[3]
+        dest = os.path.join(self.repo, key)
+        os.rename(pathname, dest)
+      else:
+        self.logger.warning("Skipping unknown operation %s" % operation)
+        continue
+
+      with self.lock:
+        self.injected.setdefault(key, []).append(time.time())
+      applied += 1
+
+      if not self.options.inotify:
+        if operation == "move":
+          self.inject(pyinotify.IN_MOVED_FROM, pathname)
+          self.inject(pyinotify.IN_MOVED_TO, dest, pathname)
+        else:
+          self.inject(mask, pathname)
+
+    self.waitIdle()
+    with self.lock:
+      latencies = self.latencies
+      self.latencies = []
+      updates = self.updates
+      lost = sum([len(times) for times in self.injected.values()])
+
+    self.scenario('replay', start, applied,
+      updates=updates,
+      lost_events=lost,
+      latency_p50=percentile(latencies, 50),
+      latency_p99=percentile(latencies, 99),
+      latency_max=percentile(latencies, 100))
+
+def formatBytes(value):
+  for unit in ('B', 'KiB', 'MiB', 'GiB'):
+    if abs(value) < 1024 or unit == 'GiB':
+      return "%.1f%s" % (value, unit)
+    value /= 1024.0
+
+def report(results, out = sys.stdout):
+  repository = results['repository']
+  out.write("Repository: %d packages, %s\n" % (repository['packages'], formatBytes(repository['bytes'])))
+  out.write("Peak RSS: %s (children: %s)\n" % (formatBytes(results['peak_rss_bytes']), formatBytes(results['peak_children_rss_bytes'])))
+
+  for name in ('sync', 'reconcile', 'replay'):
+    if name not in results:
+      continue
+
+    result = results[name]
+    out.write("\n%s: %d operations in %.3fs (%.1f/s)\n" % (name, result['operations'], result['seconds'], result['throughput'] or 0))
+    if name == 'replay':
+      out.write("  %d updates, %d events not processed\n" % (result['updates'], result['lost_events']))
+      if result['latency_p50'] is not None:
+        out.write("  event-to-publish latency: p50 %.3fs, p99 %.3fs, max %.3fs\n" % (result['latency_p50'], result['latency_p99'], result['latency_max']))
+
+    out.write("  %-16s %8s %10s %12s %12s\n" % ('phase', 'count', 'seconds', 'read', 'written'))
+    for (phase, p) in sorted(result['phases'].items(), key=lambda item: -item[1]['seconds']):
+      out.write("  %-16s %8d %10.3f %12s %12s\n" % (phase, p['count'], p['seconds'], formatBytes(p['read_bytes']), formatBytes(p['written_bytes'])))
+
+class EventRecorder(pyinotify.ProcessEvent):
+  """Records the changes made to the packages of a directory in the format
+     replayed by the benchmark"""
+
+  def my_init(self, directory):
+    self.directory = directory
+    self.start = time.time()
+    self.events = []
+    # cookie -> index of the event recorded for IN_MOVED_FROM
+    self.moves = {}
+
+  def record(self, *event):
+    self.events.append((time.time() - self.start, ) + event)
+
+  def href(self, pathname):
+    return os.path.relpath(pathname, self.directory)
+
+  def process_IN_CLOSE_WRITE(self, event):
+    if updaterepod.isPackage(event.pathname):
+      self.record("write", self.href(event.pathname))
+
+  def process_IN_DELETE(self, event):
+    if updaterepod.isPackage(event.pathname):
+      self.record("remove", self.href(event.pathname))
+
+  def process_IN_MOVED_FROM(self, event):
+    if updaterepod.isPackage(event.pathname):
+      # a removal unless the package shows up again
+      self.moves[event.cookie] = len(self.events)
+      self.record("remove", self.href(event.pathname))
+
+  def process_IN_MOVED_TO(self, event):
+    if not updaterepod.isPackage(event.pathname):
+      return
+
+    index = self.moves.pop(event.cookie, None)
+    if index is not None:
+      (offset, operation, src) = self.events[index]
+      self.events[index] = (offset, "move", src, self.href(event.pathname))
+    else:
+      self.record("write", self.href(event.pathname))
+
+def record(directory, filename):
+  directory = os.path.abspath(directory)
+  wm = pyinotify.WatchManager()
+  recorder = EventRecorder(directory=directory)
+  notifier = pyinotify.Notifier(wm, recorder)
+  wm.add_watch(directory, pyinotify.IN_CLOSE_WRITE | pyinotify.IN_DELETE | pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO, rec=True, auto_add=True, exclude_filter=updaterepod.isMetadataDir)
+
+  def interrupt(signum, frame):
+    raise KeyboardInterrupt()
+  signal.signal(signal.SIGTERM, interrupt)
+
+  sys.stderr.write("Recording events in %s, interrupt to stop ..\n" % directory)
+  try:
+    notifier.loop()
+  except KeyboardInterrupt:
+    pass
+
+  writeEvents(filename, recorder.events)
+  sys.stderr.write("Recorded %d events to %s\n" % (len(recorder.events), filename))
+
+def parse_args():
+  parser = OptionParser(usage = "Usage: %prog [options] run\n       %prog [options] generate DIR\n       %prog record DIR FILE")
+  parser.add_option('-n', '--packages', dest = "packages", type = "int", default = 1000, help = "Number of packages of the synthetic repository (default: 1000)", metavar = "N")
+  parser.add_option('-f', '--files', dest = "files", type = "int", default = 50, help = "Average number of files per package (default: 50)", metavar = "N")
+  parser.add_option('-S', '--size', dest = "size", type = "int", default = 65536, help = "Average size in bytes of the payload of the packages (default: 65536)", metavar = "BYTES")
+  parser.add_option('--seed', dest = "seed", type = "int", default = 0, help = "Seed of the synthetic repository and events (default: 0)", metavar = "N")
+  parser.add_option('-e', '--events', dest = "events", type = "int", default = 500, help = "Number of synthetic events to replay (default: 500)", metavar = "N")
+  parser.add_option('-r', '--rate', dest = "rate", type = "float", default = 0, help = "Average number of synthetic events per second, 0 for as fast as possible (default: 0)", metavar = "N")
+  parser.add_option('-m', '--mix', dest = "mix", default = "add=4,update=2,touch=2,remove=1,move=1", help = "Weights of the synthetic operations (default: add=4,update=2,touch=2,remove=1,move=1)", metavar = "MIX")
+  parser.add_option('-E', '--events-file', dest = "events_file", default = None, help = "Replay the events recorded in FILE instead of synthetic ones", metavar = "FILE")
+  parser.add_option('--save-events', dest = "save_events", default = None, help = "Save the replayed events to FILE", metavar = "FILE")
+  parser.add_option('-i', '--inotify', action = "store_true", dest = "inotify", default = False, help = "Read the events from inotify instead of injecting them into the event handler")
+  parser.add_option('--hot-copies', action = "store_true", dest = "hot_copies", default = False, help = "Keep hot working copies of the databases")
+  parser.add_option('-w', '--workers', dest = "workers", type = "int", default = 1, help = "Number of threads updating the metadata (default: 1)", metavar = "N")
+  parser.add_option('--sync-workers', dest = "sync_workers", type = "int", default = multiprocessing.cpu_count(), help = "Number of processes checksumming packages when synchronizing (default: number of CPUs)", metavar = "N")
+  parser.add_option('--cache-size', dest = "cache_size", type = "int", default = 10000, help = "Size of the package cache (default: 10000)", metavar = "N")
+  parser.add_option('--quiet-period', dest = "quiet_period", type = "float", default = 0.5, help = "Batch quiet period in seconds (default: 0.5)", metavar = "SECONDS")
+  parser.add_option('--max-delay', dest = "max_delay", type = "float", default = 5, help = "Batch maximum delay in seconds (default: 5)", metavar = "SECONDS")
+  parser.add_option('-D', '--directory', dest = "directory", default = None, help = "Directory to work in (default: a temporary directory)", metavar = "DIR")
+  parser.add_option('-k', '--keep', action = "store_true", dest = "keep", default = False, help = "Keep the working directory")
+  parser.add_option('-j', '--json', dest = "json", default = None, help = "Also write the results as JSON to FILE", metavar = "FILE")
+  parser.add_option('-d', '--debug', action = "store_true", dest = "debug", default = False, help = "Log what the daemon is doing")
+
+  return parser.parse_args()
+
+def main():
+  options, args = parse_args()
+
+  logger = logging.getLogger("app")
+  handler = logging.StreamHandler()
+  handler.setFormatter(logging.Formatter("[%(asctime)s] %(levelname)s - %(name)s: %(message)s"))
+  logger.addHandler(handler)
+  if options.debug:
+    logger.setLevel(logging.INFO)
+  else:
+    logger.setLevel(logging.WARNING)
+
+  if len(args) == 2 and args[0] == "generate":
+    generateRepository(args[1], PackageGenerator(options.seed, options.files, options.size), options.packages)
+  elif len(args) == 3 and args[0] == "record":
+    record(args[1], args[2])
+  elif len(args) == 1 and args[0] == "run":
+    results = Benchmark(options).run()
+    report(results)
+    if options.json is not None:
+      f = open(options.json, 'w')
+      try:
+        json.dump(results, f, indent=2, sort_keys=True)
+      finally:
+        f.close()
+  else:
+    sys.stderr.write("Unknown command, see --help\n")
+    return 1
+
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -16,11 +16,33 @@ import pyinotify
 import yaml
 import logging
 import re
+import time
+import tempfile
+import threading
+import collections
+import glob
+import fnmatch
+import itertools
+import array
+import binascii
+import contextlib
+import BaseHTTPServer
+import SocketServer
+import socket
+import json
+import cProfile
+import pstats
 from optparse import OptionParser
 import signal
 
 import shutil
-from bz2 import BZ2File
+import hashlib
+import zlib
+import cPickle
+import bz2
+from bz2 import BZ2File, BZ2Decompressor
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 
 # path to createrepo python modules, required
 sys.path.append("/usr/share/createrepo")
@@ -43,17 +65,39 @@ try:
 except ImportError:
   pass
 
+# xz compression of the databases, optional
+try:
+  import lzma
+except ImportError:
+  try:
+    from backports import lzma
+  except ImportError:
+    lzma = None
+
+# directory scanning telling directories apart without a stat() per entry, optional
+try:
+  from os import scandir
+except ImportError:
+  try:
+    from scandir import scandir
+  except ImportError:
+    scandir = None
+
 from createrepo.utils import _gzipOpen, bzipFile, checkAndMakeDir, GzipFile, checksum_and_rename, split_list_into_equal_chunks
 
 class MetaDataSqlite(createrepo.MetaDataSqlite):
   # re-defining method
-  def __init__(self, destdir):
+  def __init__(self, destdir, persistent = False):
+    # persistent databases are kept around once the metadata has been generated
+    self.persistent = persistent
+
+    # connections may be handed over between threads, access is serialized per repository
     self.pri_sqlite_file = os.path.join(destdir, 'primary.sqlite')
-    self.pri_cx = sqlite.Connection(self.pri_sqlite_file)
+    self.pri_cx = sqlite.Connection(self.pri_sqlite_file, check_same_thread=False)
     self.file_sqlite_file = os.path.join(destdir, 'filelists.sqlite')
-    self.file_cx = sqlite.Connection(self.file_sqlite_file)
+    self.file_cx = sqlite.Connection(self.file_sqlite_file, check_same_thread=False)
     self.other_sqlite_file = os.path.join(destdir, 'other.sqlite')
-    self.other_cx = sqlite.Connection(self.other_sqlite_file)
+    self.other_cx = sqlite.Connection(self.other_sqlite_file, check_same_thread=False)
     # using 8-bit strings rather than unicode
     self.other_cx.text_factory = str
     self.primary_cursor = self.pri_cx.cursor()
@@ -62,11 +106,295 @@ class MetaDataSqlite(createrepo.MetaDataSqlite):
 
     self.other_cursor = self.other_cx.cursor()
 
+    for cx in (self.pri_cx, self.file_cx, self.other_cx):
+      if persistent:
+        # working copy kept across updates, committed once per update
+        executeSQL(cx, "PRAGMA journal_mode = TRUNCATE;")
+        executeSQL(cx, "PRAGMA synchronous = NORMAL;")
+      else:
+        # throwaway copy, simply discarded if anything goes wrong
+        executeSQL(cx, "PRAGMA journal_mode = OFF;")
+        executeSQL(cx, "PRAGMA synchronous = OFF;")
+      executeSQL(cx, "PRAGMA temp_store = MEMORY;")
+
     self.create_primary_db()
     self.create_filelists_db()
     self.create_other_db()
 
+  def close(self):
+    self.pri_cx.close()
+    self.file_cx.close()
+    self.other_cx.close()
+
+class Metrics(object):
+  """Minimal registry of counters, gauges and histograms, rendered in the
+     Prometheus text exposition format"""
+
+  BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    # name -> (type, help)
+    self.definitions = {}
+    # name -> {labels: value}, histogram values being [bucket counts, sum, count]
+    self.values = {}
+    # functions returning (name, labels, value) samples computed when rendering
+    self.collectors = []
+
+  def define(self, name, kind, help):
+    self.definitions[name] = (kind, help)
+    self.values[name] = {}
+
+  def inc(self, name, value = 1, **labels):
+    key = tuple(sorted(labels.items()))
+    with self.lock:
+      self.values[name][key] = self.values[name].get(key, 0) + value
+
+  def set(self, name, value, **labels):
+    key = tuple(sorted(labels.items()))
+    with self.lock:
+      self.values[name][key] = value
+
+  def observe(self, name, value, **labels):
+    key = tuple(sorted(labels.items()))
+    with self.lock:
+      if key not in self.values[name]:
+        self.values[name][key] = [[0] * len(self.BUCKETS), 0.0, 0]
+      histogram = self.values[name][key]
+      for (i, bound) in enumerate(self.BUCKETS):
+        if value <= bound:
+          histogram[0][i] += 1
+      histogram[1] += value
+      histogram[2] += 1
+
+  @contextlib.contextmanager
+  def timer(self, name, **labels):
+    start = time.time()
+    try:
+      yield
+    finally:
+      self.observe(name, time.time() - start, **labels)
+
+  def collect(self, function):
+    self.collectors.append(function)
+
+  def render(self):
+    values = {}
+    with self.lock:
+      for (name, samples) in self.values.items():
+        values[name] = {}
+        for (key, value) in samples.items():
+          if isinstance(value, list):
+            value = [list(value[0]), value[1], value[2]]
+          values[name][key] = value
+
+    for function in self.collectors:
+      for (name, labels, value) in function():
+        values[name][tuple(sorted(labels.items()))] = value
+
+    lines = []
+    for name in sorted(self.definitions):
+      (kind, help) = self.definitions[name]
+      lines.append("# HELP %s %s" % (name, help))
+      lines.append("# TYPE %s %s" % (name, kind))
+      for (key, value) in sorted(values[name].items()):
+        if kind == 'histogram':
+          for (bound, count) in zip(self.BUCKETS, value[0]):
+            lines.append("%s_bucket%s %d" % (name, self.formatLabels(key + (('le', repr(float(bound))), )), count))
+          lines.append("%s_bucket%s %d" % (name, self.formatLabels(key + (('le', '+Inf'), )), value[2]))
+          lines.append("%s_sum%s %r" % (name, self.formatLabels(key), value[1]))
+          lines.append("%s_count%s %d" % (name, self.formatLabels(key), value[2]))
+        else:
+          lines.append("%s%s %r" % (name, self.formatLabels(key), value))
+
+    return "\n".join(lines) + "\n"
+
+  def formatLabels(self, key):
+    if len(key) == 0:
+      return ""
+    return "{%s}" % ",".join(['%s="%s"' % (label, str(value).replace('\\', '\\\\').replace('"', '\\"')) for (label, value) in key])
+
+metrics = Metrics()
+metrics.define('updaterepod_phase_seconds', 'histogram', 'Time spent in each phase of the metadata updates')
+metrics.define('updaterepod_event_to_publish_seconds', 'histogram', 'Time between the first event of a batch and the publication of the updated metadata')
+metrics.define('updaterepod_updates_total', 'counter', 'Number of metadata updates')
+metrics.define('updaterepod_packages_total', 'counter', 'Number of packages added, removed or moved')
+metrics.define('updaterepod_errors_total', 'counter', 'Number of errors')
+metrics.define('updaterepod_inotify_overflows_total', 'counter', 'Number of times the inotify queue overflowed')
+metrics.define('updaterepod_packages', 'gauge', 'Number of packages in the metadata of the last update')
+metrics.define('updaterepod_last_publish_timestamp_seconds', 'gauge', 'Time of the last publication of the metadata')
+metrics.define('updaterepod_pending_events', 'gauge', 'Number of packages with events waiting to be processed')
+metrics.define('updaterepod_queued_jobs', 'gauge', 'Number of jobs waiting for a worker')
+metrics.define('updaterepod_running_jobs', 'gauge', 'Number of jobs being run by a worker')
+
+class MetricsRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  def do_GET(self):
+    if self.path.split('?')[0] not in ('/', '/metrics'):
+      self.send_error(404)
+      return
+
+    body = metrics.render()
+    self.send_response(200)
+    self.send_header('Content-Type', 'text/plain; version=0.0.4')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    pass
+
+class ControlServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+  daemon_threads = True
+
+  def __init__(self, path, control):
+    """control is called with each request, returning the response"""
+    self.control = control
+    SocketServer.UnixStreamServer.__init__(self, path, ControlRequestHandler)
+
+class ControlRequestHandler(SocketServer.StreamRequestHandler):
+  """Requests and responses of the control socket are JSON objects, one per
+     line"""
+
+  def handle(self):
+    logger = logging.getLogger("app.ControlRequestHandler")
+    while True:
+      line = self.rfile.readline()
+      if not line:
+        break
+
+      try:
+        response = self.server.control(json.loads(line))
+      except Exception, e:
+        logger.error("Failed to process control request %s: %s" % (line.strip(), e))
+        response = {'ok': False, 'error': str(e)}
+
+      self.wfile.write(json.dumps(response) + "\n")
+      self.wfile.flush()
+
+# compression codecs of the databases, along with their file suffix and default level
+COMPRESSION_SUFFIXES = {'bz2': 'bz2', 'gzip': 'gz', 'xz': 'xz'}
+COMPRESSION_LEVELS = {'bz2': 9, 'gzip': 6, 'xz': 6}
+# size of the reads when compressing, large enough to keep the round trips
+# to network filesystems down
+COMPRESS_BUFFER_SIZE = 4 * 2**20
+
+class Profiler(object):
+  """Runs the metadata updates under cProfile, one of every few updates or
+     all of them, keeping the profile of the ones slower than a threshold in
+     a directory along with a summary of the functions with the highest
+     cumulative time. Only the calling thread is profiled."""
+
+  # number of functions listed in the summaries
+  SUMMARY_LINES = 40
+
+  def __init__(self):
+    self.logger = logging.getLogger("app.Profiler")
+    self.lock = threading.Lock()
+    self.directory = None
+    self.every = 1
+    self.threshold = 0
+    self.retention = 100
+    self.runs = 0
+
+  def configure(self, directory, every = 1, threshold = 0, retention = 100):
+    """Enables profiling (disabled if directory is None), can be called at
+       any time"""
+    if directory is not None and not os.path.isdir(directory):
+      os.makedirs(directory)
+
+    with self.lock:
+      self.directory = directory
+      self.every = max(1, every)
+      self.threshold = threshold
+      self.retention = retention
+
+  def run(self, name, function, *args, **kwargs):
+    with self.lock:
+      directory = self.directory
+      self.runs += 1
+      sampled = self.runs % self.every == 0
+      threshold = self.threshold
+
+    if directory is None or not sampled:
+      return function(*args, **kwargs)
+
+    profile = cProfile.Profile()
+    start = time.time()
+    try:
+      return profile.runcall(function, *args, **kwargs)
+    finally:
+      elapsed = time.time() - start
+      if elapsed >= threshold:
+        try:
+          self.dump(directory, name, profile, elapsed)
+        except Exception, e:
+          self.logger.error("Failed to write the profile of %s to %s: %s" % (name, directory, e))
+
+  def dump(self, directory, name, profile, elapsed):
+    """Writes <time>-<name>.prof, to be loaded with pstats, and the summary
+       in <time>-<name>.txt, then removes the oldest profiles beyond the
+       retention"""
+    now = time.time()
+    basename = "%s.%03d-%s" % (time.strftime("%Y%m%d-%H%M%S", time.localtime(now)), now * 1000 % 1000, name.strip('/').replace('/', '_'))
+    base = os.path.join(directory, basename)
+    profile.dump_stats(base + ".prof")
+    with open(base + ".txt", 'w') as f:
+      f.write("%s: %.3fs\n\n" % (name, elapsed))
+      pstats.Stats(profile, stream=f).sort_stats('cumulative').print_stats(self.SUMMARY_LINES)
+    self.logger.info("Profiled %s in %.2fs: %s.prof" % (name, elapsed, base))
+
+    if self.retention > 0:
+      dumps = sorted([f for f in os.listdir(directory) if f.endswith(".prof")], key=lambda f: os.stat(os.path.join(directory, f)).st_mtime)
+      for f in dumps[:-self.retention]:
+        for path in (os.path.join(directory, f), os.path.join(directory, f[:-len(".prof")] + ".txt")):
+          if os.path.exists(path):
+            os.unlink(path)
+
+profiler = Profiler()
+
+class UpdateRepoConfig(createrepo.MetaDataConfig):
+  def __init__(self):
+    createrepo.MetaDataConfig.__init__(self)
+    # codec and level the databases are compressed with, None for the codec's default level
+    self.compression = 'bz2'
+    self.compression_level = None
+    # number of threads compressing and checksumming the databases
+    self.compress_workers = 3
+    # size in MiB of the blocks compressed in parallel, 0 to disable
+    self.parallel_bzip2_min_size = 0
+    # whether to publish the XML metadata along with the databases
+    self.xml_metadata = False
+    # whether to switch to the new metadata by renaming repomd.xml, with
+    # checksum-named files, instead of replacing the whole of repodata/
+    self.atomic_publish = False
+    # seconds the files of the previous metadata are kept once superseded
+    self.publish_grace_period = 600
+    # whether to only publish the primary database (and XML) on updates, the
+    # filelists and other ones being refreshed by a later action="refresh"
+    self.tiered_publish = False
+    self.unique_md_filenames = False
+
 class MetaDataGenerator(createrepo.MetaDataGenerator):
+  # XmlFragments the XML metadata is written from, if enabled
+  xml_fragments = None
+  # types of metadata whose entry in previous_repomd is published again,
+  # instead of being generated, and the RepoData reused that way
+  deferred = ()
+  previous_repomd = None
+  reused = ()
+
+  def reuseData(self, repomd, data_type):
+    """Copies the entry of data_type of the previous repomd.xml, if any,
+       returning whether it did"""
+    if self.previous_repomd is None or data_type not in self.previous_repomd.fileTypes():
+      return False
+    if not os.path.exists(os.path.join(self.conf.outputdir, self.previous_repomd.getData(data_type).location[1])):
+      return False
+
+    repomd.repoData[data_type] = self.previous_repomd.getData(data_type)
+    self.reused.append(repomd.repoData[data_type])
+    return True
+
   # re-defining method
   def doRepoMetadata(self):
     """wrapper to generate the repomd.xml file that stores the info
@@ -158,32 +486,23 @@ class MetaDataGenerator(createrepo.MetaDataGenerator):
 
           # rename from silly name to not silly name
           os.rename(tmp_result_path, resultpath)
-          compressed_name = '%s.bz2' % good_name
+          compressed_name = '%s.%s' % (good_name, COMPRESSION_SUFFIXES[self.conf.compression])
           result_compressed = os.path.join(repopath, compressed_name)
-          db_csums[ftype] = misc.checksum(sumtype, resultpath)
-
-          # compress the files
-          bzipFile(resultpath, result_compressed)
-          # csum the compressed file
-          db_compressed_sums[ftype] = misc.checksum(sumtype,
-                               result_compressed)
-          # timestamp+size the uncompressed file
-          un_stat = os.stat(resultpath)
+          # compress and csum the files
+          (db_csums[ftype], un_size, db_compressed_sums[ftype], db_size) = compressFile(resultpath, result_compressed, self.conf.compression,
+                                                                                       self.conf.compression_level, sumtype)
           # remove the uncompressed file
           os.unlink(resultpath)
 
           if self.conf.unique_md_filenames:
-            csum_compressed_name = '%s-%s.bz2' % (
-                       db_compressed_sums[ftype], good_name)
+            csum_compressed_name = '%s-%s.%s' % (
+                       db_compressed_sums[ftype], good_name, COMPRESSION_SUFFIXES[self.conf.compression])
             csum_result_compressed =  os.path.join(repopath,
                                csum_compressed_name)
             os.rename(result_compressed, csum_result_compressed)
             result_compressed = csum_result_compressed
             compressed_name = csum_compressed_name
 
-          # timestamp+size the compressed file
-          db_stat = os.stat(result_compressed)
-
           # add this data as a section to the repomdxml
           db_data_type = '%s_db' % ftype
           data = RepoData()
@@ -191,9 +510,9 @@ class MetaDataGenerator(createrepo.MetaDataGenerator):
           data.location = (self.conf.baseurl, 
                 os.path.join(self.conf.finaldir, compressed_name))
           data.checksum = (sumtype, db_compressed_sums[ftype])
-          data.timestamp = str(db_stat.st_mtime)
-          data.size = str(db_stat.st_size)
-          data.opensize = str(un_stat.st_size)
+          data.timestamp = str(time.time())
+          data.size = str(db_size)
+          data.opensize = str(un_size)
           data.openchecksum = (sumtype, db_csums[ftype])
           data.dbversion = dbversion
           if self.conf.verbose:
@@ -224,39 +543,63 @@ class MetaDataGenerator(createrepo.MetaDataGenerator):
 
     if not self.conf.quiet and self.conf.database: self.callback.log('Sqlite DBs complete')
 
+    # deferred databases are published as they were
+    self.reused = []
+    db_workfiles = [(fn, ftype) for (fn, ftype) in db_workfiles if ftype not in self.deferred or not self.reuseData(repomd, '%s_db' % ftype)]
+
+    # compress and checksum the databases concurrently
+    suffix = COMPRESSION_SUFFIXES[self.conf.compression]
+    pool = ThreadPool(max(1, min(self.conf.compress_workers, len(db_workfiles))))
+    results = {}
+    try:
+      for (fn, ftype) in db_workfiles:
+        result_compressed = os.path.join(repopath, '%s.%s' % (os.path.basename(fn), suffix))
+        results[ftype] = pool.apply_async(compressDB, (fn, result_compressed, sumtype,
+                                                      self.conf.compression, self.conf.compression_level,
+                                                      self.conf.parallel_bzip2_min_size * 2**20,
+                                                      self.conf.compress_workers))
+
+      # written while the databases are being compressed
+      if self.conf.xml_metadata:
+        self.doXmlMetadata(repomd, repopath, sumtype)
+    finally:
+      pool.close()
+      pool.join()
+    db_timestamp = time.time()
+
     for (fn, ftype) in db_workfiles:
       db_csums = {}
       db_compressed_sums = {}
 
-      result_compressed = '%s.bz2' % fn
-      compressed_name = os.path.basename(result_compressed)
-
-      db_csums[ftype] = misc.checksum(sumtype, fn)
+      compressed_name = '%s.%s' % (os.path.basename(fn), suffix)
+      result_compressed = os.path.join(repopath, compressed_name)
 
-      bzipFile(fn, result_compressed)
-      db_compressed_sums[ftype] = misc.checksum(sumtype, result_compressed)
+      (db_csums[ftype], un_size, db_compressed_sums[ftype], db_size) = results[ftype].get()
 
-      # timestamp+size the compressed file
-      un_stat = os.stat(fn)
-      db_stat = os.stat(result_compressed)
+      if self.conf.unique_md_filenames:
+        compressed_name = '%s-%s' % (db_compressed_sums[ftype], compressed_name)
+        os.rename(result_compressed, os.path.join(repopath, compressed_name))
+        result_compressed = os.path.join(repopath, compressed_name)
 
-      # add this data as a section to the repomdxml
+      # add this data as a section to the repomdxml, the sizes being known
+      # from compressing the file
       db_data_type = '%s_db' % ftype
       data = RepoData()
       data.type = db_data_type
       data.location = (self.conf.baseurl,
             os.path.join(self.conf.finaldir, compressed_name))
       data.checksum = (sumtype, db_compressed_sums[ftype])
-      data.timestamp = str(db_stat.st_mtime)
-      data.size = str(db_stat.st_size)
-      data.opensize = str(un_stat.st_size)
+      data.timestamp = str(db_timestamp)
+      data.size = str(db_size)
+      data.opensize = str(un_size)
       data.openchecksum = (sumtype, db_csums[ftype])
       data.dbversion = dbversion
       repomd.repoData[data.type] = data
-      try:
-        os.unlink(fn)
-      except (IOError, OSError), e:
-        pass
+      if not self.md_sqlite.persistent:
+        try:
+          os.unlink(fn)
+        except (IOError, OSError), e:
+          pass
 
     if self.conf.groupfile is not None:
       mdcontent = self._createRepoDataObject(self.conf.groupfile, 'group_gz')
@@ -284,14 +627,90 @@ class MetaDataGenerator(createrepo.MetaDataGenerator):
       fo.close()
       raise MDError, 'Could not save temp file: %s' % repofilepath
 
+  def doXmlMetadata(self, repomd, repopath, sumtype):
+    """Writes primary.xml.gz, filelists.xml.gz and other.xml.gz from the
+       fragments of the packages, only generating the ones of the packages
+       changed since the last time"""
+    with metrics.timer('updaterepod_phase_seconds', phase='xml'):
+      count = self.xml_fragments.refresh(self.md_sqlite)
+
+      for ftype in XmlFragments.TYPES:
+        if ftype in self.deferred and self.reuseData(repomd, ftype):
+          continue
+
+        name = '%s.xml.gz' % ftype
+        result = os.path.join(repopath, name)
+        (uncsum, unsize, csum, size) = self.xml_fragments.write(ftype, count, result, sumtype)
+        if self.conf.unique_md_filenames:
+          name = '%s-%s' % (csum, name)
+          os.rename(result, os.path.join(repopath, name))
+
+        data = RepoData()
+        data.type = ftype
+        data.location = (self.conf.baseurl, os.path.join(self.conf.finaldir, name))
+        data.checksum = (sumtype, csum)
+        data.timestamp = str(time.time())
+        data.size = str(size)
+        data.opensize = str(unsize)
+        data.openchecksum = (sumtype, uncsum)
+        repomd.repoData[data.type] = data
+
 class AppendingMetaDataSqlite(MetaDataSqlite):
-  def __init__(self, destdir):
+  """Databases updated in place. Nothing is committed until commit() is
+     called, so that all the changes of an update are written in a single
+     transaction per database."""
+
+  # maximum number of parameters of a statement
+  MAX_VARIABLES = 500
+
+  # indexes the lookups and deletes rely on: (database, name, table, column)
+  INDEXES = (
+    ('primary', 'packagehref', 'packages', 'location_href'),
+    ('primary', 'pkgfiles', 'files', 'pkgKey'),
+    ('primary', 'pkgrequires', 'requires', 'pkgKey'),
+    ('primary', 'pkgprovides', 'provides', 'pkgKey'),
+    ('primary', 'pkgconflicts', 'conflicts', 'pkgKey'),
+    ('primary', 'pkgobsoletes', 'obsoletes', 'pkgKey'),
+    ('filelists', 'keyfile', 'filelist', 'pkgKey'),
+    ('other', 'keychange', 'changelog', 'pkgKey'),
+  )
+
+  def __init__(self, destdir, persistent = False):
     self.logger = logging.getLogger("app.AppendingMetaDataSqlite")
-    MetaDataSqlite.__init__(self, destdir)
-
-  def getPackageIndex(self):
+    MetaDataSqlite.__init__(self, destdir, persistent)
+    self.createIndexes()
+
+  def createIndexes(self):
+    """Creates the indexes missing from the databases, e.g. when they were
+       generated by another tool. Extra indexes are ignored by yum."""
+    connections = dict(self.connections())
+    for (db, name, table, column) in self.INDEXES:
+      cx = connections[db]
+      indexed = False
+      for index in executeSQL(cx, "PRAGMA index_list(%s);" % table).fetchall():
+        columns = executeSQL(cx, "PRAGMA index_info(%s);" % index[1]).fetchall()
+        if len(columns) > 0 and columns[0][2] == column:
+          indexed = True
+          break
+
+      if not indexed:
+        self.logger.debug("Creating index %s on %s(%s) in %s database" % (name, table, column, db))
+        executeSQL(cx, "CREATE INDEX IF NOT EXISTS %s ON %s (%s);" % (name, table, column))
+    self.commit()
+
+  def getPackageIndex(self, hrefs = None):
+    """Returns the pkgKey of every package, or only of the ones located at
+       hrefs, keyed by location_href"""
     index = {}
-    result = executeSQL(self.pri_cx, "SELECT pkgKey, location_href FROM packages;").fetchall()
+    if hrefs is None:
+      result = executeSQL(self.pri_cx, "SELECT pkgKey, location_href FROM packages;").fetchall()
+    else:
+      hrefs = list(hrefs)
+      result = []
+      for i in range(0, len(hrefs), self.MAX_VARIABLES):
+        chunk = hrefs[i:i + self.MAX_VARIABLES]
+        result.extend(executeSQL(self.pri_cx, "SELECT pkgKey, location_href FROM packages WHERE location_href IN (%s);" % ", ".join(["?"] * len(chunk)), chunk).fetchall())
+
     for row in result:
       index[row[1]] = row[0]
     return index
@@ -332,29 +751,1349 @@ class AppendingMetaDataSqlite(MetaDataSqlite):
       raise MDError('DB exists, but has wrong table count. Was ' + object_count.__str__() + ', expected: ' + expected_count.__str__())
 
   def removePkgKey(self, pkgKey):
-    executeSQL(self.pri_cx, "DELETE FROM packages WHERE pkgKey = ?;", (pkgKey, ))
+    self.removePkgKeys([pkgKey])
+
+  def removePkgKeys(self, pkgKeys):
+    """Removes packages, the triggers of the databases removing their
+       files, dependencies and changelogs"""
+    if len(pkgKeys) == 0:
+      return
+
+    with metrics.timer('updaterepod_phase_seconds', phase='remove'):
+      for (db, cx) in self.connections():
+        for i in range(0, len(pkgKeys), self.MAX_VARIABLES):
+          chunk = pkgKeys[i:i + self.MAX_VARIABLES]
+          executeSQL(cx, "DELETE FROM packages WHERE pkgKey IN (%s);" % ", ".join(["?"] * len(chunk)), chunk)
+
+  def iterPackages(self, page_size = 1000):
+    """Yields the location_href and pkgKey of every package, sorted by
+       location_href, a page at a time. Pages start after the last location
+       of the previous page, so packages can be added and removed while
+       iterating, as long as it is before the current location."""
+    last = None
+    while True:
+      if last is None:
+        rows = executeSQL(self.pri_cx, "SELECT location_href, pkgKey FROM packages ORDER BY location_href LIMIT ?;", (page_size, )).fetchall()
+      else:
+        rows = executeSQL(self.pri_cx, "SELECT location_href, pkgKey FROM packages WHERE location_href > ? ORDER BY location_href LIMIT ?;", (last, page_size)).fetchall()
+
+      for (href, pkgKey) in rows:
+        if isinstance(href, unicode):
+          href = href.encode('utf-8')
+        yield (href, pkgKey)
+
+      if len(rows) < page_size:
+        return
+      last = rows[-1][0]
+
+  def countPackages(self):
+    return executeSQL(self.pri_cx, "SELECT COUNT(*) FROM packages;").fetchone()[0]
+
+  def getPackageId(self, pkgKey):
+    result = executeSQL(self.pri_cx, "SELECT pkgId FROM packages WHERE pkgKey = ?;", (pkgKey, )).fetchall()
+    if len(result) > 0:
+      return result[0][0]
+    return None
+
+  def connections(self):
+    return (('primary', self.pri_cx), ('filelists', self.file_cx), ('other', self.other_cx))
+
+  def highestPkgKey(self):
+    """Returns the highest pkgKey found in any of the databases, 0 if empty"""
+    highest = 0
+    for (db, cx) in self.connections():
+      highest = max(highest, executeSQL(cx, "SELECT MAX(pkgKey) FROM packages;").fetchone()[0] or 0)
+    return highest
+
+  def packageRows(self, pkgKey):
+    """Returns all the rows describing a package, as a {db: {table: (columns, rows)}} dictionary"""
+    rows = {}
+    for (db, cx) in self.connections():
+      rows[db] = {}
+      for (table, ) in executeSQL(cx, 'SELECT name FROM sqlite_master WHERE type = "table" AND name != "db_info";').fetchall():
+        cursor = executeSQL(cx, "SELECT * FROM %s WHERE pkgKey = ?;" % table, (pkgKey, ))
+        rows[db][table] = ([column[0] for column in cursor.description], cursor.fetchall())
+    return rows
+
+  def insertPackageRows(self, rows, pkgKey, href, baseurl, mtime):
+    """Inserts the rows returned by packageRows as a new package, located at href"""
+    for (db, cx) in self.connections():
+      for (table, (columns, table_rows)) in rows[db].items():
+        overrides = {'pkgKey': pkgKey}
+        if db == 'primary' and table == 'packages':
+          overrides.update({'location_href': href, 'location_base': baseurl, 'time_file': mtime})
+
+        positions = [(columns.index(column), value) for (column, value) in overrides.items() if column in columns]
+        values = []
+        for row in table_rows:
+          row = list(row)
+          for (position, value) in positions:
+            row[position] = value
+          values.append(row)
+
+        cx.executemany("INSERT INTO %s (%s) VALUES (%s);" % (table, ", ".join(columns), ", ".join(["?"] * len(columns))), values)
+
+  def renamePackage(self, pkgKey, href):
+    executeSQL(self.pri_cx, "UPDATE packages SET location_href = ? WHERE pkgKey = ?;", (href, pkgKey))
+
+  def dumpPackage(self, po):
+    """Writes a package to the databases, leaving the transactions open"""
+    po.do_primary_sqlite_dump(self.primary_cursor)
+    po.do_filelists_sqlite_dump(self.filelists_cursor)
+    po.do_other_sqlite_dump(self.other_cursor)
+
+  def commit(self):
     self.pri_cx.commit()
-    executeSQL(self.file_cx, "DELETE FROM packages WHERE pkgKey = ?;", (pkgKey, ))
     self.file_cx.commit()
-    executeSQL(self.other_cx, "DELETE FROM packages WHERE pkgKey = ?;", (pkgKey, ))
     self.other_cx.commit()
 
+class ChecksumWriter(object):
+  """Wraps a file object, checksumming the data written to it"""
+
+  def __init__(self, fo, sumtype):
+    self.fo = fo
+    self.sumtype = sumtype
+    self.checksums = misc.Checksums([sumtype])
+
+  def write(self, data):
+    if data:
+      self.fo.write(data)
+      self.checksums.update(data)
+
+  def result(self):
+    """Returns the checksum and size of the data written so far"""
+    return (self.checksums.hexdigest(self.sumtype), len(self.checksums))
+
+# bzip2 stream layout, see the bzip2 format specification
+BZIP2_BLOCK_MAGIC = 0x314159265359
+BZIP2_EOS_MAGIC = 0x177245385090
+
+def bzipBlock(data, level):
+  """bzip2 compresses data into a single bzip2 block. Returns the block as a
+     (bits, length in bits, block CRC) tuple, None if data did not fit in a
+     single block."""
+  stream = bz2.compress(data, level)
+  value = int(binascii.hexlify(stream), 16)
+  length = len(stream) * 8
+  # the stream ends with the end of stream marker, its CRC and up to 7 bits
+  # of padding
+  for padding in range(8):
+    if (value >> (padding + 32)) & 0xffffffffffff == BZIP2_EOS_MAGIC:
+      break
+  else:
+    raise MDError("Unexpected end of bzip2 stream")
+  crc = (value >> padding) & 0xffffffff
+  # after the 4 bytes header, up to the end of stream marker
+  bits = length - 32 - 80 - padding
+  block = (value >> (80 + padding)) & ((1 << bits) - 1)
+  if block >> (bits - 48) != BZIP2_BLOCK_MAGIC or (block >> (bits - 80)) & 0xffffffff != crc:
+    # the stream CRC only matches the block one when there is a single block
+    return None
+  return (block, bits, crc)
+
+def bzipBlockSize(level):
+  """Returns how many bytes are compressed into each bzip2 block"""
+  # a bit less than the size of a block, which the run-length encoding
+  # applied first grows when the data has runs of 4 identical bytes
+  return (100000 * level - 19) * 99 / 100
+
+def bzipBlocks(data, level):
+  """bzip2 compresses data, at most bzipBlockSize bytes, into bzip2 blocks
+     to be concatenated into a single stream"""
+  block = bzipBlock(data, level)
+  if block is not None:
+    return [block]
+
+  # grown by up to a quarter, whatever the data
+  size = (100000 * level - 19) * 4 / 5 - 5
+  blocks = [bzipBlock(data[offset:offset + size], level) for offset in range(0, len(data), size)]
+  if None in blocks:
+    raise MDError("Unexpected bzip2 block count")
+  return blocks
+
+def parallelBzipFile(source, dest, workers, level = 9, sumtype = 'sha256'):
+  """bzip2 compresses source on a pool of threads, one bzip2 block each,
+     the blocks being written into a single bzip2 stream as yum on Python 2
+     only reads the first stream of a file. Returns the checksum and size of
+     source and of the compressed file."""
+  pool = ThreadPool(workers)
+  orig = open(source, 'rb')
+  opened = misc.Checksums([sumtype])
+  result = ChecksumWriter(open(dest, 'wb'), sumtype)
+  # bits not written yet, less than a byte
+  (pending, pending_bits) = (0, 0)
+  combined_crc = 0
+  try:
+    result.write('BZh%d' % level)
+    while True:
+      # bound memory usage to a couple of blocks per worker
+      chunks = []
+      for i in range(workers * 2):
+        chunk = orig.read(bzipBlockSize(level))
+        if not chunk:
+          break
+        opened.update(chunk)
+        chunks.append(chunk)
+
+      if not chunks:
+        break
+
+      for blocks in pool.imap(lambda chunk: bzipBlocks(chunk, level), chunks):
+        for (block, bits, crc) in blocks:
+          combined_crc = (((combined_crc << 1) | (combined_crc >> 31)) & 0xffffffff) ^ crc
+          pending = (pending << bits) | block
+          pending_bits += bits
+          (size, pending_bits) = divmod(pending_bits, 8)
+          result.write(binascii.unhexlify('%0*x' % (size * 2, pending >> pending_bits)))
+          pending &= (1 << pending_bits) - 1
+
+    # end of stream marker and combined CRC, padded to a whole byte
+    pending = (((pending << 48) | BZIP2_EOS_MAGIC) << 32) | combined_crc
+    pending_bits += 80
+    padding = -pending_bits % 8
+    result.write(binascii.unhexlify('%0*x' % ((pending_bits + padding) / 4, pending << padding)))
+  finally:
+    result.fo.close()
+    orig.close()
+    pool.close()
+    pool.join()
+
+  return (opened.hexdigest(sumtype), len(opened)) + result.result()
+
+def compressor(compression, level = None):
+  """Returns a compressor object (with compress() and flush() methods) of the
+     given codec"""
+  if level is None:
+    level = COMPRESSION_LEVELS[compression]
+
+  if compression == 'bz2':
+    return bz2.BZ2Compressor(level)
+  elif compression == 'gzip':
+    # gzip header and trailer around the deflate stream
+    return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+  elif compression == 'xz':
+    if lzma is None:
+      raise MDError("xz compression requires the lzma module")
+    try:
+      # backports.lzma
+      return lzma.LZMACompressor(preset=level)
+    except TypeError:
+      # pyliblzma
+      return lzma.LZMACompressor(options={'level': level, 'format': 'xz'})
+
+  raise MDError("Unknown compression %s" % compression)
+
+def decompressor(filename):
+  """Returns a decompressor object for filename, based on its suffix"""
+  if filename.endswith('.gz'):
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+  elif filename.endswith('.xz'):
+    if lzma is None:
+      raise MDError("xz decompression requires the lzma module")
+    return lzma.LZMADecompressor()
+
+  return BZ2Decompressor()
+
+def compressFile(source, dest, compression, level = None, sumtype = 'sha256'):
+  """Compresses source into dest, reading source only once: it is
+     checksummed as it is read and the compressed data as it is written.
+     Returns the checksum and size of source and of the compressed file."""
+  c = compressor(compression, level)
+  orig = open(source, 'rb')
+  opened = misc.Checksums([sumtype])
+  result = ChecksumWriter(open(dest, 'wb'), sumtype)
+  try:
+    while True:
+      data = orig.read(COMPRESS_BUFFER_SIZE)
+      if not data:
+        break
+      opened.update(data)
+      result.write(c.compress(data))
+    result.write(c.flush())
+  finally:
+    result.fo.close()
+    orig.close()
+
+  return (opened.hexdigest(sumtype), len(opened)) + result.result()
+
+def compressDB(fn, result_compressed, sumtype, compression = 'bz2', level = None, parallel_size = 0, workers = 1):
+  """Compresses a database, returning the checksum and size of both the
+     uncompressed and the compressed file"""
+  with metrics.timer('updaterepod_phase_seconds', phase='compress'):
+    if compression == 'bz2' and parallel_size > 0 and workers > 1 and os.path.getsize(fn) > parallel_size:
+      return parallelBzipFile(fn, result_compressed, workers, level or COMPRESSION_LEVELS['bz2'], sumtype)
+
+    return compressFile(fn, result_compressed, compression, level, sumtype)
+
 def uncompressDB(from_file, to_file):
   if os.path.exists(from_file):
-    orig = BZ2File(from_file)
+    orig = open(from_file, 'rb')
     dest = open(to_file, 'wb')
-    try: 
-      shutil.copyfileobj(orig, dest)
+    try:
+      # the file may consist of multiple concatenated streams
+      d = decompressor(from_file)
+      while True:
+        data = orig.read(2**20)
+        if not data:
+          break
+
+        while data:
+          try:
+            dest.write(d.decompress(data))
+          except EOFError:
+            # the previous stream ended right at the end of the last read
+            d = decompressor(from_file)
+            continue
+
+          data = getattr(d, 'unused_data', '')
+          if data:
+            d = decompressor(from_file)
     finally:
       dest.close()
       orig.close()
   else:
     print "DB skipped: File not found " + from_file
 
+def locateDB(repodata_dir, ftype):
+  """Returns the path of the compressed database of the given type published
+     in repodata_dir, as referenced by its repomd.xml, whatever the codec it
+     was compressed with"""
+  repodata_dir = os.path.normpath(repodata_dir)
+  repomd_file = os.path.join(repodata_dir, 'repomd.xml')
+  if os.path.exists(repomd_file):
+    try:
+      data = RepoMD('repoid', repomd_file).getData('%s_db' % ftype)
+      return os.path.join(os.path.dirname(repodata_dir), data.location[1])
+    except (RepoMDError, KeyError), e:
+      pass
+
+  for suffix in COMPRESSION_SUFFIXES.values():
+    filename = os.path.join(repodata_dir, '%s.sqlite.%s' % (ftype, suffix))
+    if os.path.exists(filename):
+      return filename
+
+  # reported missing by uncompressDB
+  return os.path.join(repodata_dir, '%s.sqlite.bz2' % ftype)
+
+# metadata files written by updaterepod, optionally prefixed with their checksum
+METADATA_FILENAME = re.compile('^([0-9a-f]+-)?(primary|filelists|other)\.(sqlite\.(%s)|xml\.gz)$' % "|".join(COMPRESSION_SUFFIXES.values()))
+
+def linkOrCopy(source, dest):
+  try:
+    os.link(source, dest)
+  except OSError:
+    shutil.copy2(source, dest)
+
+def referencedFiles(repomd_file, finaldir = 'repodata'):
+  """Returns the names of the files of finaldir referenced by repomd_file"""
+  if not os.path.exists(repomd_file):
+    return set()
+
+  repomd = RepoMD('repoid', repomd_file)
+  names = set()
+  for ftype in repomd.fileTypes():
+    location = os.path.normpath(repomd.getData(ftype).location[1])
+    if os.path.dirname(location) == os.path.normpath(finaldir):
+      names.add(os.path.basename(location))
+  return names
+
 def uncompressDBs(from_dir, to_dir):
-  uncompressDB(os.path.join(from_dir, 'primary.sqlite.bz2'), os.path.join(to_dir, 'primary.sqlite'))
-  uncompressDB(os.path.join(from_dir, 'other.sqlite.bz2'), os.path.join(to_dir, 'other.sqlite'))
-  uncompressDB(os.path.join(from_dir, 'filelists.sqlite.bz2'), os.path.join(to_dir, 'filelists.sqlite'))
+  with metrics.timer('updaterepod_phase_seconds', phase='uncompress'):
+    for ftype in ('primary', 'other', 'filelists'):
+      uncompressDB(locateDB(from_dir, ftype), os.path.join(to_dir, '%s.sqlite' % ftype))
+
+def scanRpms(directory):
+  """Walks directory, yielding the path (relative to directory) and the stat
+     information of every package"""
+  if scandir is not None:
+    for package in scanDirectory(directory, ''):
+      yield package
+    return
+
+  if not directory.endswith('/'):
+    directory = directory + '/'
+
+  dirLength = len(directory)
+  for root, dirnames, files in os.walk(directory):
+    relpath = root[dirLength:]
+    for name in files:
+      if name.endswith('.rpm'):
+        try:
+          yield (os.path.join(relpath, name), os.stat(os.path.join(root, name)))
+        except OSError:
+          # removed in the meantime
+          pass
+
+def scanDirectory(directory, relpath):
+  """scanRpms using scandir, which only needs the type of the entries
+     returned along with their name to tell directories apart"""
+  try:
+    entries = list(scandir(os.path.join(directory, relpath)))
+  except OSError:
+    # removed in the meantime
+    return
+
+  for entry in entries:
+    if entry.is_dir(follow_symlinks=False):
+      for package in scanDirectory(directory, os.path.join(relpath, entry.name)):
+        yield package
+    elif entry.name.endswith('.rpm'):
+      try:
+        yield (os.path.join(relpath, entry.name), entry.stat())
+      except OSError:
+        pass
+
+def sortedRpms(directory, relpath = ''):
+  """Yields the path (relative to directory) of every package, sorted the
+     way SQLite sorts location_href (bytewise), only listing one directory
+     at a time"""
+  path = os.path.join(directory, relpath)
+  try:
+    if scandir is not None:
+      entries = [(entry.name, entry.is_dir(follow_symlinks=False)) for entry in scandir(path)]
+    else:
+      entries = [(name, os.path.isdir(os.path.join(path, name)) and not os.path.islink(os.path.join(path, name))) for name in os.listdir(path)]
+  except OSError:
+    # removed in the meantime
+    return
+
+  # the packages of a subdirectory sort as its name followed by a slash
+  keys = []
+  for (name, isdir) in entries:
+    if isdir:
+      keys.append((name + '/', name, True))
+    elif name.endswith('.rpm'):
+      keys.append((name, name, False))
+  keys.sort()
+
+  for (key, name, isdir) in keys:
+    if isdir:
+      for package in sortedRpms(directory, os.path.join(relpath, name)):
+        yield package
+    else:
+      yield os.path.join(relpath, name)
+
+class StatIndex(object):
+  """Persisted index of the packages of a repository, associating the path of
+     each package to the size, mtime, inode and ctime of the file it was read
+     from and to its pkgKey.
+
+     Entries seeded from existing metadata have no inode nor ctime. The index
+     is only trusted once it has been seeded (user_version = 1)."""
+
+  def __init__(self, filename):
+    self.cx = sqlite.Connection(filename, check_same_thread=False, timeout=60)
+    self.cx.text_factory = str
+    executeSQL(self.cx, "CREATE TABLE IF NOT EXISTS files (href TEXT PRIMARY KEY, size INTEGER, mtime REAL, inode INTEGER, ctime REAL, pkgKey INTEGER);")
+    # indexes written before the ctime was recorded
+    if 'ctime' not in [column[1] for column in executeSQL(self.cx, "PRAGMA table_info(files);")]:
+      executeSQL(self.cx, "ALTER TABLE files ADD COLUMN ctime REAL;")
+    self.cx.commit()
+
+  def isSeeded(self):
+    return executeSQL(self.cx, "PRAGMA user_version;").fetchone()[0] == 1
+
+  def seed(self, rows):
+    """Seeds the index from (href, size, mtime, pkgKey) rows, without
+       overriding entries already present"""
+    self.cx.executemany("INSERT OR IGNORE INTO files (href, size, mtime, inode, pkgKey) VALUES (?, ?, ?, NULL, ?);", rows)
+    executeSQL(self.cx, "PRAGMA user_version = 1;")
+    self.cx.commit()
+
+  def entries(self):
+    index = {}
+    for (href, size, mtime, inode, ctime) in executeSQL(self.cx, "SELECT href, size, mtime, inode, ctime FROM files;"):
+      index[href] = (size, mtime, inode, ctime)
+    return index
+
+  def update(self, href, st, pkgKey):
+    executeSQL(self.cx, "INSERT OR REPLACE INTO files (href, size, mtime, inode, ctime, pkgKey) VALUES (?, ?, ?, ?, ?, ?);",
+               (href, st.st_size, st.st_mtime, st.st_ino, st.st_ctime, pkgKey))
+
+  def remove(self, href):
+    executeSQL(self.cx, "DELETE FROM files WHERE href = ?;", (href, ))
+
+  def commit(self):
+    self.cx.commit()
+
+  def rollback(self):
+    self.cx.rollback()
+
+  def close(self):
+    self.cx.close()
+
+class PackageCache(object):
+  """Persisted cache of the database rows of the packages read so far,
+     keyed by pkgId, along with the identity (device, inode, size, mtime and
+     ctime) of the files they were read from. Holds at most max_packages packages,
+     dropping the least recently used ones first.
+
+     Shared by all the repositories, so that a package hardlinked or copied
+     into several of them is only read once. The rows do not depend on the
+     repository, the location of the package being set when inserting them."""
+
+  def __init__(self, filename, max_packages):
+    self.max_packages = max_packages
+    # the connection is used by all the workers
+    self.lock = threading.Lock()
+    self.cx = sqlite.Connection(filename, check_same_thread=False, timeout=60)
+    self.cx.text_factory = str
+    executeSQL(self.cx, "CREATE TABLE IF NOT EXISTS packages (pkgId TEXT PRIMARY KEY, rows BLOB, last_used INTEGER);")
+    # identities recorded before the ctime was part of them are dropped
+    if 'ctime' not in [column[1] for column in executeSQL(self.cx, "PRAGMA table_info(files);")]:
+      executeSQL(self.cx, "DROP TABLE IF EXISTS files;")
+    executeSQL(self.cx, "CREATE TABLE IF NOT EXISTS files (dev INTEGER, inode INTEGER, size INTEGER, mtime REAL, ctime REAL, pkgId TEXT, PRIMARY KEY (dev, inode, size, mtime, ctime));")
+    executeSQL(self.cx, "CREATE INDEX IF NOT EXISTS lastused ON packages (last_used);")
+    self.cx.commit()
+
+  def lookupFile(self, identity):
+    with self.lock:
+      result = executeSQL(self.cx, "SELECT pkgId FROM files WHERE dev = ? AND inode = ? AND size = ? AND mtime = ? AND ctime = ?;", identity).fetchall()
+    if len(result) > 0:
+      return result[0][0]
+    return None
+
+  def addFile(self, identity, pkgId):
+    with self.lock:
+      executeSQL(self.cx, "INSERT OR REPLACE INTO files (dev, inode, size, mtime, ctime, pkgId) VALUES (?, ?, ?, ?, ?, ?);", identity + (pkgId, ))
+
+  def lookupPackage(self, pkgId):
+    with self.lock:
+      result = executeSQL(self.cx, "SELECT rows FROM packages WHERE pkgId = ?;", (pkgId, )).fetchall()
+      if len(result) == 0:
+        return None
+
+      executeSQL(self.cx, "UPDATE packages SET last_used = ? WHERE pkgId = ?;", (int(time.time()), pkgId))
+    return cPickle.loads(zlib.decompress(result[0][0]))
+
+  def addPackage(self, pkgId, rows):
+    data = sqlite.Binary(zlib.compress(cPickle.dumps(rows, 2)))
+    with self.lock:
+      executeSQL(self.cx, "INSERT OR REPLACE INTO packages (pkgId, rows, last_used) VALUES (?, ?, ?);", (pkgId, data, int(time.time())))
+
+  def prune(self):
+    count = executeSQL(self.cx, "SELECT COUNT(*) FROM packages;").fetchone()[0]
+    if count > self.max_packages:
+      executeSQL(self.cx, "DELETE FROM packages WHERE pkgId IN (SELECT pkgId FROM packages ORDER BY last_used LIMIT ?);", (count - self.max_packages, ))
+      executeSQL(self.cx, "DELETE FROM files WHERE pkgId NOT IN (SELECT pkgId FROM packages);")
+
+  def commit(self):
+    with self.lock:
+      self.prune()
+      self.cx.commit()
+
+  def close(self):
+    with self.lock:
+      self.cx.close()
+
+class PackageIndex(object):
+  """In-memory index of the packages of a repository, giving the pkgKey,
+     pkgId, size and mtime of the package found at each location. Loaded once
+     from primary.sqlite and kept up to date as packages are added, removed
+     and moved.
+
+     Entries are stored in parallel arrays, addressed by slot, with the pkgIds
+     as raw digests. Locations are split into a directory, shared by all the
+     packages it contains, and a file name, so that an entry costs less than
+     two hundred bytes."""
+
+  def __init__(self):
+    # directory -> {file name: slot}
+    self.dirs = {}
+    self.pkgKeys = array.array('l')
+    self.sizes = array.array('l')
+    self.mtimes = array.array('l')
+    # digest_size bytes per slot
+    self.pkgIds = bytearray()
+    self.digest_size = None
+    # slot -> pkgId, for the pkgIds which are not digests of digest_size bytes
+    self.odd_pkgIds = {}
+    # slots of the removed entries, to be reused
+    self.free = []
+    self.count = 0
+    self.nextPkgKey = 1
+
+  @classmethod
+  def load(cls, md_sqlite):
+    index = cls()
+    for (pkgKey, pkgId, href, size, mtime) in executeSQL(md_sqlite.pri_cx, "SELECT pkgKey, pkgId, location_href, size_package, time_file FROM packages;"):
+      index.add(href, pkgKey, pkgId, size or 0, mtime or 0)
+    return index
+
+  def __len__(self):
+    return self.count
+
+  def __contains__(self, href):
+    return self.slot(href) is not None
+
+  def __iter__(self):
+    for (dirname, files) in self.dirs.items():
+      for filename in files:
+        yield os.path.join(dirname, filename)
+
+  def slot(self, href):
+    (dirname, filename) = os.path.split(href)
+    files = self.dirs.get(dirname)
+    if files is None:
+      return None
+    return files.get(filename)
+
+  def pkgKey(self, href):
+    slot = self.slot(href)
+    if slot is None:
+      return None
+    return self.pkgKeys[slot]
+
+  def pkgId(self, href):
+    slot = self.slot(href)
+    if slot is None:
+      return None
+    if slot in self.odd_pkgIds:
+      return self.odd_pkgIds[slot]
+    return binascii.hexlify(self.pkgIds[slot * self.digest_size:(slot + 1) * self.digest_size])
+
+  def packageKeys(self, hrefs = None):
+    """Returns the pkgKey of every package, or only of the ones located at
+       hrefs, keyed by location, like AppendingMetaDataSqlite.getPackageIndex"""
+    if hrefs is None:
+      hrefs = self
+    keys = {}
+    for href in hrefs:
+      pkgKey = self.pkgKey(href)
+      if pkgKey is not None:
+        keys[href] = pkgKey
+    return keys
+
+  def add(self, href, pkgKey, pkgId, size, mtime):
+    (dirname, filename) = os.path.split(href)
+    files = self.dirs.setdefault(dirname, {})
+    slot = files.get(filename)
+    if slot is None:
+      if len(self.free) > 0:
+        slot = self.free.pop()
+      else:
+        slot = len(self.pkgKeys)
+        self.pkgKeys.append(0)
+        self.sizes.append(0)
+        self.mtimes.append(0)
+      files[filename] = slot
+      self.count += 1
+
+    self.pkgKeys[slot] = pkgKey
+    self.sizes[slot] = size
+    self.mtimes[slot] = mtime
+
+    if self.digest_size is None and len(pkgId) % 2 == 0:
+      self.digest_size = len(pkgId) / 2
+    if len(self.pkgIds) < (slot + 1) * (self.digest_size or 0):
+      self.pkgIds.extend('\0' * ((slot + 1) * self.digest_size - len(self.pkgIds)))
+    self.odd_pkgIds.pop(slot, None)
+    try:
+      if len(pkgId) != 2 * self.digest_size:
+        raise TypeError()
+      self.pkgIds[slot * self.digest_size:(slot + 1) * self.digest_size] = binascii.unhexlify(pkgId)
+    except TypeError:
+      self.odd_pkgIds[slot] = pkgId
+
+    self.nextPkgKey = max(self.nextPkgKey, pkgKey + 1)
+
+  def remove(self, href):
+    (dirname, filename) = os.path.split(href)
+    files = self.dirs.get(dirname)
+    if files is None or filename not in files:
+      return
+
+    slot = files.pop(filename)
+    if len(files) == 0:
+      del(self.dirs[dirname])
+    self.odd_pkgIds.pop(slot, None)
+    self.free.append(slot)
+    self.count -= 1
+
+  def rename(self, src, dest):
+    slot = self.slot(src)
+    if slot is None:
+      return
+
+    pkgId = self.pkgId(src)
+    self.remove(src)
+    self.add(dest, self.pkgKeys[slot], pkgId, self.sizes[slot], self.mtimes[slot])
+
+def statChanged(entry, st):
+  (size, mtime, inode, ctime) = entry
+  if size != st.st_size:
+    return True
+  if inode is None or ctime is None:
+    # seeded from the metadata, which only has the mtime to the second
+    return int(mtime) != int(st.st_mtime)
+  # a file rewritten in place keeps its inode, and cp or rsync can restore
+  # its size and mtime but not its ctime
+  return inode != st.st_ino or mtime != st.st_mtime or ctime != st.st_ctime
+
+def xmlText(value, attrib = False):
+  """Escapes a value of the databases for the XML metadata"""
+  if value is None:
+    return ''
+  if not isinstance(value, basestring):
+    value = str(value)
+  return misc.to_xml(value, attrib)
+
+def xmlAttr(value):
+  return xmlText(value, attrib=True)
+
+def gzipMember(data):
+  """Compresses data as a gzip member. Concatenated members make up a valid
+     gzip file."""
+  c = compressor('gzip')
+  return c.compress(data) + c.flush()
+
+class XmlFragments(object):
+  """Persisted XML fragments (primary, filelists and other) of the packages
+     of a repository, each compressed as a gzip member, so that the XML
+     metadata is written by concatenating them instead of being generated
+     and compressed again from scratch.
+
+     Fragments are generated from the SQLite databases and stored by
+     pkgKey, along with the pkgId, location and mtime of the package they
+     were generated for, so that they are generated again whenever the
+     package changed."""
+
+  TYPES = ('primary', 'filelists', 'other')
+
+  # document header and footer of each type
+  DOCUMENTS = {
+    'primary': ('<?xml version="1.0" encoding="UTF-8"?>\n<metadata xmlns="http://linux.duke.edu/metadata/common" xmlns:rpm="http://linux.duke.edu/metadata/rpm" packages="%d">\n', '</metadata>\n'),
+    'filelists': ('<?xml version="1.0" encoding="UTF-8"?>\n<filelists xmlns="http://linux.duke.edu/metadata/filelists" packages="%d">\n', '</filelists>\n'),
+    'other': ('<?xml version="1.0" encoding="UTF-8"?>\n<otherdata xmlns="http://linux.duke.edu/metadata/other" packages="%d">\n', '</otherdata>\n'),
+  }
+
+  # file types of the filelist table
+  FILE_TYPES = {'d': 'dir', 'g': 'ghost'}
+
+  def __init__(self, filename):
+    self.logger = logging.getLogger("app.XmlFragments")
+    self.cx = sqlite.Connection(filename, check_same_thread=False, timeout=60)
+    self.cx.text_factory = str
+    executeSQL(self.cx, "CREATE TABLE IF NOT EXISTS fragments (pkgKey INTEGER PRIMARY KEY, pkgId TEXT, href TEXT, mtime INTEGER, primary_xml BLOB, filelists_xml BLOB, other_xml BLOB);")
+    self.cx.commit()
+
+  def refresh(self, md_sqlite):
+    """Generates the fragments of the packages added, moved or replaced
+       since the last call and drops the ones of the packages removed.
+       Returns the number of packages."""
+    known = {}
+    for (pkgKey, pkgId, href, mtime) in executeSQL(self.cx, "SELECT pkgKey, pkgId, href, mtime FROM fragments;"):
+      known[pkgKey] = (pkgId, href, mtime)
+
+    packages = executeSQL(md_sqlite.pri_cx, "SELECT pkgKey, pkgId, location_href, time_file FROM packages;").fetchall()
+    generated = 0
+    for (pkgKey, pkgId, href, mtime) in packages:
+      pkgId = str(pkgId)
+      if isinstance(href, unicode):
+        href = href.encode('utf-8')
+      if known.pop(pkgKey, None) == (pkgId, href, mtime):
+        continue
+
+      fragments = [buffer(gzipMember(fragment)) for fragment in self.generate(md_sqlite, pkgKey)]
+      executeSQL(self.cx, "INSERT OR REPLACE INTO fragments VALUES (?, ?, ?, ?, ?, ?, ?);", [pkgKey, pkgId, href, mtime] + fragments)
+      generated += 1
+
+    removed = known.keys()
+    for i in range(0, len(removed), AppendingMetaDataSqlite.MAX_VARIABLES):
+      chunk = removed[i:i + AppendingMetaDataSqlite.MAX_VARIABLES]
+      executeSQL(self.cx, "DELETE FROM fragments WHERE pkgKey IN (%s);" % ", ".join(["?"] * len(chunk)), chunk)
+    self.cx.commit()
+
+    self.logger.debug("Generated the XML of %d packages, dropped %d" % (generated, len(removed)))
+    return len(packages)
+
+  def write(self, ftype, count, filename, sumtype):
+    """Writes the gzipped XML document of a type, returning the checksum and
+       size of the uncompressed document and of the file"""
+    (header, footer) = self.DOCUMENTS[ftype]
+    opened = misc.Checksums([sumtype])
+
+    fo = ChecksumWriter(open(filename, 'wb'), sumtype)
+    try:
+      for (member, ) in itertools.chain([(gzipMember(header % count), )],
+                                        executeSQL(self.cx, "SELECT %s_xml FROM fragments ORDER BY pkgKey;" % ftype),
+                                        [(gzipMember(footer), )]):
+        member = str(member)
+        fo.write(member)
+        # decompressing is much cheaper than compressing the whole document again
+        opened.update(zlib.decompress(member, 16 + zlib.MAX_WBITS))
+    finally:
+      fo.fo.close()
+
+    return (opened.hexdigest(sumtype), len(opened)) + fo.result()
+
+  def generate(self, md_sqlite, pkgKey):
+    """Returns the primary, filelists and other XML of a package, as found in
+       the databases"""
+    cursor = executeSQL(md_sqlite.pri_cx, "SELECT * FROM packages WHERE pkgKey = ?;", (pkgKey, ))
+    pkg = dict(zip([column[0] for column in cursor.description], cursor.fetchone()))
+
+    version = '<version epoch="%s" ver="%s" rel="%s"/>' % (xmlAttr(pkg['epoch']), xmlAttr(pkg['version']), xmlAttr(pkg['release']))
+    if pkg['location_base']:
+      location = '<location xml:base="%s" href="%s"/>' % (xmlAttr(pkg['location_base']), xmlAttr(pkg['location_href']))
+    else:
+      location = '<location href="%s"/>' % xmlAttr(pkg['location_href'])
+
+    primary = [
+      '<package type="rpm">',
+      '  <name>%s</name>' % xmlText(pkg['name']),
+      '  <arch>%s</arch>' % xmlText(pkg['arch']),
+      '  %s' % version,
+      '  <checksum type="%s" pkgid="YES">%s</checksum>' % (xmlAttr(pkg['checksum_type']), xmlText(pkg['pkgId'])),
+      '  <summary>%s</summary>' % xmlText(pkg['summary']),
+      '  <description>%s</description>' % xmlText(pkg['description']),
+      '  <packager>%s</packager>' % xmlText(pkg['rpm_packager']),
+      '  <url>%s</url>' % xmlText(pkg['url']),
+      '  <time file="%s" build="%s"/>' % (xmlAttr(pkg['time_file']), xmlAttr(pkg['time_build'])),
+      '  <size package="%s" installed="%s" archive="%s"/>' % (xmlAttr(pkg['size_package']), xmlAttr(pkg['size_installed']), xmlAttr(pkg['size_archive'])),
+      '  %s' % location,
+      '  <format>',
+      '    <rpm:license>%s</rpm:license>' % xmlText(pkg['rpm_license']),
+      '    <rpm:vendor>%s</rpm:vendor>' % xmlText(pkg['rpm_vendor']),
+      '    <rpm:group>%s</rpm:group>' % xmlText(pkg['rpm_group']),
+      '    <rpm:buildhost>%s</rpm:buildhost>' % xmlText(pkg['rpm_buildhost']),
+      '    <rpm:sourcerpm>%s</rpm:sourcerpm>' % xmlText(pkg['rpm_sourcerpm']),
+      '    <rpm:header-range start="%s" end="%s"/>' % (xmlAttr(pkg['rpm_header_start']), xmlAttr(pkg['rpm_header_end'])),
+    ]
+    for table in ('provides', 'requires', 'conflicts', 'obsoletes'):
+      primary.extend(self.dependencies(md_sqlite.pri_cx, table, pkgKey))
+    for (name, ftype) in executeSQL(md_sqlite.pri_cx, "SELECT name, type FROM files WHERE pkgKey = ? ORDER BY rowid;", (pkgKey, )):
+      if ftype in ('dir', 'ghost'):
+        primary.append('    <file type="%s">%s</file>' % (ftype, xmlText(name)))
+      else:
+        primary.append('    <file>%s</file>' % xmlText(name))
+    primary.extend(['  </format>', '</package>', ''])
+
+    package = '<package pkgid="%s" name="%s" arch="%s">' % (xmlAttr(pkg['pkgId']), xmlAttr(pkg['name']), xmlAttr(pkg['arch']))
+
+    filelists = [package, '  %s' % version]
+    for (dirname, filenames, filetypes) in executeSQL(md_sqlite.file_cx, "SELECT dirname, filenames, filetypes FROM filelist WHERE pkgKey = ? ORDER BY rowid;", (pkgKey, )):
+      for (filename, filetype) in zip(filenames.split('/'), filetypes):
+        path = xmlText(os.path.join(dirname, filename))
+        if filetype in self.FILE_TYPES:
+          filelists.append('  <file type="%s">%s</file>' % (self.FILE_TYPES[filetype], path))
+        else:
+          filelists.append('  <file>%s</file>' % path)
+    filelists.extend(['</package>', ''])
+
+    other = [package, '  %s' % version]
+    for (author, date, text) in executeSQL(md_sqlite.other_cx, "SELECT author, date, changelog FROM changelog WHERE pkgKey = ? ORDER BY rowid;", (pkgKey, )):
+      other.append('  <changelog author="%s" date="%s">%s</changelog>' % (xmlAttr(author), xmlAttr(date), xmlText(text)))
+    other.extend(['</package>', ''])
+
+    return ("\n".join(primary), "\n".join(filelists), "\n".join(other))
+
+  def dependencies(self, cx, table, pkgKey):
+    columns = "name, flags, epoch, version, release"
+    if table == 'requires':
+      columns += ", pre"
+    rows = executeSQL(cx, "SELECT %s FROM %s WHERE pkgKey = ? ORDER BY rowid;" % (columns, table), (pkgKey, )).fetchall()
+    if len(rows) == 0:
+      return []
+
+    lines = ['    <rpm:%s>' % table]
+    for row in rows:
+      entry = '      <rpm:entry name="%s"' % xmlAttr(row[0])
+      if row[1]:
+        entry += ' flags="%s"' % xmlAttr(row[1])
+        for (attribute, value) in zip(('epoch', 'ver', 'rel'), row[2:5]):
+          if value is not None:
+            entry += ' %s="%s"' % (attribute, xmlAttr(value))
+      if table == 'requires' and row[5] in (True, 1, '1', 'TRUE'):
+        entry += ' pre="1"'
+      lines.append(entry + '/>')
+    lines.append('    </rpm:%s>' % table)
+
+    return lines
+
+  def close(self):
+    self.cx.close()
+
+def journalName(directory):
+  """Name of the journal of a repository under journal_dir"""
+  return hashlib.sha1(os.path.normpath(directory)).hexdigest()
+
+def writeFileAtomically(filename, data):
+  tmp = "%s.tmp" % filename
+  fo = open(tmp, 'w')
+  try:
+    fo.write(data)
+    fo.flush()
+    os.fsync(fo.fileno())
+  finally:
+    fo.close()
+  os.rename(tmp, filename)
+
+class Journal(object):
+  """Append-only journal of the batches of changes applied to a repository,
+     each record being written (and synced) before the batch is applied.
+
+     Records are JSON lines {"seq": n, "time": t, "added": [...],
+     "removed": [...], "moved": [[source, dest], ...]}, the sequence numbers
+     increasing by one. They are stored in segments named after the sequence
+     number of their first record, a new segment being started once the
+     current one exceeds SEGMENT_SIZE. The published file holds the sequence
+     number up to which all the records have been published, a record whose
+     batch failed holding it back until it is replayed. The segments all of
+     whose records have been published are removed once older than the
+     retention given to compact(), to leave followers the time to read them."""
+
+  SEGMENT_SIZE = 4 * 2**20
+  SEGMENT_SUFFIX = '.journal'
+
+  def __init__(self, directory):
+    self.logger = logging.getLogger("app.Journal")
+    self.directory = directory
+    self.published_file = os.path.join(directory, 'published')
+    self.lock = threading.Lock()
+    # segment being appended to
+    self.segment = None
+    self.seq = None
+    # sequence numbers of the records written or replayed, not published yet
+    self.unpublished = set()
+
+  def create(self, repo):
+    """Sets up the journal for writing, recording the repository it is about"""
+    if not os.path.isdir(self.directory):
+      os.makedirs(self.directory)
+    if not os.path.exists(os.path.join(self.directory, 'repo')):
+      writeFileAtomically(os.path.join(self.directory, 'repo'), repo + "\n")
+
+    segments = self.segments()
+    if len(segments) > 0:
+      self.truncateTornRecord(segments[-1][1])
+    self.seq = max(self.lastSeq() or 0, self.published())
+
+  def truncateTornRecord(self, path):
+    """Cuts off the last record of a segment if it was only partly written"""
+    fo = open(path, 'r+')
+    try:
+      offset = 0
+      for line in fo:
+        try:
+          json.loads(line)
+        except ValueError:
+          break
+        if not line.endswith("\n"):
+          break
+        offset += len(line)
+      else:
+        return
+
+      self.logger.warning("Truncating the torn record at the end of %s" % path)
+      fo.truncate(offset)
+    finally:
+      fo.close()
+
+  def segments(self):
+    """Returns the (first sequence number, path) of the segments, oldest first"""
+    try:
+      names = os.listdir(self.directory)
+    except OSError:
+      return []
+
+    return sorted([(int(name[:-len(self.SEGMENT_SUFFIX)]), os.path.join(self.directory, name))
+                   for name in names if name.endswith(self.SEGMENT_SUFFIX) and name[:-len(self.SEGMENT_SUFFIX)].isdigit()])
+
+  def firstSeq(self):
+    segments = self.segments()
+    if len(segments) == 0:
+      return None
+    return segments[0][0]
+
+  def lastSeq(self):
+    last = None
+    segments = self.segments()
+    if len(segments) > 0:
+      for record in self.readSegment(segments[-1][1]):
+        last = record['seq']
+    return last
+
+  def readSegment(self, path):
+    try:
+      fo = open(path, 'r')
+    except IOError:
+      # compacted in the meantime
+      return
+
+    try:
+      for line in fo:
+        try:
+          record = json.loads(line)
+        except ValueError:
+          # the last record may have been cut short by a crash
+          return
+        # locations are byte strings everywhere else
+        record['added'] = [href.encode('utf-8') for href in record['added']]
+        record['removed'] = [href.encode('utf-8') for href in record['removed']]
+        record['moved'] = [(source.encode('utf-8'), dest.encode('utf-8')) for (source, dest) in record['moved']]
+        yield record
+    finally:
+      fo.close()
+
+  def records(self, after = 0):
+    """Yields the records whose sequence number is greater than after"""
+    segments = self.segments()
+    for (i, (first, path)) in enumerate(segments):
+      if i + 1 < len(segments) and segments[i + 1][0] <= after + 1:
+        continue
+      for record in self.readSegment(path):
+        if record['seq'] > after:
+          yield record
+
+  def replay(self):
+    """Returns the records not published, to be applied again"""
+    with self.lock:
+      records = list(self.records(self.published()))
+      self.unpublished.update([record['seq'] for record in records])
+    return records
+
+  def append(self, added, removed, moved):
+    """Writes a record, returning its sequence number. The segment is only
+       open while writing, not to hold a file descriptor per repository."""
+    with self.lock:
+      if self.segment is None or os.path.getsize(self.segment) >= self.SEGMENT_SIZE:
+        segments = self.segments()
+        if len(segments) > 0 and os.path.getsize(segments[-1][1]) < self.SEGMENT_SIZE:
+          self.segment = segments[-1][1]
+        else:
+          self.segment = os.path.join(self.directory, "%020d%s" % (self.seq + 1, self.SEGMENT_SUFFIX))
+
+      record = {'seq': self.seq + 1, 'time': time.time(), 'added': list(added), 'removed': list(removed), 'moved': list(moved)}
+      fo = open(self.segment, 'a')
+      try:
+        fo.write(json.dumps(record) + "\n")
+        fo.flush()
+        os.fsync(fo.fileno())
+      finally:
+        fo.close()
+
+      self.seq += 1
+      self.unpublished.add(self.seq)
+      return self.seq
+
+  def published(self):
+    try:
+      fo = open(self.published_file, 'r')
+      try:
+        return int(fo.read().strip())
+      finally:
+        fo.close()
+    except (IOError, OSError, ValueError):
+      return 0
+
+  def markPublished(self, seq):
+    """Records that the batch of a record has been published, the published
+       file only moving up to the record before the first one still pending"""
+    with self.lock:
+      self.unpublished.discard(seq)
+      if len(self.unpublished) > 0:
+        seq = min(self.unpublished) - 1
+      else:
+        seq = self.seq
+      if seq > self.published():
+        writeFileAtomically(self.published_file, "%d\n" % seq)
+
+  def compact(self, retention):
+    """Removes the segments older than retention seconds whose records have
+       all been published, the current one being kept"""
+    published = self.published()
+    now = time.time()
+    with self.lock:
+      segments = self.segments()
+      for (i, (first, path)) in enumerate(segments[:-1]):
+        # the last record of a segment precedes the first one of the next
+        if segments[i + 1][0] - 1 > published:
+          break
+        try:
+          if now - os.stat(path).st_mtime > retention:
+            os.unlink(path)
+            self.logger.debug("Removed journal segment %s" % path)
+        except OSError:
+          pass
+
+class RepoState(object):
+  """Long-lived state of a watched repository, kept across metadata updates.
+
+     The SQLite databases are extracted once into a private working copy,
+     which is kept open and updated in place. They are only extracted again
+     from repodata/ when the published metadata has been changed by someone
+     else (e.g. a manual createrepo run)."""
+
+  def __init__(self, directory, state_dir, hot = False, cache = None):
+    self.logger = logging.getLogger("app.RepoState")
+    self.directory = directory
+    self.hot = hot
+    self.state_dir = os.path.join(state_dir, hashlib.sha1(directory).hexdigest())
+    self.work_dir = os.path.join(self.state_dir, 'work')
+    self.published_file = os.path.join(self.state_dir, 'published')
+    self.index_file = os.path.join(self.state_dir, 'index.sqlite')
+    self.xml_file = os.path.join(self.state_dir, 'xml.sqlite')
+    # exists while the published filelists and other metadata lag behind
+    self.deferred_file = os.path.join(self.state_dir, 'deferred')
+    # sequence number of the last record of the journal followed applied
+    self.journal_position_file = os.path.join(self.state_dir, 'journal_position')
+    # packages of the records applied without them, not replicated in time
+    self.follow_pending_file = os.path.join(self.state_dir, 'follow_pending')
+    # pkgKey above all the ones handed out so far
+    self.next_pkgkey_file = os.path.join(self.state_dir, 'next_pkgkey')
+    self.next_pkgkey = None
+    self.repomd_file = os.path.join(directory, 'repodata', 'repomd.xml')
+    self.md_sqlite = None
+    self.signature = None
+    # in-memory index of the packages and the signature of the metadata it matches
+    self.packages = None
+    self.packages_signature = None
+
+    if not os.path.exists(self.state_dir):
+      os.makedirs(self.state_dir)
+    self.index = StatIndex(self.index_file)
+
+    # PackageCache shared with the other repositories, if enabled
+    self.cache = cache
+    # superseded by the shared one
+    if os.path.exists(os.path.join(self.state_dir, 'packages.sqlite')):
+      os.unlink(os.path.join(self.state_dir, 'packages.sqlite'))
+
+    # opened on first use, only needed when publishing XML metadata
+    self.xml = None
+
+  def repomdSignature(self):
+    try:
+      st = os.stat(self.repomd_file)
+    except OSError:
+      return None
+
+    return "%d %d %r" % (st.st_ino, st.st_size, st.st_mtime)
+
+  def readPublished(self):
+    try:
+      fo = open(self.published_file, 'r')
+      try:
+        return fo.read().strip()
+      finally:
+        fo.close()
+    except (IOError, OSError):
+      return None
+
+  def workFilesExist(self):
+    for db in ('primary.sqlite', 'filelists.sqlite', 'other.sqlite'):
+      if not os.path.exists(os.path.join(self.work_dir, db)):
+        return False
+    return True
+
+  def open(self):
+    """Returns the working copy of the databases, extracting it again from
+       repodata/ if the published metadata is not the one we produced"""
+    signature = self.repomdSignature()
+
+    if self.md_sqlite is not None:
+      if signature is not None and signature == self.signature:
+        return self.md_sqlite
+      self.logger.info("Metadata of %s changed externally, discarding working copy" % self.directory)
+      self.closeWorkingCopy()
+
+    if signature is None or signature != self.readPublished() or not self.workFilesExist():
+      self.logger.info("Extracting SQLite databases of %s" % self.directory)
+      if os.path.exists(self.work_dir):
+        shutil.rmtree(self.work_dir)
+      os.makedirs(self.work_dir)
+      uncompressDBs(os.path.dirname(self.repomd_file), self.work_dir)
+      self.md_sqlite = AppendingMetaDataSqlite(self.work_dir, persistent=True)
+      if self.isDeferred():
+        self.dropDeferredPackages()
+    else:
+      self.md_sqlite = AppendingMetaDataSqlite(self.work_dir, persistent=True)
+
+    self.signature = signature
+
+    return self.md_sqlite
+
+  def published(self):
+    self.signature = self.repomdSignature()
+
+    fo = open(self.published_file, 'w')
+    try:
+      fo.write(self.signature)
+    finally:
+      fo.close()
+
+  def journalPosition(self):
+    """Returns the sequence number of the last record of the journal
+       followed applied, or None if it never has been followed"""
+    try:
+      fo = open(self.journal_position_file, 'r')
+      try:
+        return int(fo.read().strip())
+      finally:
+        fo.close()
+    except (IOError, OSError, ValueError):
+      return None
+
+  def setJournalPosition(self, seq):
+    writeFileAtomically(self.journal_position_file, "%d\n" % seq)
+
+  def followPending(self):
+    """Returns the packages given up on while following, to be added once
+       they show up"""
+    try:
+      fo = open(self.follow_pending_file, 'r')
+      try:
+        return set([href.encode('utf-8') for href in json.load(fo)])
+      finally:
+        fo.close()
+    except (IOError, OSError, ValueError):
+      return set()
+
+  def setFollowPending(self, hrefs):
+    writeFileAtomically(self.follow_pending_file, json.dumps(sorted(hrefs)) + "\n")
+
+  def nextPkgKey(self):
+    if self.next_pkgkey is None:
+      try:
+        fo = open(self.next_pkgkey_file, 'r')
+        try:
+          self.next_pkgkey = int(fo.read().strip())
+        finally:
+          fo.close()
+      except (IOError, OSError, ValueError):
+        self.next_pkgkey = 1
+    return self.next_pkgkey
+
+  def setNextPkgKey(self, pkgKey):
+    if pkgKey > self.nextPkgKey():
+      writeFileAtomically(self.next_pkgkey_file, "%d\n" % pkgKey)
+      self.next_pkgkey = pkgKey
+
+  def isDeferred(self):
+    return os.path.exists(self.deferred_file)
+
+  def deferred(self, value):
+    """Records whether the filelists and other metadata published lag
+       behind the primary one"""
+    if value and not self.isDeferred():
+      open(self.deferred_file, 'w').close()
+    elif not value and self.isDeferred():
+      os.unlink(self.deferred_file)
+
+  def dropDeferredPackages(self):
+    """Removes the packages not found in all of the databases extracted
+       while the filelists and other ones lagged behind, dropping them from
+       the index as well so that the next reconciliation adds them again"""
+    keys = {}
+    for (db, cx) in self.md_sqlite.connections():
+      keys[db] = set(executeSQL(cx, "SELECT pkgKey, pkgId FROM packages;").fetchall())
+
+    stale = set([pkgKey for (pkgKey, pkgId) in (keys['primary'] ^ keys['filelists']) | (keys['primary'] ^ keys['other'])])
+    hrefs = executeSQL(self.md_sqlite.pri_cx, "SELECT location_href, pkgKey FROM packages;").fetchall()
+    for (href, pkgKey) in hrefs:
+      if pkgKey in stale:
+        self.index.remove(href)
+
+    self.logger.warning("Dropped %d packages of %s missing from the deferred metadata, until the next reconciliation" % (len(stale), self.directory))
+    self.md_sqlite.removePkgKeys(list(stale))
+    self.md_sqlite.commit()
+    self.index.commit()
+    self.packages = None
+    self.deferred(False)
+
+  def packageIndex(self, md_sqlite):
+    """Returns the in-memory index of the packages of md_sqlite, loading it
+       again if the metadata has been published by someone else since"""
+    signature = self.repomdSignature()
+    if self.packages is None or signature != self.packages_signature:
+      start = time.time()
+      self.packages = PackageIndex.load(md_sqlite)
+      # the keys of removed packages are never handed out again, the
+      # filelists and other metadata published may still use them
+      # (tiered_publish)
+      self.packages.nextPkgKey = max(self.packages.nextPkgKey, md_sqlite.highestPkgKey() + 1, self.nextPkgKey())
+      self.packages_signature = signature
+      self.logger.info("Loaded index of the %d packages of %s in %.2fs" % (len(self.packages), self.directory, time.time() - start))
+
+    return self.packages
+
+  def indexed(self):
+    """The package index matches the metadata as published now"""
+    if self.packages is not None:
+      self.packages_signature = self.repomdSignature()
+
+  def invalidate(self):
+    self.closeWorkingCopy()
+    self.index.rollback()
+    self.packages = None
+    if os.path.exists(self.published_file):
+      os.unlink(self.published_file)
+
+  def close(self):
+    self.closeWorkingCopy()
+    self.index.close()
+    if self.xml is not None:
+      self.xml.close()
+
+  def xmlFragments(self):
+    if self.xml is None:
+      self.xml = XmlFragments(self.xml_file)
+    return self.xml
+
+  def closeWorkingCopy(self):
+    if self.md_sqlite is not None:
+      self.md_sqlite.close()
+      self.md_sqlite = None
+      self.signature = None
+
+  def reconcile(self):
+    """Compares the packages found in the repository with the persisted
+       index, returning the packages to add and the ones to remove. Only
+       uses its own connection to the index, so that it can run alongside
+       metadata updates."""
+    index = StatIndex(self.index_file)
+    try:
+      if not index.isSeeded():
+        self.logger.info("Seeding package index of %s from published metadata" % self.directory)
+        index.seed(self.publishedPackages())
+
+      known = index.entries()
+    finally:
+      index.close()
+
+    added = []
+    for (href, st) in scanRpms(self.directory):
+      entry = known.pop(href, None)
+      if entry is None or statChanged(entry, st):
+        added.append(href)
+
+    return (added, known.keys())
+
+  def publishedPackages(self):
+    primary = locateDB(os.path.dirname(self.repomd_file), 'primary')
+    if not os.path.exists(primary):
+      return []
+
+    tmp_dir = tempfile.mkdtemp(dir=self.state_dir)
+    try:
+      uncompressDB(primary, os.path.join(tmp_dir, 'primary.sqlite'))
+      cx = sqlite.Connection(os.path.join(tmp_dir, 'primary.sqlite'))
+      cx.text_factory = str
+      try:
+        return executeSQL(cx, "SELECT location_href, size_package, time_file, pkgKey FROM packages;").fetchall()
+      finally:
+        cx.close()
+    finally:
+      shutil.rmtree(tmp_dir)
+
+def checksumRpm(args):
+  """Computes the checksum of a package, meant to be run on a process pool"""
+  (directory, package, sumtype) = args
+  try:
+    return (package, misc.checksum(sumtype, os.path.join(directory, package)), None)
+  except Exception, e:
+    return (package, None, str(e))
 
 def _return_primary_files(self, list_of_files=None):
   returns = {}
@@ -381,9 +2120,18 @@ CreateRepoPackage._return_primary_files = _return_primary_files
 CreateRepoPackage._return_primary_dirs = _return_primary_dirs
 
 class UpdateRepo(object):
-  def __init__(self, config):
+  # number of packages removed or added at once when synchronizing
+  SYNC_CHUNK_SIZE = 1000
+
+  def __init__(self, config, state = None):
     self.logger = logging.getLogger("app.UpdateRepo")
     self.config = config
+    self.state = state
+    self.repo = os.path.normpath(self.config.directory)
+    # whether the metadata got published, and whether the filelists and
+    # other metadata were left out of it (tiered_publish)
+    self.published = False
+    self.deferred = False
 
     if os.path.isabs(self.config.directory):
       self.config.basedir = os.path.dirname(self.config.directory)
@@ -396,6 +2144,8 @@ class UpdateRepo(object):
       self.config.directory = self.config.directory + '/'
 
     self.config.database_only = True
+    # the files of successive versions of the metadata live side by side
+    self.config.unique_md_filenames = self.config.atomic_publish
 
     if not self.config.outputdir:
       self.config.outputdir = os.path.join(self.config.basedir, self.config.relative_dir)
@@ -407,91 +2157,399 @@ class UpdateRepo(object):
     if not 'action' in kargs:
       raise(ValueError, "Must specify action to %s" % self.__class__.__name__)
 
-    self.reuseExistingMetadata()
-    self.generator = MetaDataGenerator(self.config)
-    self.generator.md_sqlite = AppendingMetaDataSqlite(self.temp_dir)
-    self.nextPkgKey = self.generator.md_sqlite.generateNewPackageNumber()
+    metrics.inc('updaterepod_updates_total', repo=self.repo)
+    with metrics.timer('updaterepod_phase_seconds', phase='execute'):
+      self.executeAction(**kargs)
 
-    packagesInDb = self.generator.md_sqlite.getPackageIndex()
-    packagesInDbKeys = set(packagesInDb.keys())
+  def executeAction(self, **kargs):
+    try:
+      if self.state is not None and self.state.hot:
+        self.executeWithState(**kargs)
+      else:
+        self.reuseExistingMetadata()
+        self.update(AppendingMetaDataSqlite(self.temp_dir), **kargs)
+    except:
+      if self.state is not None:
+        # the working copy and the package index may be half-way through the update
+        self.state.invalidate()
+      raise
+
+    if self.state is not None:
+      self.state.indexed()
+
+  def executeWithState(self, **kargs):
+    self.reuseExistingMetadata(uncompress=False)
+    self.update(self.state.open(), **kargs)
+    self.state.published()
+
+  def update(self, md_sqlite, **kargs):
+    self.generator = MetaDataGenerator(self.config)
+    self.generator.md_sqlite = md_sqlite
+    self.action = kargs['action']
+    # number of packages added or removed
+    self.changes = 0
+
+    # in-memory index of the packages, kept by the daemon across updates
+    self.packageIndex = None
+    if self.state is not None:
+      self.packageIndex = self.state.packageIndex(md_sqlite)
+      self.nextPkgKey = self.packageIndex.nextPkgKey
+    else:
+      self.nextPkgKey = md_sqlite.generateNewPackageNumber()
 
     if kargs['action'] == "remove":
-      for package in self.config.packages:
-        if package in packagesInDb:
-          pkgKey = packagesInDb[package]
-          self.generator.md_sqlite.removePkgKey(pkgKey)
-          self.logger.info("Removed %s from SQLite database" % package)
-        else:
-          self.logger.info("Package %s is already absent" % package)
+      packagesInDb = self.lookupPackages(self.config.packages)
+      self.removePackages(self.config.packages, packagesInDb)
     elif kargs['action'] == "add":
-      for package in self.config.packages:
-        remove_existing = False
-        if package in packagesInDb:
-          # FIXME: ideally, we would check if the package actually differs 
-          self.logger.info("Package %s is already present. The existing one will be removed." % package)
-          remove_existing = True
+      packagesInDb = self.lookupPackages(self.config.packages)
+      self.addPackages(self.config.packages, packagesInDb)
+    elif kargs['action'] == "update":
+      moved = kargs.get('moved', [])
+      # only the packages concerned by the events are looked up
+      hrefs = set(kargs['added']) | set(kargs['removed'])
+      for (src, dest) in moved:
+        hrefs.update((src, dest))
+      packagesInDb = self.lookupPackages(hrefs)
+
+      self.movePackages(moved, packagesInDb)
+      self.removePackages(kargs['removed'], packagesInDb)
+      self.addPackages(kargs['added'], packagesInDb)
+    elif kargs['action'] == "refresh":
+      # only publishes the deferred metadata
+      pass
+    else:
+      self.sync(kargs.get('workers', 1))
 
-        try:
-          self.addRpm(package)
-        except Exception, e:
-          self.logger.error("Error adding %s to SQLite database: %s" % (package, e))
+    md_sqlite.commit()
+    if self.state is not None:
+      self.state.setNextPkgKey(self.nextPkgKey)
+      if self.state.cache is not None:
+        self.state.cache.commit()
 
-        if remove_existing:
-          pkgKey = packagesInDb[package]
-          self.generator.md_sqlite.removePkgKey(pkgKey)
+    if self.packageIndex is not None:
+      metrics.set('updaterepod_packages', len(self.packageIndex), repo=self.repo)
     else:
-      if self.config.packages is None:
-        self.config.packages = set(self.listRpms())
+      metrics.set('updaterepod_packages', md_sqlite.countPackages(), repo=self.repo)
 
-      packagesToDelete = list(packagesInDbKeys - self.config.packages)
-      packagesToAdd = list(self.config.packages - packagesInDbKeys)
+    refresh = self.action == "refresh" and self.state is not None and self.state.isDeferred()
+    if self.changes == 0 and not refresh and os.path.exists(os.path.join(self.output_dir, self.config.repomdfile)):
+      self.logger.info("No changes to %s, metadata left untouched" % self.config.directory)
+      shutil.rmtree(self.temp_dir)
+    else:
+      self.generateMetaData()
 
-      self.logger.debug("DB Packages: %s " % packagesInDbKeys.__str__())
-      self.logger.debug("Packages: %s " % self.config.packages.__str__())
-      self.logger.debug("Delete: %s " % packagesToDelete.__str__())
-      self.logger.debug("Add: %s " % packagesToAdd.__str__())
+    # only once published, so that the packages of a failed update are
+    # picked up again by the next reconciliation
+    if self.state is not None:
+      self.state.index.commit()
 
-      for package in packagesToDelete:
-        pkgKey = packagesInDb[package]
-        try:
-          self.generator.md_sqlite.removePkgKey(pkgKey)
-          self.logger.info("Removed %s from SQLite database" % package)
-        except Exception, e:
-          self.logger.error("Error removing %s from SQLite database: %s" % (package, e))
+  def sync(self, workers = 1):
+    """Synchronizes the databases with the packages of the directory,
+       applying the changes as they are found"""
+    pool = None
+    if workers > 1:
+      self.logger.info("Adding packages using %d workers" % workers)
+      pool = multiprocessing.Pool(workers)
+
+    try:
+      for (removed, added) in self.syncChanges():
+        self.logger.debug("Delete: %s " % removed.__str__())
+        self.logger.debug("Add: %s " % added.__str__())
 
-      for package in packagesToAdd:
         try:
-          self.addRpm(package)
+          self.removePackages([href for (href, pkgKey) in removed], dict(removed))
         except Exception, e:
-          self.logger.error("Error adding %s to SQLite database: %s" % (package, e))
+          metrics.inc('updaterepod_errors_total', repo=self.repo, operation='remove')
+          self.logger.error("Error removing %d packages from SQLite database: %s" % (len(removed), e))
 
-    self.generateMetaData()
+        if pool is not None and len(added) > 1:
+          self.addRpmsInParallel(added, pool)
+        else:
+          self.addPackages(added, {})
+    finally:
+      if pool is not None:
+        pool.close()
+        pool.join()
+
+  def syncChanges(self):
+    """Merge-joins the packages of the directory (or config.packages) with
+       the ones of the databases, both walked in location order, yielding
+       the (location, pkgKey) of the packages to remove and the location of
+       the ones to add, SYNC_CHUNK_SIZE at a time"""
+    if self.config.packages is not None:
+      packages = iter(sorted(self.config.packages))
+    else:
+      packages = sortedRpms(self.config.directory)
+    packagesInDb = self.generator.md_sqlite.iterPackages()
+
+    removed = []
+    added = []
+    package = next(packages, None)
+    (href, pkgKey) = next(packagesInDb, (None, None))
+    while package is not None or href is not None:
+      if href is None or (package is not None and package < href):
+        added.append(package)
+        package = next(packages, None)
+      elif package is None or href < package:
+        removed.append((href, pkgKey))
+        (href, pkgKey) = next(packagesInDb, (None, None))
+      else:
+        package = next(packages, None)
+        (href, pkgKey) = next(packagesInDb, (None, None))
+
+      if len(removed) + len(added) >= self.SYNC_CHUNK_SIZE:
+        yield (removed, added)
+        removed = []
+        added = []
+
+    if len(removed) + len(added) > 0:
+      yield (removed, added)
+
+  def lookupPackages(self, hrefs = None):
+    """Returns the pkgKey of every package, or only of the ones located at
+       hrefs, keyed by location"""
+    if self.packageIndex is not None:
+      return self.packageIndex.packageKeys(hrefs)
+    return self.generator.md_sqlite.getPackageIndex(hrefs)
+
+  def packageId(self, rpm, pkgKey):
+    if self.packageIndex is not None:
+      return self.packageIndex.pkgId(rpm)
+    return self.generator.md_sqlite.getPackageId(pkgKey)
+
+  def removePackages(self, packages, packagesInDb):
+    pkgKeys = []
+    for package in packages:
+      if package in packagesInDb:
+        pkgKeys.append(packagesInDb[package])
+        self.unindexRpm(package)
+      else:
+        self.logger.info("Package %s is already absent" % package)
+
+    self.generator.md_sqlite.removePkgKeys(pkgKeys)
+
+    for package in packages:
+      if package in packagesInDb:
+        self.changes += 1
+        metrics.inc('updaterepod_packages_total', repo=self.repo, operation='remove')
+        self.logger.info("Removed %s from SQLite database" % package)
+
+  def movePackages(self, moves, packagesInDb):
+    """Renames packages in place, without reading them again"""
+    for (src, dest) in moves:
+      if src not in packagesInDb:
+        self.logger.info("Package %s moved to %s is not present, adding it" % (src, dest))
+        self.addPackages([dest], packagesInDb)
+        continue
+
+      if dest in packagesInDb:
+        self.generator.md_sqlite.removePkgKey(packagesInDb.pop(dest))
+
+      pkgKey = packagesInDb.pop(src)
+      pkgId = self.packageId(src, pkgKey)
+      self.generator.md_sqlite.renamePackage(pkgKey, dest)
+      packagesInDb[dest] = pkgKey
+      self.unindexRpm(src)
+      self.indexRpm(dest, pkgKey, pkgId)
+      self.changes += 1
+      metrics.inc('updaterepod_packages_total', repo=self.repo, operation='move')
+      self.logger.info("Moved %s to %s in SQLite database" % (src, dest))
+
+  def addPackages(self, packages, packagesInDb):
+    # packages being replaced, removed all at once
+    replaced = []
+    for package in packages:
+      pkgKey = packagesInDb.get(package)
+
+      try:
+        if not self.addPackage(package, pkgKey):
+          continue
+        metrics.inc('updaterepod_packages_total', repo=self.repo, operation='add')
+      except Exception, e:
+        metrics.inc('updaterepod_errors_total', repo=self.repo, operation='add')
+        self.logger.error("Error adding %s to SQLite database: %s" % (package, e))
+
+      self.changes += 1
+
+      if pkgKey is not None:
+        self.logger.info("Package %s was already present. The existing one has been removed." % package)
+        replaced.append(pkgKey)
+        if self.packageIndex is not None and self.packageIndex.pkgKey(package) == pkgKey:
+          # the new package could not be added
+          self.unindexRpm(package)
+
+    self.generator.md_sqlite.removePkgKeys(replaced)
+
+  def addPackage(self, rpm, pkgKey = None):
+    """Adds a package, re-using the rows of the package cache when the same
+       package has been read before. Returns False, without doing anything,
+       if the package is identical to the one already present as pkgKey."""
+    if self.state is None or self.state.cache is None:
+      self.addRpm(rpm)
+      return True
+
+    cache = self.state.cache
+    md_sqlite = self.generator.md_sqlite
+
+    path = os.path.join(self.config.directory, rpm)
+    st = os.stat(path)
+    # the ctime changes whenever the file is rewritten, even in place with
+    # the same size and mtime
+    identity = (st.st_dev, st.st_ino, st.st_size, st.st_mtime, st.st_ctime)
+
+    checksum = None
+    pkgId = cache.lookupFile(identity)
+    if pkgId is None:
+      checksum = pkgId = misc.checksum(self.config.sumtype, path)
+
+    if pkgKey is not None and pkgId == self.packageId(rpm, pkgKey):
+      self.logger.info("Package %s is unchanged" % rpm)
+      cache.addFile(identity, pkgId)
+      self.indexRpm(rpm, pkgKey, pkgId)
+      return False
+
+    rows = cache.lookupPackage(pkgId)
+    if rows is not None:
+      newPkgKey = self.nextPkgKey
+      self.nextPkgKey += 1
+      with metrics.timer('updaterepod_phase_seconds', phase='cache_insert'):
+        md_sqlite.insertPackageRows(rows, newPkgKey, rpm, self.config.baseurl, int(st.st_mtime))
+      self.indexRpm(rpm, newPkgKey, pkgId)
+      self.logger.info("Added %s to SQLite database from cache" % rpm)
+    else:
+      po = self.addRpm(rpm, pkgId)
+      cache.addPackage(pkgId, md_sqlite.packageRows(po.crp_packagenumber))
 
-  def listRpms(self):
-    dirLength = len(self.config.directory)
-    rpms = []
-    for root, dirnames, files in os.walk(self.config.directory):
-      relpath = root[dirLength:]
-      for name in files:
-        if name.endswith('.rpm'):
-          rpms.append(os.path.join(relpath, name))
+    cache.addFile(identity, pkgId)
 
-    return rpms
+    return True
 
-  def reuseExistingMetadata(self):
+  def reuseExistingMetadata(self, uncompress = True):
     if os.path.exists(self.temp_dir):
       shutil.rmtree(self.temp_dir)
     os.mkdir(self.temp_dir)
 
-    uncompressDBs(self.output_dir, self.temp_dir)
+    if uncompress:
+      uncompressDBs(self.output_dir, self.temp_dir)
 
   def generateMetaData(self):
     self.generator.closeMetadataDocs()
-    self.generator.doRepoMetadata()
-    self.generator.doFinalMove()
 
-  def addRpm(self, rpm):
-    po = self.generator.read_in_package(rpm, self.config.directory)
+    fragments_file = None
+    if self.config.xml_metadata:
+      if self.state is not None:
+        self.generator.xml_fragments = self.state.xmlFragments()
+      else:
+        # all generated from scratch, in a throwaway store
+        (fd, fragments_file) = tempfile.mkstemp(prefix='updaterepod-xml-', suffix='.sqlite')
+        os.close(fd)
+        self.generator.xml_fragments = XmlFragments(fragments_file)
+
+    # the working copy keeps the filelists and other databases up to date
+    # while the ones published lag behind
+    if self.config.tiered_publish and self.state is not None and self.state.hot and self.action != "refresh":
+      repomd_file = os.path.join(self.output_dir, self.config.repomdfile)
+      if os.path.exists(repomd_file):
+        self.generator.deferred = ('filelists', 'other')
+        self.generator.previous_repomd = RepoMD('repoid', repomd_file)
+
+    try:
+      with metrics.timer('updaterepod_phase_seconds', phase='repomd'):
+        self.generator.doRepoMetadata()
+    finally:
+      if fragments_file is not None:
+        self.generator.xml_fragments.close()
+        os.unlink(fragments_file)
+
+    self.deferred = len(self.generator.reused) > 0
+    if self.deferred and not self.config.atomic_publish:
+      # replaced along with the whole of repodata/
+      for data in self.generator.reused:
+        name = os.path.basename(data.location[1])
+        linkOrCopy(os.path.join(self.output_dir, name), os.path.join(self.temp_dir, name))
+    if self.state is not None and self.deferred:
+      # recorded before publishing, in case the working copy is lost
+      self.state.deferred(True)
+
+    with metrics.timer('updaterepod_phase_seconds', phase='final_move'):
+      if self.config.atomic_publish:
+        self.publishAtomically()
+      else:
+        self.generator.doFinalMove()
+    self.published = True
+    if self.state is not None and not self.deferred:
+      self.state.deferred(False)
+    metrics.set('updaterepod_last_publish_timestamp_seconds', time.time(), repo=self.repo)
+
+  def publishAtomically(self):
+    """Moves the new metadata files, whose names are unique, next to the ones
+       being published and then switches to them by renaming repomd.xml, so
+       that clients never see a missing or half-updated repodata/"""
+    repomd_file = os.path.join(self.output_dir, self.config.repomdfile)
+    if not os.path.exists(self.output_dir):
+      os.mkdir(self.output_dir)
+
+    previous = referencedFiles(repomd_file, self.config.finaldir)
+    current = referencedFiles(os.path.join(self.temp_dir, self.config.repomdfile), self.config.finaldir)
+    for name in current:
+      # the deferred ones are already published
+      if os.path.exists(os.path.join(self.temp_dir, name)):
+        os.rename(os.path.join(self.temp_dir, name), os.path.join(self.output_dir, name))
+    os.rename(os.path.join(self.temp_dir, self.config.repomdfile), repomd_file)
+    shutil.rmtree(self.temp_dir)
+
+    # the grace period of the files superseded starts now
+    now = time.time()
+    for name in previous - current:
+      try:
+        os.utime(os.path.join(self.output_dir, name), (now, now))
+      except OSError:
+        pass
+
+    self.removeSupersededFiles(current)
+
+  def removeSupersededFiles(self, current):
+    """Removes the metadata files no longer referenced by repomd.xml once
+       they have been superseded for longer than the grace period, giving
+       the clients which fetched the previous repomd.xml the time to fetch
+       the files it references"""
+    now = time.time()
+    for name in os.listdir(self.output_dir):
+      if name in current or not METADATA_FILENAME.match(name):
+        continue
+
+      path = os.path.join(self.output_dir, name)
+      try:
+        if now - os.stat(path).st_mtime > self.config.publish_grace_period:
+          os.unlink(path)
+          self.logger.debug("Removed superseded metadata file %s" % path)
+      except OSError:
+        pass
+
+  def addRpmsInParallel(self, packages, pool):
+    """Checksums packages on a pool of processes, while the header of each
+       checksummed package is read and written to the databases here"""
+    jobs = [(self.config.directory, package, self.config.sumtype) for package in packages]
+    for (package, checksum, error) in pool.imap_unordered(checksumRpm, jobs, 16):
+      if error is not None:
+        metrics.inc('updaterepod_errors_total', repo=self.repo, operation='add')
+        self.logger.error("Error adding %s to SQLite database: %s" % (package, error))
+        continue
+
+      try:
+        self.addRpm(package, checksum)
+        self.changes += 1
+        metrics.inc('updaterepod_packages_total', repo=self.repo, operation='add')
+      except Exception, e:
+        metrics.inc('updaterepod_errors_total', repo=self.repo, operation='add')
+        self.logger.error("Error adding %s to SQLite database: %s" % (package, e))
+
+  def addRpm(self, rpm, checksum = None):
+    with metrics.timer('updaterepod_phase_seconds', phase='read_in_package'):
+      po = self.generator.read_in_package(rpm, self.config.directory)
+    if checksum is not None:
+      # already computed, saves reading the whole package again
+      po._checksum = checksum
 
     #if self.generator.md_sqlite.containsPackage(po):
     #  self.logger.info("Package %s already present in SQLite database" % po.__str__())
@@ -501,39 +2559,430 @@ class UpdateRepo(object):
     self.nextPkgKey += 1
     po.crp_baseurl = self.config.baseurl
 
-    po.do_sqlite_dump(self.generator.md_sqlite)
+    with metrics.timer('updaterepod_phase_seconds', phase='sqlite_dump'):
+      self.generator.md_sqlite.dumpPackage(po)
+
+    self.indexRpm(rpm, po.crp_packagenumber, po.checksum)
 
     self.logger.info("Added %s to SQLite database" % po.__str__())
 
+    return po
+
+  def indexRpm(self, rpm, pkgKey, pkgId):
+    if self.state is None:
+      return
+
+    try:
+      st = os.stat(os.path.join(self.config.directory, rpm))
+    except OSError:
+      # gone already, will be removed by a later event
+      st = None
+
+    if self.packageIndex is not None:
+      if st is not None:
+        self.packageIndex.add(rpm, pkgKey, pkgId, st.st_size, int(st.st_mtime))
+      else:
+        self.packageIndex.add(rpm, pkgKey, pkgId, 0, 0)
+    if st is not None:
+      self.state.index.update(rpm, st, pkgKey)
+
+  def unindexRpm(self, rpm):
+    if self.state is not None:
+      if self.packageIndex is not None:
+        self.packageIndex.remove(rpm)
+      self.state.index.remove(rpm)
+
+class EventBatcher(object):
+  """Accumulates package events per repository until the repository has been
+     quiet for a while (or the maximum delay has expired), so that a whole
+     batch of packages can be processed with a single metadata update.
+
+     Only the net effect of the events on each file is retained: the last
+     action recorded for a file wins, so an add followed by a delete ends up
+     as a removal and a delete followed by an add ends up as an addition.
+     Moves are recorded as ("move", source) and followed through chains of
+     renames, the source of a package moved away again being kept as
+     ("gone", source)."""
+
+  def __init__(self, callback, quiet_period, max_delay):
+    self.logger = logging.getLogger("app.EventBatcher")
+    self.callback = callback
+    self.quiet_period = quiet_period
+    self.max_delay = max_delay
+
+    # repository -> {package: action}
+    self.pending = {}
+    # repository -> (time of the first event, time of the last event)
+    self.times = {}
+    # events may be added from other threads
+    self.lock = threading.Lock()
+    # optional function telling whether the events of a repository must be held back
+    self.hold = None
+
+  def add(self, repo, package, action):
+    now = time.time()
+
+    with self.lock:
+      if repo not in self.pending:
+        self.pending[repo] = {}
+        self.times[repo] = (now, now)
+      else:
+        self.times[repo] = (self.times[repo][0], now)
+
+      previous = self.pending[repo].get(package)
+      if action == "remove" and isinstance(previous, tuple):
+        # remember where it came from, in case it is being moved on
+        action = ("gone", previous[1])
+
+      self.pending[repo][package] = action
+
+  def move(self, repo, src, dest):
+    now = time.time()
+
+    with self.lock:
+      if repo not in self.pending:
+        self.pending[repo] = {}
+        self.times[repo] = (now, now)
+      else:
+        self.times[repo] = (self.times[repo][0], now)
+
+      events = self.pending[repo]
+      previous = events.get(src)
+      if previous == "add":
+        # not processed yet, only the destination matters
+        events[dest] = "add"
+      elif isinstance(previous, tuple):
+        events[dest] = ("move", previous[1])
+      else:
+        events[dest] = ("move", src)
+      events[src] = "remove"
+
+  def pendingCounts(self):
+    with self.lock:
+      return dict([(repo, len(events)) for (repo, events) in self.pending.items()])
+
+  def discard(self, repo):
+    """Drops the pending events of a repository, returning how many"""
+    with self.lock:
+      self.times.pop(repo, None)
+      return len(self.pending.pop(repo, {}))
+
+  def due(self, now = None):
+    if now is None:
+      now = time.time()
+
+    repos = []
+    for repo, (first, last) in self.times.items():
+      if self.hold is not None and self.hold(repo):
+        continue
+      if now - last >= self.quiet_period or now - first >= self.max_delay:
+        repos.append(repo)
+
+    return repos
+
+  def flush(self, force = False, repos = None):
+    """Hands the batches that are due over to the callback, or all of them
+       (or the ones of repos) if force is set"""
+    with self.lock:
+      if force:
+        repos = [repo for repo in self.pending.keys() if repos is None or repo in repos]
+      else:
+        repos = self.due()
+
+      batches = []
+      for repo in repos:
+        batches.append((repo, self.pending.pop(repo), self.times.pop(repo)[0]))
+
+    for (repo, events, first) in batches:
+      added = [package for package, action in events.items() if action == "add"]
+      removed = [package for package, action in events.items() if action == "remove" or (isinstance(action, tuple) and action[0] == "gone")]
+      moved = [(action[1], package) for package, action in events.items() if isinstance(action, tuple) and action[0] == "move"]
+
+      self.logger.info("Processing %d added, %d removed and %d moved packages in %s" % (len(added), len(removed), len(moved), repo))
+
+      try:
+        self.callback(repo, added, removed, moved, first)
+      except Exception, e:
+        self.logger.error("Failed to update repository %s: %s" % (repo, e))
+
+class RepoWorkers(object):
+  """Pool of threads running jobs on behalf of repositories. Jobs of the
+     same repository run one after the other, in submission order, so that
+     there is only one writer per repodata/, while jobs of different
+     repositories run in parallel."""
+
+  def __init__(self, workers):
+    self.logger = logging.getLogger("app.RepoWorkers")
+    self.condition = threading.Condition()
+    # repository -> pending jobs
+    self.queues = {}
+    # repositories with pending jobs and no job running
+    self.ready = collections.deque()
+    # repositories with a job running
+    self.running = set()
+    # set once the threads must exit
+    self.stopped = False
+
+    self.threads = []
+    for i in range(max(1, workers)):
+      thread = threading.Thread(target=self.work, name="worker-%d" % i)
+      thread.daemon = True
+      thread.start()
+      self.threads.append(thread)
+
+  def submit(self, repo, job, *args):
+    with self.condition:
+      if repo not in self.queues:
+        self.queues[repo] = collections.deque()
+        if repo not in self.running:
+          self.ready.append(repo)
+      self.queues[repo].append((job, args))
+      self.condition.notify()
+
+  def collectMetrics(self):
+    with self.condition:
+      samples = [('updaterepod_queued_jobs', {'repo': repo}, len(jobs)) for (repo, jobs) in self.queues.items()]
+      samples.extend([('updaterepod_running_jobs', {'repo': repo}, 1) for repo in self.running])
+    return samples
+
+  def isBusy(self, repo):
+    with self.condition:
+      return repo in self.queues or repo in self.running
+
+  def jobCounts(self):
+    """Returns the number of jobs queued and running, per repository"""
+    with self.condition:
+      return dict([(repo, (len(self.queues.get(repo, ())), int(repo in self.running))) for repo in set(self.queues.keys()) | self.running])
+
+  def work(self):
+    while True:
+      with self.condition:
+        while len(self.ready) == 0:
+          if self.stopped:
+            return
+          self.condition.wait()
+
+        repo = self.ready.popleft()
+        (job, args) = self.queues[repo].popleft()
+        if len(self.queues[repo]) == 0:
+          del(self.queues[repo])
+        self.running.add(repo)
+
+      try:
+        job(*args)
+      except Exception, e:
+        metrics.inc('updaterepod_errors_total', repo=repo, operation='job')
+        self.logger.error("Failed to process job for %s: %s" % (repo, e))
+      finally:
+        with self.condition:
+          self.running.discard(repo)
+          if repo in self.queues:
+            self.ready.append(repo)
+          # wakes up another worker, or whoever is waiting for the jobs to be done
+          self.condition.notify_all()
+
+  def join(self, *repos):
+    """Waits until all the jobs submitted so far (only the ones of repos if
+       given), and the jobs they submit in turn, are done"""
+    if len(repos) == 0:
+      busy = lambda: len(self.queues) > 0 or len(self.running) > 0
+    else:
+      busy = lambda: any([repo in self.queues or repo in self.running for repo in repos])
+
+    with self.condition:
+      while busy():
+        # waiting with a timeout lets the signals be handled in the meantime
+        self.condition.wait(1)
+
+  def stop(self):
+    """Stops the threads once the jobs submitted so far are done"""
+    self.join()
+    with self.condition:
+      self.stopped = True
+      self.condition.notify_all()
+    for thread in self.threads:
+      thread.join()
+
+def isPackage(pathname):
+  filename = os.path.basename(pathname)
+  return filename.endswith('.rpm') and not re.search('^\.', filename)
+
+def isMetadataDir(path):
+  """Directories never watched when watching recursively"""
+  return os.path.basename(path) in ('repodata', '.repodata', '.olddata')
+
+def isGlob(path):
+  return re.search('[*?[]', path) is not None
+
+def pathComponents(path):
+  path = os.path.normpath(path).strip('/')
+  if path == '':
+    return []
+  return path.split('/')
+
+def matchesPattern(path, pattern):
+  """Whether path matches the glob pattern, wildcards not matching slashes"""
+  parts = pathComponents(path)
+  pattern_parts = pathComponents(pattern)
+  return len(parts) == len(pattern_parts) and matchesPrefix(parts, pattern_parts)
+
+def matchesPrefix(parts, pattern_parts):
+  """Whether the path components match the first components of a pattern"""
+  if len(parts) > len(pattern_parts):
+    return False
+  for (part, pattern_part) in zip(parts, pattern_parts):
+    if part.startswith('.') and not pattern_part.startswith('.'):
+      # as glob does, hidden directories have to be named explicitly
+      return False
+    if not fnmatch.fnmatchcase(part, pattern_part):
+      return False
+  return True
+
+class DiscoveryEventHandler(pyinotify.ProcessEvent):
+  """Handles the events of the directories leading to the repositories
+     matched by glob patterns"""
+
+  def __init__(self, discovered, lost):
+    self.discovered = discovered
+    self.lost = lost
+
+  def process_IN_CREATE(self, event):
+    if event.dir:
+      self.discovered(event.pathname)
+
+  def process_IN_MOVED_TO(self, event):
+    if event.dir:
+      self.discovered(event.pathname)
+
+  def process_IN_IGNORED(self, event):
+    self.lost(event.path)
+
+  def process_default(self, event):
+    pass
+
 class iNotifyEventHandler(pyinotify.ProcessEvent):
+  # events about the watches themselves rather than about packages
+  WATCH_EVENTS = pyinotify.IN_Q_OVERFLOW | pyinotify.IN_IGNORED | pyinotify.IN_UNMOUNT
+
   def __call__(self, event):
+    if event.mask & self.WATCH_EVENTS:
+      # overflow events do not even have a path
+      super(iNotifyEventHandler, self).__call__(event)
+      return
+
     filename = os.path.basename(event.pathname)
     if not re.search('^\.', filename):
-      if filename.endswith('.rpm'):
+      if filename.endswith('.rpm') or event.dir:
         super(iNotifyEventHandler, self).__call__(event)
 
-  def __init__(self):
+  def __init__(self, batcher, locate, resync, lost):
+    """locate maps a path to its (repository, relative path), or None if it
+       does not belong to any watched repository, resync reconciles
+       repositories (all of them if none is given) with their metadata and
+       lost is called with the path of a watch removed by the kernel"""
     self.logger = logging.getLogger("app.iNotifyEventHandler")
-    self.config = createrepo.MetaDataConfig()
-    self.config.quiet = True
+    self.batcher = batcher
+    self.locate = locate
+    self.resync = resync
+    self.lost = lost
+    # whether the subdirectories are watched as well
+    self.recursive = False
+
+  def add(self, pathname):
+    location = self.locate(pathname)
+    if location is not None:
+      self.logger.info("Adding %s" % pathname)
+      self.batcher.add(location[0], location[1], "add")
+
+  def remove(self, pathname):
+    location = self.locate(pathname)
+    if location is not None:
+      self.logger.info("Removing %s" % pathname)
+      self.batcher.add(location[0], location[1], "remove")
+
+  def addDirectory(self, pathname):
+    """A directory showing up when watching recursively may already contain packages"""
+    location = self.locate(pathname)
+    if location is None or isMetadataDir(pathname):
+      return
+
+    for (href, st) in scanRpms(pathname):
+      self.add(os.path.join(pathname, href))
 
   def process_IN_CLOSE_WRITE(self, event):
-    self.logger.info("Adding %s" % event.pathname)
+    self.add(event.pathname)
 
-    self.config.directory = os.path.dirname(event.pathname)
-    self.config.packages = [os.path.basename(event.pathname)]
+  def process_IN_CREATE(self, event):
+    if event.dir:
+      if self.recursive:
+        self.addDirectory(event.pathname)
+      return
 
-    UpdateRepo(self.config).execute(action="add")
+    # hardlinks show up without being written, unlike new files
+    try:
+      hardlink = os.stat(event.pathname).st_nlink > 1
+    except OSError:
+      return
+    if hardlink:
+      self.add(event.pathname)
 
   def process_IN_DELETE(self, event):
-    self.logger.info("Removing %s" % event.pathname)
+    if not event.dir:
+      self.remove(event.pathname)
+
+  def process_IN_MOVED_FROM(self, event):
+    if event.dir:
+      location = self.locate(event.pathname)
+      if location is not None and not isMetadataDir(event.pathname):
+        # the packages it contained are gone, which only the index knows about
+        self.resync(location[0])
+    else:
+      self.remove(event.pathname)
+
+  def process_IN_Q_OVERFLOW(self, event):
+    # the kernel does not tell which watches the dropped events were about
+    self.logger.warning("inotify queue overflowed, events have been lost")
+    metrics.inc('updaterepod_inotify_overflows_total')
+    self.resync()
+
+  def process_IN_UNMOUNT(self, event):
+    location = self.locate(os.path.join(event.path, ''))
+    if location is not None:
+      self.logger.warning("Filesystem backing %s has been unmounted" % event.path)
+      self.resync(location[0])
+
+  def process_IN_IGNORED(self, event):
+    # sent once the kernel stops watching a directory, e.g. when it is
+    # deleted or unmounted
+    self.lost(event.wd, event.path)
+
+  def process_IN_MOVED_TO(self, event):
+    if event.dir:
+      self.addDirectory(event.pathname)
+      return
+
+    src_pathname = getattr(event, 'src_pathname', None)
+    if src_pathname is None or not isPackage(src_pathname):
+      self.add(event.pathname)
+      return
+
+    src = self.locate(src_pathname)
+    dest = self.locate(event.pathname)
+    if src is not None and dest is not None and src[0] == dest[0]:
+      self.logger.info("Moving %s to %s" % (src_pathname, event.pathname))
+      self.batcher.move(dest[0], src[1], dest[1])
+    else:
+      # the removal of the source has been handled by IN_MOVED_FROM
+      self.add(event.pathname)
 
-    self.config.directory = os.path.dirname(event.pathname)
-    self.config.packages = [os.path.basename(event.pathname)]
+class Updaterepo_Daemon:
+  # how often (in milliseconds) pending batches are checked when no events arrive
+  BATCH_TICK = 250
 
-    UpdateRepo(self.config).execute(action="remove")
+  # seconds a follower waits for the packages added by a record of the
+  # journal to be replicated, before applying it without them
+  FOLLOW_WAIT = 600
 
-class Updaterepo_Daemon:
   def __init__(self, **kwargs):
     # set up logger for this instance
     self.logger = logging.getLogger("app.Updaterepo_Daemon")
@@ -541,24 +2990,86 @@ class Updaterepo_Daemon:
     # read configuration file
     self.config_file = kwargs['config_file']
 
+    # overrides profile_dir, from the command line
+    self.profile_dir = kwargs.get('profile_dir')
+
     self.config = None
     self.read_config()
 
     # dictionary containing path to WatchManager file descriptor association
     self.wd_fds = {}
 
+    # directories leading to the repositories matched by glob patterns,
+    # watched for new repositories to show up
+    self.discovery_wd_fds = {}
+    self.discovery_handler = DiscoveryEventHandler(self.discovered, self.discovery_lost)
+
+    # dictionary containing path to RepoState association, least recently used first
+    self.repos = collections.OrderedDict()
+
+    # protects the dictionary of RepoState, used by the workers
+    self.repos_lock = threading.Lock()
+
+    # cache of the packages read so far, shared by all the repositories
+    self.open_package_cache()
+
+    # repositories with a reconciliation submitted but not started yet
+    self.reconciling = set()
+
+    # threads updating the metadata, one repository at a time each
+    self.workers = RepoWorkers(self.config['workers'])
+
     # watchmanager object
     self.wm = pyinotify.WatchManager()
 
+    # batches events per repository before updating the metadata, holding
+    # them back while the repository is being updated
+    self.batcher = EventBatcher(self.schedule_update, self.config['batch_quiet_period'], self.config['batch_max_delay'])
+    self.batcher.hold = self.hold_events
+
+    # repositories whose events are held back until resumed, via the control socket
+    self.paused = set()
+
+    # repository -> time of the last publication of its metadata
+    self.last_publish = {}
+
+    # repository -> time its deferred filelists and other metadata are due
+    # to be published (tiered_publish), protected by repos_lock
+    self.refreshes = {}
+
+    # repository -> Journal the batches are written to before being applied,
+    # protected by repos_lock
+    self.journals = {}
+
+    # followed repositories with a job reading the journal submitted, when
+    # the journal is to be read next, and repository -> (sequence number,
+    # time) of the record waiting for its packages to be replicated
+    self.following = set()
+    self.next_follow = 0
+    self.follow_waits = {}
+
+    # server of the control socket
+    self.control_server = None
+
+    # HTTP server exposing the metrics
+    self.metrics_server = None
+    metrics.collect(self.workers.collectMetrics)
+    metrics.collect(self.collect_metrics)
+
     # eventhandler object
-    handler = iNotifyEventHandler()
+    self.event_handler = iNotifyEventHandler(self.batcher, self.locate_package, self.resync_repos, self.watch_lost)
+    self.event_handler.recursive = self.config['recursive']
 
-    # notifier object
-    self.notifier = pyinotify.Notifier(self.wm, handler, read_freq=self.config['poll_freq'], threshold=self.config['queue_threshold'])
+    # notifier object, waking up regularly to flush the pending batches
+    self.notifier = pyinotify.Notifier(self.wm, self.event_handler, read_freq=self.config['poll_freq'], threshold=self.config['queue_threshold'], timeout=self.BATCH_TICK)
 
     # enable coalescing of events so that only one event will be generated for multiple actions on the same file
     self.set_events_coalescing()
 
+    # set by the signal handler, acted upon by the main loop
+    self.reload_requested = False
+    self.shutdown_requested = False
+
     # handling signals
     signal.signal(signal.SIGHUP, self.signal_handler)
     signal.signal(signal.SIGTERM, self.signal_handler)
@@ -570,10 +3081,29 @@ class Updaterepo_Daemon:
       self.logger.error("Failed to load %s configuration file: %s" % (self.config_file, e))
       sys.exit(1)
 
-    if ('watch' not in config) or (config['watch'] is None) or (len(config['watch']) == 0):
+    if ('follow' not in config) or (config['follow'] is None):
+      config['follow'] = {}
+
+    # local directory -> directory on the leader, the same by default
+    config['follow'] = dict([(os.path.normpath(path), os.path.normpath(leader or path)) for (path, leader) in config['follow'].items()])
+
+    if ('watch' not in config) or (config['watch'] is None):
+      config['watch'] = []
+
+    if len(config['watch']) == 0 and len(config['follow']) == 0:
       self.logger.error("Must specify at least one directory to watch")
       sys.exit(1)
 
+    config['watch'] = [os.path.normpath(path) for path in config['watch']]
+    for path in config['watch']:
+      if path in config['follow']:
+        self.logger.error("Directory %s cannot be both watched and followed" % path)
+        sys.exit(1)
+    for path in config['watch']:
+      if isGlob(path) and not os.path.isabs(path):
+        self.logger.error("Glob pattern %s must be an absolute path" % path)
+        sys.exit(1)
+
     if ('coalesce_events' not in config) or (config['coalesce_events'] is None):
       config['coalesce_events'] = False
 
@@ -583,6 +3113,120 @@ class Updaterepo_Daemon:
     if ('queue_threshold' not in config) or (config['queue_threshold'] is None):
       config['queue_threshold'] = 0
 
+    if ('batch_quiet_period' not in config) or (config['batch_quiet_period'] is None):
+      config['batch_quiet_period'] = 2
+
+    if ('batch_max_delay' not in config) or (config['batch_max_delay'] is None):
+      config['batch_max_delay'] = 30
+
+    if ('hot_copies' not in config) or (config['hot_copies'] is None):
+      config['hot_copies'] = False
+
+    if ('state_dir' not in config) or (config['state_dir'] is None):
+      config['state_dir'] = "/var/lib/updaterepod"
+
+    if ('compress_workers' not in config) or (config['compress_workers'] is None):
+      config['compress_workers'] = 3
+
+    if ('parallel_bzip2_min_size' not in config) or (config['parallel_bzip2_min_size'] is None):
+      config['parallel_bzip2_min_size'] = 0
+
+    if ('package_cache_size' not in config) or (config['package_cache_size'] is None):
+      config['package_cache_size'] = 10000
+
+    if ('workers' not in config) or (config['workers'] is None):
+      config['workers'] = 4
+
+    if ('recursive' not in config) or (config['recursive'] is None):
+      config['recursive'] = False
+
+    if ('metrics_address' not in config) or (config['metrics_address'] is None):
+      config['metrics_address'] = "127.0.0.1"
+
+    if 'metrics_port' not in config:
+      config['metrics_port'] = None
+
+    if ('compression' not in config) or (config['compression'] is None):
+      config['compression'] = "bz2"
+
+    if 'compression_level' not in config:
+      config['compression_level'] = None
+
+    if ('xml_metadata' not in config) or (config['xml_metadata'] is None):
+      config['xml_metadata'] = False
+
+    if ('atomic_publish' not in config) or (config['atomic_publish'] is None):
+      config['atomic_publish'] = False
+
+    if ('publish_grace_period' not in config) or (config['publish_grace_period'] is None):
+      config['publish_grace_period'] = 600
+
+    if ('tiered_publish' not in config) or (config['tiered_publish'] is None):
+      config['tiered_publish'] = False
+
+    if ('deferred_publish_delay' not in config) or (config['deferred_publish_delay'] is None):
+      config['deferred_publish_delay'] = 60
+
+    if 'journal_dir' not in config:
+      config['journal_dir'] = None
+
+    if ('journal_retention' not in config) or (config['journal_retention'] is None):
+      config['journal_retention'] = 3600
+
+    if 'follow_journal_dir' not in config:
+      config['follow_journal_dir'] = None
+
+    if len(config['follow']) > 0 and config['follow_journal_dir'] is None:
+      self.logger.error("Must specify the journal directory of the leader to follow (follow_journal_dir)")
+      sys.exit(1)
+
+    if ('follow_interval' not in config) or (config['follow_interval'] is None):
+      config['follow_interval'] = 5
+
+    if ('max_open_repos' not in config) or (config['max_open_repos'] is None):
+      config['max_open_repos'] = 0
+
+    if self.profile_dir is not None:
+      config['profile_dir'] = self.profile_dir
+    elif 'profile_dir' not in config:
+      config['profile_dir'] = None
+
+    if ('profile_every' not in config) or (config['profile_every'] is None):
+      config['profile_every'] = 1
+
+    if ('profile_threshold' not in config) or (config['profile_threshold'] is None):
+      config['profile_threshold'] = 0
+
+    if ('profile_retention' not in config) or (config['profile_retention'] is None):
+      config['profile_retention'] = 100
+
+    if 'control_socket' not in config:
+      config['control_socket'] = None
+
+    if ('repositories' not in config) or (config['repositories'] is None):
+      config['repositories'] = {}
+
+    config['repositories'] = dict([(os.path.normpath(path), options or {}) for (path, options) in config['repositories'].items()])
+
+    for options in [config] + config['repositories'].values():
+      compression = options.get('compression', config['compression'])
+      if compression not in COMPRESSION_SUFFIXES:
+        self.logger.error("Unknown compression %s, must be one of %s" % (compression, ", ".join(sorted(COMPRESSION_SUFFIXES))))
+        sys.exit(1)
+      if compression == 'xz' and lzma is None:
+        self.logger.error("xz compression requires the lzma module")
+        sys.exit(1)
+
+    if not config['hot_copies'] and any([options.get('tiered_publish', config['tiered_publish']) for options in [config] + config['repositories'].values()]):
+      # the deferred metadata is published from the working copies
+      self.logger.warning("tiered_publish has no effect without hot_copies, all the metadata is published on every update")
+
+    try:
+      profiler.configure(config['profile_dir'], config['profile_every'], config['profile_threshold'], config['profile_retention'])
+    except Exception, e:
+      self.logger.error("Failed to enable profiling in %s: %s" % (config['profile_dir'], e))
+      sys.exit(1)
+
     self.config = config
 
   def reload_config(self):
@@ -590,13 +3234,17 @@ class Updaterepo_Daemon:
 
     self.read_config()
 
-    for path in old_config['watch']:
-      if path not in self.config['watch']:
+    self.event_handler.recursive = self.config['recursive']
+    if old_config['recursive'] != self.config['recursive']:
+      for path in self.wd_fds.keys():
         self.stop_watching(path)
 
-    for path in self.config['watch']:
-      if path not in old_config['watch']:
-        self.start_watching(path)
+    # set up again from scratch, patterns may have changed
+    self.stop_discovery()
+    repos = self.watch_repos()
+    for path in self.wd_fds.keys():
+      if path not in repos:
+        self.stop_watching(path)
 
     if old_config['coalesce_events'] != self.config['coalesce_events']:
       if old_config['coalesce_events']:
@@ -604,15 +3252,35 @@ class Updaterepo_Daemon:
       else:
         self.set_events_coalescing(True)
 
+    self.batcher.quiet_period = self.config['batch_quiet_period']
+    self.batcher.max_delay = self.config['batch_max_delay']
+
+    if old_config['journal_dir'] != self.config['journal_dir']:
+      with self.repos_lock:
+        self.journals = {}
+
+    for option in ('hot_copies', 'state_dir', 'package_cache_size', 'max_open_repos'):
+      if old_config[option] != self.config[option]:
+        self.close_repos()
+        self.close_package_cache()
+        self.open_package_cache()
+        break
+
+    self.reconcile_repos()
+
   def signal_handler(self, signum, frame):
     self.logger.debug("Received signal: %s at frame: %s" % (signum, frame))
 
+    # only flags the request: the main loop may be in the middle of anything
     if signum == signal.SIGTERM:
+      if self.shutdown_requested:
+        self.logger.warning("Requested daemon shutdown again, exiting without waiting for the pending updates ..")
+        sys.exit(1)
       self.logger.info("Requested daemon shutdown ..")
-      sys.exit(0)
+      self.shutdown_requested = True
     elif signum == signal.SIGHUP:
       self.logger.info("Requested configuration reload ..")
-      self.reload_config()
+      self.reload_requested = True
 
   def set_events_coalescing(self, value = None):
     if value is None:
@@ -626,35 +3294,703 @@ class Updaterepo_Daemon:
     self.notifier.coalesce_events(value)
 
   def start_watching(self, path):
-    fd = self.wm.add_watch(path, pyinotify.IN_CLOSE_WRITE | pyinotify.IN_DELETE, rec=False)
-    wd_fd = fd.itervalues().next()
+    mask = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_CREATE | pyinotify.IN_DELETE | pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO
+    recursive = self.config['recursive']
+    if recursive:
+      # lets pyinotify follow subdirectories being renamed
+      mask |= pyinotify.IN_MOVE_SELF
+    fd = self.wm.add_watch(path, mask, rec=recursive, auto_add=recursive, exclude_filter=isMetadataDir)
+    wd_fd = fd[path]
     self.logger.info("Start watching %s (wd_fd: %d)" % (path, wd_fd))
     self.wd_fds[path] = wd_fd
 
+  def watch_repos(self):
+    """Starts watching the directories of the configuration not watched yet,
+       glob patterns being expanded, and returns all of them"""
+    repos = set()
+    for path in self.config['watch']:
+      if isGlob(path):
+        repos.update(self.discover(path))
+      else:
+        repos.add(path)
+        if path not in self.wd_fds:
+          self.start_watching(path)
+    return repos
+
+  def discover(self, pattern, directory = None):
+    """Watches the directories matching pattern, found under directory
+       (which matches its first components) or under the part of pattern
+       without wildcards. The directories leading to them are watched as
+       well, for new repositories to be discovered as they are created.
+       Returns the repositories found."""
+    pattern_parts = pathComponents(pattern)
+    if directory is None:
+      first = [i for (i, part) in enumerate(pattern_parts) if isGlob(part)][0]
+      directory = '/' + '/'.join(pattern_parts[:first])
+    depth = len(pathComponents(directory))
+
+    if depth == len(pattern_parts):
+      if isMetadataDir(directory):
+        return []
+      if directory not in self.wd_fds:
+        self.start_watching(directory)
+      return [directory]
+
+    if directory not in self.discovery_wd_fds:
+      mask = pyinotify.IN_CREATE | pyinotify.IN_MOVED_TO | pyinotify.IN_ONLYDIR
+      wd_fd = self.wm.add_watch(directory, mask, proc_fun=self.discovery_handler).get(directory, -1)
+      if wd_fd < 0:
+        # does not exist (yet), its parent being watched if it matters
+        return []
+      self.discovery_wd_fds[directory] = wd_fd
+
+    repos = []
+    try:
+      names = sorted(os.listdir(directory))
+    except OSError:
+      return []
+    for name in names:
+      path = os.path.join(directory, name)
+      if matchesPrefix(pathComponents(path), pattern_parts) and os.path.isdir(path):
+        repos.extend(self.discover(pattern, path))
+    return repos
+
+  def discovered(self, path):
+    """Called when a directory is created (or moved) where repositories are
+       discovered"""
+    for pattern in self.config['watch']:
+      if isGlob(pattern) and matchesPrefix(pathComponents(path), pathComponents(pattern)):
+        for repo in self.discover(pattern, path):
+          self.logger.info("Discovered repository %s" % repo)
+          # may have been moved in along with its packages
+          self.reconcile_repos(repo)
+
+  def discovery_lost(self, path):
+    self.discovery_wd_fds.pop(os.path.normpath(path), None)
+
+  def stop_discovery(self):
+    for (path, wd_fd) in self.discovery_wd_fds.items():
+      self.wm.rm_watch(wd_fd)
+    self.discovery_wd_fds = {}
+
   def stop_watching(self, path):
     wd_fd = self.wd_fds[path]
     self.logger.info("Stop watching %s (wd_fd: %d)" % (path, wd_fd))
-    self.wm.del_watch(wd_fd)
+    self.wm.rm_watch(wd_fd, rec=True)
     del(self.wd_fds[path])
 
-  def run(self):
-    for path in self.config['watch']:
+    with self.repos_lock:
+      state = self.repos.pop(path, None)
+    if state is not None:
+      self.workers.submit(path, state.close)
+
+  def repo_state(self, directory):
+    """Returns the state of a repository, created on first use. At most
+       max_open_repos are kept open, the least recently used ones being
+       closed once their pending jobs are done."""
+    evicted = []
+    with self.repos_lock:
+      state = self.repos.pop(directory, None)
+      if state is None:
+        state = RepoState(directory, self.config['state_dir'], self.config['hot_copies'], self.package_cache)
+      self.repos[directory] = state
+
+      limit = self.config['max_open_repos']
+      while limit > 0 and len(self.repos) > limit:
+        evicted.append(self.repos.popitem(last=False))
+
+    for (path, old_state) in evicted:
+      self.logger.debug("Closing the state of %s" % path)
+      self.workers.submit(path, old_state.close)
+
+    return state
+
+  def open_package_cache(self):
+    """Opens the package cache shared by all the repositories"""
+    self.package_cache = None
+    if self.config['package_cache_size'] > 0:
+      if not os.path.isdir(self.config['state_dir']):
+        os.makedirs(self.config['state_dir'])
+      self.package_cache = PackageCache(os.path.join(self.config['state_dir'], 'packages.sqlite'), self.config['package_cache_size'])
+
+  def close_package_cache(self):
+    """Closes the package cache once the jobs submitted so far, which may
+       still be using it, are done"""
+    cache = self.package_cache
+    if cache is None:
+      return
+
+    busy = set(self.workers.jobCounts().keys())
+    if len(busy) == 0:
+      cache.close()
+      return
+
+    # the last repository done with its jobs closes it
+    lock = threading.Lock()
+    def done(repo):
+      with lock:
+        busy.discard(repo)
+        if len(busy) > 0:
+          return
+      cache.close()
+
+    for repo in list(busy):
+      self.workers.submit(repo, done, repo)
+
+  def close_repos(self):
+    with self.repos_lock:
+      repos = self.repos
+      self.repos = collections.OrderedDict()
+
+    # closed by the workers once the jobs already submitted are done
+    for (directory, state) in repos.items():
+      self.workers.submit(directory, state.close)
+
+  def repo_config(self, directory):
+    config = UpdateRepoConfig()
+    config.quiet = True
+    config.directory = directory
+    config.compress_workers = self.config['compress_workers']
+    config.parallel_bzip2_min_size = self.config['parallel_bzip2_min_size']
+
+    options = self.config['repositories'].get(directory)
+    if options is None:
+      # first matching pattern
+      patterns = [pattern for pattern in sorted(self.config['repositories']) if isGlob(pattern) and matchesPattern(directory, pattern)]
+      options = patterns and self.config['repositories'][patterns[0]] or {}
+    config.compression = options.get('compression', self.config['compression'])
+    config.compression_level = options.get('compression_level', self.config['compression_level'])
+    config.xml_metadata = options.get('xml_metadata', self.config['xml_metadata'])
+    config.atomic_publish = options.get('atomic_publish', self.config['atomic_publish'])
+    config.publish_grace_period = self.config['publish_grace_period']
+    config.tiered_publish = options.get('tiered_publish', self.config['tiered_publish'])
+
+    return config
+
+  def locate_package(self, pathname):
+    """Returns the watched repository containing pathname and the path
+       relative to it, or None"""
+    directory = os.path.dirname(pathname)
+    while directory not in self.wd_fds:
+      parent = os.path.dirname(directory)
+      if parent == directory:
+        return None
+      directory = parent
+
+    return (directory, os.path.relpath(pathname, directory))
+
+  def schedule_update(self, directory, added, removed, moved, since):
+    seq = None
+    journal = self.journal(directory)
+    if journal is not None:
+      # written before being applied, so that it is replayed after a crash
+      try:
+        seq = journal.append(added, removed, moved)
+      except Exception, e:
+        metrics.inc('updaterepod_errors_total', repo=directory, operation='journal')
+        self.logger.error("Failed to write the batch of %s to the journal: %s" % (directory, e))
+
+    self.workers.submit(directory, self.update_repo, directory, added, removed, moved, since, seq)
+
+  def update_repo(self, directory, added, removed, moved, since, seq = None):
+    config = self.repo_config(directory)
+
+    updater = UpdateRepo(config, self.repo_state(directory))
+    profiler.run(directory, updater.execute, action="update", added=added, removed=removed, moved=moved)
+    if updater.published:
+      self.last_publish[directory] = time.time()
+      metrics.observe('updaterepod_event_to_publish_seconds', time.time() - since, repo=directory)
+    if updater.deferred:
+      self.schedule_refresh(directory)
+
+    if seq is not None:
+      journal = self.journal(directory)
+      journal.markPublished(seq)
+      journal.compact(self.config['journal_retention'])
+
+  def journal(self, directory):
+    """Returns the journal of a repository, None unless journal_dir is set"""
+    if self.config['journal_dir'] is None:
+      return None
+
+    with self.repos_lock:
+      if directory not in self.journals:
+        journal = Journal(os.path.join(self.config['journal_dir'], journalName(directory)))
+        journal.create(directory)
+        self.journals[directory] = journal
+      return self.journals[directory]
+
+  def replay_journals(self):
+    """Applies again the batches written to the journals but not published,
+       the daemon having died while applying them"""
+    if self.config['journal_dir'] is None:
+      return
+
+    for directory in sorted(self.wd_fds):
+      journal = self.journal(directory)
+      for record in journal.replay():
+        self.logger.info("Replaying batch %d of %s" % (record['seq'], directory))
+        self.workers.submit(directory, self.update_repo, directory, record['added'], record['removed'], record['moved'], time.time(), record['seq'])
+
+  def submit_follows(self):
+    if len(self.config['follow']) == 0 or time.time() < self.next_follow:
+      return
+    self.next_follow = time.time() + self.config['follow_interval']
+
+    for directory in self.config['follow']:
+      with self.repos_lock:
+        if directory in self.following:
+          continue
+        self.following.add(directory)
+      self.workers.submit(directory, self.follow_repo, directory)
+
+  def follow_repo(self, directory):
+    """Applies to a followed repository the records of the journal of the
+       leader it has not applied yet"""
+    with self.repos_lock:
+      self.following.discard(directory)
+
+    leader = self.config['follow'][directory]
+    journal = Journal(os.path.join(self.config['follow_journal_dir'], journalName(leader)))
+    first = journal.firstSeq()
+    if first is None:
+      # nothing written by the leader yet
+      return
+
+    state = self.repo_state(directory)
+    position = state.journalPosition()
+    if position is None and first == 1:
+      # the whole history is there
+      position = 0
+    if position is None or position + 1 < first:
+      # the records in between have been compacted: catch up by comparing
+      # the packages with the index, from the last record on
+      last = journal.lastSeq()
+      self.logger.warning("Records of the journal of %s missing, reconciling %s" % (leader, directory))
+      (added, removed) = state.reconcile()
+      self.apply_followed(directory, state, added, removed, [], last, set())
+      position = last
+
+    pending = state.followPending()
+    present = [href for href in sorted(pending) if os.path.exists(os.path.join(directory, href))]
+    if present:
+      self.logger.info("%s showed up in %s at last" % (", ".join(present), directory))
+      pending.difference_update(present)
+      self.apply_followed(directory, state, present, [], [], position, pending)
+
+    while True:
+      (added, removed, moved, last) = self.follow_batch(directory, journal, position, pending)
+      if last is None:
+        return
+      self.apply_followed(directory, state, added, removed, moved, last, pending)
+      position = last
+
+  def follow_batch(self, directory, journal, position, pending = None):
+    """Merges the records following position into a single batch, up to the
+       first one touching a package already in it or adding packages not
+       replicated yet (and not removed by a later record). Returns the batch
+       and the sequence number of its last record, None if there is none.
+       The packages given up on after FOLLOW_WAIT seconds are left out of the
+       batch and added to pending, as are the moves to them."""
+    if pending is None:
+      pending = set()
+    added = []
+    removed = []
+    moved = []
+    touched = set()
+    last = None
+    records = list(journal.records(position))
+    for (i, record) in enumerate(records):
+      hrefs = set(record['added']) | set(record['removed'])
+      for (source, dest) in record['moved']:
+        hrefs.update((source, dest))
+      if hrefs & touched:
+        break
+
+      absent = [href for href in record['added'] + [dest for (source, dest) in record['moved']] if not os.path.exists(os.path.join(directory, href))]
+      missing = absent
+      if missing:
+        # no need to wait for the packages gone since
+        gone = set()
+        for later in records[i + 1:]:
+          gone.update(later['removed'])
+          gone.update([source for (source, dest) in later['moved']])
+        missing = [href for href in missing if href not in gone]
+      if missing:
+        (seq, since) = self.follow_waits.get(directory, (None, None))
+        if seq != record['seq']:
+          self.follow_waits[directory] = (record['seq'], time.time())
+          break
+        if time.time() - since < self.FOLLOW_WAIT:
+          break
+        self.logger.warning("Gave up waiting for %s to show up in %s, adding them once they do" % (", ".join(missing), directory))
+
+      added.extend([href for href in record['added'] if href not in absent])
+      removed.extend(record['removed'])
+      pending.difference_update(record['removed'])
+      for (source, dest) in record['moved']:
+        # added along with the destination when there
+        pending.discard(source)
+        if dest not in absent:
+          moved.append((source, dest))
+        elif not os.path.exists(os.path.join(directory, source)):
+          # moved away on the replica as well, the destination not there yet
+          removed.append(source)
+      pending.update(missing)
+      touched.update(hrefs)
+      last = record['seq']
+
+    return (added, removed, moved, last)
+
+  def apply_followed(self, directory, state, added, removed, moved, seq, pending):
+    self.logger.info("Applying %d added, %d removed and %d moved packages up to record %d to %s" % (len(added), len(removed), len(moved), seq, directory))
+    updater = UpdateRepo(self.repo_config(directory), state)
+    profiler.run(directory, updater.execute, action="update", added=added, removed=removed, moved=moved)
+    state.setFollowPending(pending)
+    state.setJournalPosition(seq)
+    if updater.published:
+      self.last_publish[directory] = time.time()
+    if updater.deferred:
+      self.schedule_refresh(directory)
+
+  def schedule_refresh(self, directory):
+    """Publishes the deferred metadata of a repository deferred_publish_delay
+       seconds after the first update leaving it out, however many follow"""
+    with self.repos_lock:
+      if directory not in self.refreshes:
+        self.refreshes[directory] = time.time() + self.config['deferred_publish_delay']
+
+  def submit_refreshes(self, force = False):
+    now = time.time()
+    with self.repos_lock:
+      due = [directory for (directory, deadline) in self.refreshes.items() if force or deadline <= now]
+      for directory in due:
+        del(self.refreshes[directory])
+
+    for directory in due:
+      self.workers.submit(directory, self.refresh_repo, directory)
+
+  def refresh_repo(self, directory):
+    updater = UpdateRepo(self.repo_config(directory), self.repo_state(directory))
+    profiler.run(directory, updater.execute, action="refresh")
+    if updater.published:
+      self.last_publish[directory] = time.time()
+
+  def collect_metrics(self):
+    return [('updaterepod_pending_events', {'repo': repo}, count) for (repo, count) in self.batcher.pendingCounts().items()]
+
+  def start_metrics_server(self):
+    if self.config['metrics_port'] is None:
+      return
+
+    address = (self.config['metrics_address'], self.config['metrics_port'])
+    self.logger.info("Exposing metrics on http://%s:%d/metrics" % address)
+    self.metrics_server = BaseHTTPServer.HTTPServer(address, MetricsRequestHandler)
+    thread = threading.Thread(target=self.metrics_server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+  def hold_events(self, repo):
+    return repo in self.paused or self.workers.isBusy(repo)
+
+  def start_control_server(self):
+    path = self.config['control_socket']
+    if path is None:
+      return
+
+    if os.path.exists(path):
+      # left behind by a previous instance
+      os.unlink(path)
+
+    self.logger.info("Listening for control requests on %s" % path)
+    self.control_server = ControlServer(path, self.control)
+    thread = threading.Thread(target=self.control_server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+  def stop_control_server(self):
+    if self.control_server is None:
+      return
+
+    self.control_server.shutdown()
+    self.control_server.server_close()
+    try:
+      os.unlink(self.config['control_socket'])
+    except OSError:
+      pass
+
+  def control(self, request):
+    """Runs a request of the control socket, on one of its threads:
+
+       - flush publishes the pending events right away, paused or not
+       - resync reconciles the repositories with their directory
+       - pause holds back the events until resume is requested
+       - status only reports the state of the repositories
+
+       Requests apply to the repository given as repo, or to all of them,
+       and flush and resync only return once the resulting updates are done
+       if wait is set. Responses report the state of the repositories."""
+    command = request.get('command')
+    repos = sorted(self.wd_fds.keys())
+    if request.get('repo') is not None:
+      repo = os.path.normpath(request['repo'])
+      if repo not in repos:
+        raise ValueError("%s is not a watched directory" % repo)
+      repos = [repo]
+
+    self.logger.info("Control request: %s %s" % (command, " ".join(repos)))
+    if command == 'flush':
+      self.publish_now(repos, request.get('wait', False))
+    elif command == 'resync':
+      self.reconcile_repos(*repos)
+      if request.get('wait', False):
+        self.publish_now(repos, True)
+    elif command == 'pause':
+      self.paused.update(repos)
+    elif command == 'resume':
+      self.paused.difference_update(repos)
+    elif command != 'status':
+      raise ValueError("Unknown command %s" % command)
+
+    return {'ok': True, 'repos': self.repos_status(repos)}
+
+  def publish_now(self, repos, wait = False):
+    while True:
+      self.batcher.flush(force=True, repos=repos)
+      if not wait:
+        return
+
+      # reconciliations may queue more events in the meantime
+      self.workers.join(*repos)
+      pending = self.batcher.pendingCounts()
+      if not any([repo in pending for repo in repos]):
+        return
+
+  def repos_status(self, repos):
+    pending = self.batcher.pendingCounts()
+    jobs = self.workers.jobCounts()
+
+    status = {}
+    for repo in repos:
+      (queued, running) = jobs.get(repo, (0, 0))
+      status[repo] = {
+        'pending_events': pending.get(repo, 0),
+        'queued_jobs': queued,
+        'running_jobs': running,
+        'paused': repo in self.paused,
+        'last_publish': self.last_publish.get(repo),
+        'deferred_publish': self.refreshes.get(repo),
+      }
+    return status
+
+  def reconcile_repos(self, *paths):
+    """Catches up with the changes made to the watched directories (all of
+       them by default) while the daemon was not watching them. Runs on the
+       workers, so that events keep being read and other repositories keep
+       being updated in the meantime."""
+    if len(paths) == 0:
+      paths = self.wd_fds.keys()
+
+    for path in paths:
+      with self.repos_lock:
+        if path in self.reconciling:
+          # the one already submitted will see the same changes
+          continue
+        self.reconciling.add(path)
+      self.workers.submit(path, self.reconcile, path)
+
+  def resync_repos(self, *paths):
+    """Recovers from lost events. Watches are added again when watching
+       recursively, as subdirectories created in the meantime were missed."""
+    if len(paths) == 0:
+      # repositories created in the meantime were missed as well
+      self.watch_repos()
+      paths = self.wd_fds.keys()
+
+    if self.config['recursive']:
+      for path in paths:
+        self.start_watching(path)
+
+    self.reconcile_repos(*paths)
+
+  def watch_lost(self, wd_fd, path):
+    path = os.path.normpath(path)
+    if self.wd_fds.get(path) != wd_fd:
+      # a subdirectory, whose packages have been removed one by one
+      return
+
+    del(self.wd_fds[path])
+    if os.path.isdir(path):
+      self.logger.warning("Lost the watch on %s, watching it again" % path)
       self.start_watching(path)
+      self.reconcile_repos(path)
+    elif path not in self.config['watch']:
+      self.logger.info("Repository %s is gone" % path)
+      dropped = self.batcher.discard(path)
+      if dropped > 0:
+        self.logger.info("Dropped %d pending events of %s" % (dropped, path))
+      # after the jobs already submitted, which may still use its state
+      self.workers.submit(path, self.forget_repo, path)
+    else:
+      self.logger.error("Lost the watch on %s, which is no longer a directory, until the configuration is reloaded" % path)
+      metrics.inc('updaterepod_errors_total', repo=path, operation='watch')
+
+  def forget_repo(self, directory):
+    """Closes the state of a repository which is gone and drops what the
+       daemon kept track of about it"""
+    with self.repos_lock:
+      state = self.repos.pop(directory, None)
+      self.refreshes.pop(directory, None)
+      self.reconciling.discard(directory)
+      self.journals.pop(directory, None)
+    self.paused.discard(directory)
+    self.last_publish.pop(directory, None)
+    self.follow_waits.pop(directory, None)
+
+    if state is not None:
+      self.logger.debug("Closing the state of %s" % directory)
+      state.close()
+
+  def reconcile(self, directory):
+    with self.repos_lock:
+      self.reconciling.discard(directory)
+
+    start = time.time()
+    (added, removed) = self.repo_state(directory).reconcile()
+    self.logger.info("Reconciled %s in %.2fs: %d packages to add, %d to remove" % (directory, time.time() - start, len(added), len(removed)))
+
+    # left behind by a restart
+    if self.repo_state(directory).isDeferred():
+      self.schedule_refresh(directory)
+
+    for package in removed:
+      self.batcher.add(directory, package, "remove")
+    for package in added:
+      self.batcher.add(directory, package, "add")
+
+  def flush_events(self, notifier):
+    """Called by the notifier between two reads of the inotify queue, which
+       happen at least every BATCH_TICK milliseconds. Returns True to stop
+       the loop."""
+    if self.shutdown_requested:
+      return True
+
+    if self.reload_requested:
+      self.reload_requested = False
+      self.reload_config()
+
+    self.batcher.flush()
+    self.submit_refreshes()
+    self.submit_follows()
+
+  def shutdown(self):
+    """Publishes the events received so far and waits for the updates in
+       progress to be done, so that no repository is left half updated"""
+    self.logger.info("Waiting for the pending updates to be done ..")
+    while True:
+      self.batcher.flush(force=True)
+      self.workers.join()
+      # reconciliations may have queued more events in the meantime
+      if len(self.batcher.pendingCounts()) == 0:
+        break
+
+    self.submit_refreshes(force=True)
+    self.workers.join()
+
+    self.close_repos()
+    self.close_package_cache()
+    self.workers.stop()
+
+    if self.metrics_server is not None:
+      self.metrics_server.shutdown()
+    self.stop_control_server()
+
+    self.logger.info("Stopped")
+
+  def run(self):
+    self.watch_repos()
+    self.start_metrics_server()
+    self.start_control_server()
+    self.replay_journals()
+    self.reconcile_repos()
     self.logger.info("Running ..")
-    self.notifier.loop()
+    # the updates run on the workers, so that the inotify queue keeps being
+    # read while metadata is being generated. Returns once a shutdown has
+    # been requested (or on Control-C), after closing the inotify instance.
+    self.notifier.loop(callback=self.flush_events)
+    self.shutdown()
+
+def sync_repo(directory, workers, xml_metadata = False, profile_dir = None):
+  config = UpdateRepoConfig()
+  config.quiet = True
+  config.directory = os.path.abspath(directory)
+  config.compress_workers = max(1, workers)
+  config.xml_metadata = xml_metadata
+
+  profiler.configure(profile_dir, retention=0)
+  profiler.run(config.directory, UpdateRepo(config).execute, action="sync", workers=workers)
+
+def control_client(options, args):
+  """Sends a request to the control socket of the running daemon, printing
+     the response"""
+  if len(args) not in (1, 2):
+    sys.stderr.write("Usage: updaterepod ctl flush|resync|pause|resume|status [DIR]\n")
+    return 1
+
+  path = options.socket
+  if path is None:
+    try:
+      path = yaml.load(open(options.config_file, 'r')).get('control_socket')
+    except Exception, e:
+      sys.stderr.write("Failed to load %s configuration file: %s\n" % (options.config_file, e))
+      return 1
+  if path is None:
+    sys.stderr.write("The control socket is not enabled (control_socket)\n")
+    return 1
+
+  request = {'command': args[0], 'wait': options.wait}
+  if len(args) == 2:
+    request['repo'] = os.path.abspath(args[1])
+
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    sock.connect(path)
+    sock.sendall(json.dumps(request) + "\n")
+    response = json.loads(sock.makefile('r').readline())
+  except Exception, e:
+    sys.stderr.write("Failed to send request to %s: %s\n" % (path, e))
+    return 1
+  finally:
+    sock.close()
+
+  if not response['ok']:
+    sys.stderr.write("%s\n" % response['error'])
+    return 1
+
+  print json.dumps(response['repos'], indent=2, sort_keys=True)
+  return 0
 
 def parse_args():
-  parser = OptionParser(usage = "Usage: %prog [options]")
+  parser = OptionParser(usage = "Usage: %prog [options]\n       %prog [options] ctl flush|resync|pause|resume|status [DIR]")
   parser.add_option('-c', '--config', dest = "config_file", default = "/etc/updaterepod/config.yaml", help = "Path to configuration file", metavar = "FILE")
   parser.add_option('-d', '--debug', action = "store_false", dest = "debug", default = False, help = "Enable debug mode")
   parser.add_option('-l', '--logdest', dest = "logdest", default = None, help = "Optional destination log file")
   parser.add_option('-u', '--user', dest = "user", default = None, help = "Optional user to run with")
+  parser.add_option('-s', '--sync', dest = "sync", default = None, help = "Synchronize the metadata of DIR with the packages it contains and exit", metavar = "DIR")
+  parser.add_option('-x', '--xml', action = "store_true", dest = "xml", default = False, help = "Also publish the XML metadata when synchronizing")
+  parser.add_option('-w', '--workers', dest = "workers", type = "int", default = multiprocessing.cpu_count(), help = "Number of processes checksumming packages when synchronizing (default: number of CPUs)", metavar = "N")
+  parser.add_option('-p', '--profile', dest = "profile_dir", default = None, help = "Profile the metadata updates, or the synchronization, writing the profiles to DIR (overrides profile_dir)", metavar = "DIR")
+  parser.add_option('--socket', dest = "socket", default = None, help = "Path to the control socket of the daemon (default: control_socket of the configuration file)", metavar = "FILE")
+  parser.add_option('--wait', action = "store_true", dest = "wait", default = False, help = "With ctl flush and resync, wait until the metadata is published")
 
   return parser.parse_args()
 
 def main():
   options, args = parse_args()
 
+  if len(args) > 0 and args[0] == 'ctl':
+    return control_client(options, args[1:])
+
   if options.user is not None:
     try:
       uid = pwd.getpwnam(options.user)
@@ -682,7 +4018,11 @@ def main():
   else:
     logger.setLevel(logging.INFO)
 
-  updaterepod = Updaterepo_Daemon(config_file=options.config_file)
+  if options.sync is not None:
+    sync_repo(options.sync, options.workers, options.xml, options.profile_dir)
+    return
+
+  updaterepod = Updaterepo_Daemon(config_file=options.config_file, profile_dir=options.profile_dir)
   updaterepod.run()
 
 if __name__ == "__main__":
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+#
+# test_batcher.py
+#
+# Checks how the events of a repository are coalesced into a batch
+#
+# Run with: python -m unittest discover -s tests
+#
+
+import os
+import sys
+import unittest
+
+BIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin')
+sys.path.insert(0, BIN_DIR)
+
+import updaterepod
+
+class EventBatcherTest(unittest.TestCase):
+  def setUp(self):
+    self.batches = []
+    self.batcher = updaterepod.EventBatcher(self.callback, 0, 30)
+
+  def callback(self, repo, added, removed, moved, since):
+    self.batches.append((repo, sorted(added), sorted(removed), sorted(moved)))
+
+  def flush(self):
+    """Returns the batch of /repo, which must be the only one"""
+    self.batcher.flush(force = True)
+    self.assertEqual(len(self.batches), 1)
+    return self.batches.pop()[1:]
+
+  def test_last_action_wins(self):
+    """Only the net effect of the events on each file is kept"""
+    self.batcher.add('/repo', 'a.rpm', 'add')
+    self.batcher.add('/repo', 'a.rpm', 'remove')
+    self.batcher.add('/repo', 'b.rpm', 'remove')
+    self.batcher.add('/repo', 'b.rpm', 'add')
+    self.assertEqual(self.flush(), (['b.rpm'], ['a.rpm'], []))
+
+  def test_move(self):
+    """A move is applied in place, the source being removed if not moved"""
+    self.batcher.move('/repo', 'a.rpm', 'b.rpm')
+    self.assertEqual(self.flush(), ([], ['a.rpm'], [('a.rpm', 'b.rpm')]))
+
+  def test_move_added(self):
+    """A package added and moved in the same batch is only added"""
+    self.batcher.add('/repo', 'a.rpm', 'add')
+    self.batcher.move('/repo', 'a.rpm', 'b.rpm')
+    self.assertEqual(self.flush(), (['b.rpm'], ['a.rpm'], []))
+
+  def test_move_chain(self):
+    """Renames are followed back to where the package was"""
+    self.batcher.move('/repo', 'a.rpm', 'b.rpm')
+    self.batcher.move('/repo', 'b.rpm', 'c.rpm')
+    self.assertEqual(self.flush(), ([], ['a.rpm', 'b.rpm'], [('a.rpm', 'c.rpm')]))
+
+  def test_move_removed(self):
+    """A package moved then removed is removed from where it was"""
+    self.batcher.move('/repo', 'a.rpm', 'b.rpm')
+    self.batcher.add('/repo', 'b.rpm', 'remove')
+    self.assertEqual(self.flush(), ([], ['a.rpm', 'b.rpm'], []))
+
+  def test_repositories(self):
+    """Each repository gets its own batch"""
+    self.batcher.add('/repo', 'a.rpm', 'add')
+    self.batcher.add('/other', 'a.rpm', 'remove')
+    self.batcher.flush(force = True)
+    self.assertEqual(sorted(self.batches), [('/other', [], ['a.rpm'], []), ('/repo', ['a.rpm'], [], [])])
+
+  def test_due(self):
+    """Batches wait for the repository to be quiet, or for max_delay"""
+    self.batcher.quiet_period = 2
+    self.batcher.add('/repo', 'a.rpm', 'add')
+    now = self.batcher.times['/repo'][0]
+    self.assertEqual(self.batcher.due(now + 1), [])
+    self.assertEqual(self.batcher.due(now + 2), ['/repo'])
+
+    self.batcher.times['/repo'] = (now, now + 29)
+    self.assertEqual(self.batcher.due(now + 30), ['/repo'])
+
+    self.batcher.hold = lambda repo: True
+    self.assertEqual(self.batcher.due(now + 30), [])
+    self.batcher.flush()
+    self.assertEqual(self.batches, [])
+    self.assertEqual(self.batcher.pendingCounts(), {'/repo': 1})
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+#
+# test_compress.py
+#
+# Checks the compression of the databases, as read back by yum
+#
+# Run with: python -m unittest discover -s tests
+#
+
+import os
+import sys
+import bz2
+import random
+import shutil
+import tempfile
+import unittest
+
+BIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin')
+sys.path.insert(0, BIN_DIR)
+
+import updaterepod
+
+class CompressTest(unittest.TestCase):
+  def setUp(self):
+    self.workdir = tempfile.mkdtemp(prefix='updaterepod-test.')
+    self.source = os.path.join(self.workdir, 'primary.sqlite')
+    random.seed(0)
+
+  def tearDown(self):
+    shutil.rmtree(self.workdir)
+
+  def write(self, data):
+    f = open(self.source, 'wb')
+    try:
+      f.write(data)
+    finally:
+      f.close()
+
+  def read(self, filename):
+    f = open(filename, 'rb')
+    try:
+      return f.read()
+    finally:
+      f.close()
+
+  def test_parallel_bzip2(self):
+    """Blocks compressed in parallel make a single bzip2 stream, as
+       bz2.decompress on Python 2 only reads the first one"""
+    words = ['%x' % random.getrandbits(40) for i in range(1000)]
+    data = ' '.join([random.choice(words) for i in range(300000)]) + '\0' * 100000
+    self.write(data)
+
+    dest = os.path.join(self.workdir, 'primary.sqlite.bz2')
+    for level in (1, 9):
+      (checksum, size, compressed_checksum, compressed_size) = updaterepod.parallelBzipFile(self.source, dest, 3, level)
+      self.assertEqual(bz2.decompress(self.read(dest)), data)
+      self.assertEqual(size, len(data))
+      self.assertEqual(compressed_size, os.path.getsize(dest))
+      self.assertEqual(checksum, updaterepod.compressFile(self.source, dest + '.1', 'bz2', level)[0])
+
+  def test_parallel_bzip2_runs(self):
+    """Data grown by the run-length encoding of bzip2 beyond a block"""
+    data = ''.join([chr(i % 200) * 4 for i in range(300000)])
+    self.write(data)
+
+    dest = os.path.join(self.workdir, 'primary.sqlite.bz2')
+    updaterepod.parallelBzipFile(self.source, dest, 2, 1)
+    self.assertEqual(bz2.decompress(self.read(dest)), data)
+
+  def test_codecs(self):
+    """Databases compressed with any codec are read back"""
+    data = 'SQLite format 3\0' * 10000
+    self.write(data)
+
+    for compression in ('bz2', 'gzip', 'xz'):
+      if compression == 'xz' and updaterepod.lzma is None:
+        continue
+      dest = os.path.join(self.workdir, 'primary.sqlite.%s' % updaterepod.COMPRESSION_SUFFIXES[compression])
+      updaterepod.compressDB(self.source, dest, 'sha256', compression)
+      uncompressed = os.path.join(self.workdir, 'uncompressed.sqlite')
+      updaterepod.uncompressDB(dest, uncompressed)
+      self.assertEqual(self.read(uncompressed), data)
+
+  def test_multiple_streams(self):
+    """Concatenated bzip2 streams, as written by pbzip2, are all read"""
+    dest = os.path.join(self.workdir, 'primary.sqlite.bz2')
+    f = open(dest, 'wb')
+    try:
+      for i in range(3):
+        f.write(bz2.compress('stream %d\n' % i))
+    finally:
+      f.close()
+
+    uncompressed = os.path.join(self.workdir, 'uncompressed.sqlite')
+    updaterepod.uncompressDB(dest, uncompressed)
+    self.assertEqual(self.read(uncompressed), 'stream 0\nstream 1\nstream 2\n')
+
+  def test_locate(self):
+    """Databases are found by their suffix when there is no repomd.xml"""
+    repodata = os.path.join(self.workdir, 'repodata')
+    os.makedirs(repodata)
+    self.assertEqual(updaterepod.locateDB(repodata, 'primary'), os.path.join(repodata, 'primary.sqlite.bz2'))
+
+    open(os.path.join(repodata, 'primary.sqlite.xz'), 'w').close()
+    self.assertEqual(updaterepod.locateDB(repodata, 'primary'), os.path.join(repodata, 'primary.sqlite.xz'))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+#
+# test_follow.py
+#
+# Checks the journal of a daemon and a follower applying it, with local
+# directories standing in for the repository and its replica
+#
+# Run with: python -m unittest discover -s tests
+#
+
+import os
+import sys
+import imp
+import json
+import time
+import shutil
+import tempfile
+import unittest
+
+BIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin')
+sys.path.insert(0, BIN_DIR)
+
+import updaterepod
+
+# synthetic, yet well-formed, packages
+bench = imp.load_source('updaterepod_bench', os.path.join(BIN_DIR, 'updaterepod-bench.py'))
+
+class FollowTest(unittest.TestCase):
+  def setUp(self):
+    self.workdir = tempfile.mkdtemp(prefix='updaterepod-test.')
+    self.leader_dir = os.path.join(self.workdir, 'leader')
+    self.replica_dir = os.path.join(self.workdir, 'replica')
+    self.journal_dir = os.path.join(self.workdir, 'journal')
+    os.makedirs(self.leader_dir)
+    os.makedirs(self.replica_dir)
+
+    self.generator = bench.PackageGenerator(files = 2, size = 1024)
+    self.daemons = []
+    self.segment_size = updaterepod.Journal.SEGMENT_SIZE
+
+  def tearDown(self):
+    for daemon in self.daemons:
+      daemon.shutdown()
+      daemon.notifier.stop()
+    updaterepod.Journal.SEGMENT_SIZE = self.segment_size
+    shutil.rmtree(self.workdir)
+
+  def daemon(self, name, config):
+    config['state_dir'] = os.path.join(self.workdir, name)
+    config['hot_copies'] = True
+    config_file = os.path.join(self.workdir, name + '.yaml')
+    f = open(config_file, 'w')
+    try:
+      f.write(json.dumps(config))
+    finally:
+      f.close()
+
+    daemon = updaterepod.Updaterepo_Daemon(config_file=config_file)
+    self.daemons.append(daemon)
+    return daemon
+
+  def leader(self, retention = 3600):
+    daemon = self.daemon('leader-%d' % len(self.daemons), {'watch': [self.leader_dir], 'journal_dir': self.journal_dir, 'journal_retention': retention})
+    daemon.watch_repos()
+    return daemon
+
+  def follower(self):
+    return self.daemon('follower-%d' % len(self.daemons), {'follow': {self.replica_dir: self.leader_dir}, 'follow_journal_dir': self.journal_dir})
+
+  def journal(self):
+    journal = updaterepod.Journal(os.path.join(self.journal_dir, updaterepod.journalName(self.leader_dir)))
+    journal.create(self.leader_dir)
+    return journal
+
+  def update(self, daemon, added = [], removed = [], moved = []):
+    """Applies a batch of changes made to the leader, as if notified"""
+    daemon.schedule_update(self.leader_dir, added, removed, moved, time.time())
+    daemon.workers.join()
+
+  def replicate(self, *hrefs):
+    for href in hrefs:
+      shutil.copy2(os.path.join(self.leader_dir, href), os.path.join(self.replica_dir, href))
+
+  def packages(self, directory):
+    """Returns the location of the packages of the metadata published"""
+    state_dir = tempfile.mkdtemp(dir=self.workdir)
+    state = updaterepod.RepoState(directory, state_dir)
+    try:
+      return sorted([row[0] for row in state.publishedPackages()])
+    finally:
+      state.close()
+
+  def test_replay(self):
+    """Batches journaled but not published, the daemon dying or the update
+       failing, are applied again on startup"""
+    leader = self.leader()
+    self.generator.write(self.leader_dir, 'a-1.0-1.noarch.rpm')
+    self.update(leader, added=['a-1.0-1.noarch.rpm'])
+
+    # dies after writing a batch to the journal
+    self.generator.write(self.leader_dir, 'b-1.0-1.noarch.rpm')
+    self.assertEqual(self.journal().append(['b-1.0-1.noarch.rpm'], [], []), 2)
+
+    leader = self.leader()
+    leader.replay_journals()
+    leader.workers.join()
+    self.assertEqual(self.packages(self.leader_dir), ['a-1.0-1.noarch.rpm', 'b-1.0-1.noarch.rpm'])
+    self.assertEqual(self.journal().published(), 2)
+
+    # fails to publish a batch, while the next one succeeds
+    self.generator.write(self.leader_dir, 'c-1.0-1.noarch.rpm')
+    generateMetaData = updaterepod.UpdateRepo.generateMetaData
+    def fail(updater):
+      raise IOError("No space left on device")
+    updaterepod.UpdateRepo.generateMetaData = fail
+    try:
+      self.update(leader, added=['c-1.0-1.noarch.rpm'])
+    finally:
+      updaterepod.UpdateRepo.generateMetaData = generateMetaData
+    self.generator.write(self.leader_dir, 'd-1.0-1.noarch.rpm')
+    self.update(leader, added=['d-1.0-1.noarch.rpm'])
+    self.assertEqual(self.packages(self.leader_dir), ['a-1.0-1.noarch.rpm', 'b-1.0-1.noarch.rpm', 'd-1.0-1.noarch.rpm'])
+    self.assertEqual(self.journal().published(), 2)
+
+    leader = self.leader()
+    leader.replay_journals()
+    leader.workers.join()
+    self.assertEqual(self.packages(self.leader_dir), ['a-1.0-1.noarch.rpm', 'b-1.0-1.noarch.rpm', 'c-1.0-1.noarch.rpm', 'd-1.0-1.noarch.rpm'])
+    self.assertEqual(self.journal().published(), 4)
+
+  def test_follow(self):
+    """A follower applies the batches of the leader in order, holding back
+       the ones adding packages not replicated yet"""
+    leader = self.leader()
+    for name in ('a', 'b', 'c'):
+      self.generator.write(self.leader_dir, '%s-1.0-1.noarch.rpm' % name)
+    self.update(leader, added=['a-1.0-1.noarch.rpm'])
+    self.replicate('a-1.0-1.noarch.rpm')
+    self.update(leader, added=['b-1.0-1.noarch.rpm'])
+    # not to be waited for, being removed by a later batch
+    self.update(leader, added=['c-1.0-1.noarch.rpm'])
+    os.rename(os.path.join(self.leader_dir, 'a-1.0-1.noarch.rpm'), os.path.join(self.leader_dir, 'aa-1.0-1.noarch.rpm'))
+    self.update(leader, moved=[('a-1.0-1.noarch.rpm', 'aa-1.0-1.noarch.rpm')])
+    os.unlink(os.path.join(self.leader_dir, 'c-1.0-1.noarch.rpm'))
+    self.update(leader, removed=['c-1.0-1.noarch.rpm'])
+
+    follower = self.follower()
+    state = follower.repo_state(self.replica_dir)
+    follower.follow_repo(self.replica_dir)
+    self.assertEqual(self.packages(self.replica_dir), ['a-1.0-1.noarch.rpm'])
+    self.assertEqual(state.journalPosition(), 1)
+
+    self.replicate('b-1.0-1.noarch.rpm')
+    os.rename(os.path.join(self.replica_dir, 'a-1.0-1.noarch.rpm'), os.path.join(self.replica_dir, 'aa-1.0-1.noarch.rpm'))
+    follower.follow_repo(self.replica_dir)
+    self.assertEqual(self.packages(self.replica_dir), self.packages(self.leader_dir))
+    self.assertEqual(state.journalPosition(), 5)
+
+    # nothing new
+    (added, removed, moved, last) = follower.follow_batch(self.replica_dir, self.journal(), 5)
+    self.assertEqual(last, None)
+
+  def test_give_up(self):
+    """Packages not replicated within FOLLOW_WAIT seconds are left out, and
+       added once they show up"""
+    leader = self.leader()
+    for name in ('a', 'b'):
+      self.generator.write(self.leader_dir, '%s-1.0-1.noarch.rpm' % name)
+    self.update(leader, added=['a-1.0-1.noarch.rpm'])
+    self.replicate('a-1.0-1.noarch.rpm')
+    self.update(leader, added=['b-1.0-1.noarch.rpm'])
+    os.rename(os.path.join(self.leader_dir, 'a-1.0-1.noarch.rpm'), os.path.join(self.leader_dir, 'aa-1.0-1.noarch.rpm'))
+    self.update(leader, moved=[('a-1.0-1.noarch.rpm', 'aa-1.0-1.noarch.rpm')])
+
+    follower = self.follower()
+    state = follower.repo_state(self.replica_dir)
+    follower.follow_repo(self.replica_dir)
+    self.assertEqual(self.packages(self.replica_dir), ['a-1.0-1.noarch.rpm'])
+    self.assertEqual(state.journalPosition(), 1)
+
+    # moved away, the destination not replicated yet
+    os.unlink(os.path.join(self.replica_dir, 'a-1.0-1.noarch.rpm'))
+    follower.FOLLOW_WAIT = 0
+    follower.follow_repo(self.replica_dir)
+    self.assertEqual(self.packages(self.replica_dir), [])
+    self.assertEqual(state.journalPosition(), 3)
+    self.assertEqual(state.followPending(), set(['aa-1.0-1.noarch.rpm', 'b-1.0-1.noarch.rpm']))
+
+    self.replicate('aa-1.0-1.noarch.rpm', 'b-1.0-1.noarch.rpm')
+    follower.follow_repo(self.replica_dir)
+    self.assertEqual(self.packages(self.replica_dir), self.packages(self.leader_dir))
+    self.assertEqual(state.followPending(), set())
+
+  def test_catch_up(self):
+    """A follower missing records compacted by the leader reconciles the
+       replica, and goes on from the last record"""
+    updaterepod.Journal.SEGMENT_SIZE = 1
+    leader = self.leader(retention = 0)
+    for name in ('a', 'b', 'c'):
+      self.generator.write(self.leader_dir, '%s-1.0-1.noarch.rpm' % name)
+      self.update(leader, added=['%s-1.0-1.noarch.rpm' % name])
+      time.sleep(0.01)
+    self.assertEqual(self.journal().firstSeq(), 3)
+
+    follower = self.follower()
+    self.replicate('a-1.0-1.noarch.rpm', 'b-1.0-1.noarch.rpm', 'c-1.0-1.noarch.rpm')
+    follower.follow_repo(self.replica_dir)
+    self.assertEqual(self.packages(self.replica_dir), self.packages(self.leader_dir))
+    self.assertEqual(follower.repo_state(self.replica_dir).journalPosition(), 3)
+
+    self.generator.write(self.leader_dir, 'd-1.0-1.noarch.rpm')
+    self.update(leader, added=['d-1.0-1.noarch.rpm'])
+    self.replicate('d-1.0-1.noarch.rpm')
+    follower.follow_repo(self.replica_dir)
+    self.assertEqual(self.packages(self.replica_dir), self.packages(self.leader_dir))
+    self.assertEqual(follower.repo_state(self.replica_dir).journalPosition(), 4)
+
+if __name__ == '__main__':
+  unittest.main()
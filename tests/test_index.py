@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+#
+# test_index.py
+#
+# Checks the listing of the packages of a repository, merge-joined with the
+# databases, and the in-memory index of the packages
+#
+# Run with: python -m unittest discover -s tests
+#
+
+import os
+import sys
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+BIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin')
+sys.path.insert(0, BIN_DIR)
+
+import updaterepod
+
+class SortedRpmsTest(unittest.TestCase):
+  def setUp(self):
+    self.workdir = tempfile.mkdtemp(prefix='updaterepod-test.')
+
+  def tearDown(self):
+    shutil.rmtree(self.workdir)
+
+  def touch(self, href):
+    path = os.path.join(self.workdir, href)
+    if not os.path.isdir(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+    open(path, 'w').close()
+
+  def test_order(self):
+    """Packages are listed the way SQLite sorts location_href, which
+       syncChanges relies on to merge-join them"""
+    hrefs = ['a.rpm', 'a-1.rpm', 'a0.rpm', 'A.rpm', 'a/x.rpm', 'a/ x.rpm', 'a/b/y.rpm', 'a.b/z.rpm',
+             'a-b/z.rpm', 'ab.rpm', 'b/a.rpm', '\xc3\xa9.rpm', 'e/\xc3\xa9.rpm', 'z.rpm', '~.rpm']
+    for href in hrefs:
+      self.touch(href)
+    self.touch('a/notes.txt')
+    os.symlink(os.path.join(self.workdir, 'a'), os.path.join(self.workdir, 'c'))
+
+    cx = sqlite3.connect(':memory:')
+    cx.execute("CREATE TABLE packages (location_href TEXT);")
+    cx.executemany("INSERT INTO packages VALUES (?);", [(href.decode('utf-8'), ) for href in hrefs])
+    ordered = [row[0].encode('utf-8') for row in cx.execute("SELECT location_href FROM packages ORDER BY location_href;")]
+
+    self.assertEqual(list(updaterepod.sortedRpms(self.workdir)), ordered)
+
+  def test_missing(self):
+    """A directory removed in the meantime has no packages"""
+    self.assertEqual(list(updaterepod.sortedRpms(os.path.join(self.workdir, 'missing'))), [])
+
+class PackageIndexTest(unittest.TestCase):
+  PKGID = '%064x'
+
+  def test_slots(self):
+    """The slots of the removed packages are reused"""
+    index = updaterepod.PackageIndex()
+    for i in range(3):
+      index.add('x86_64/p%d.rpm' % i, i + 1, self.PKGID % i, 100 + i, 1000 + i)
+    self.assertEqual(len(index), 3)
+    self.assertEqual(index.nextPkgKey, 4)
+
+    slot = index.slot('x86_64/p1.rpm')
+    index.remove('x86_64/p1.rpm')
+    self.assertFalse('x86_64/p1.rpm' in index)
+    self.assertEqual(len(index), 2)
+
+    index.add('noarch/q.rpm', 4, self.PKGID % 4, 200, 2000)
+    self.assertEqual(index.slot('noarch/q.rpm'), slot)
+    self.assertEqual(len(index.pkgKeys), 3)
+    self.assertEqual(index.pkgKey('noarch/q.rpm'), 4)
+    self.assertEqual(index.pkgId('noarch/q.rpm'), self.PKGID % 4)
+    self.assertEqual(index.pkgId('x86_64/p2.rpm'), self.PKGID % 2)
+    self.assertEqual(sorted(index), ['noarch/q.rpm', 'x86_64/p0.rpm', 'x86_64/p2.rpm'])
+
+  def test_rename(self):
+    """Moved packages keep their pkgKey and pkgId"""
+    index = updaterepod.PackageIndex()
+    index.add('p.rpm', 1, self.PKGID % 1, 100, 1000)
+    index.rename('p.rpm', 'sub/p.rpm')
+    self.assertEqual(index.packageKeys(), {'sub/p.rpm': 1})
+    self.assertEqual(index.pkgId('sub/p.rpm'), self.PKGID % 1)
+    self.assertEqual(len(index), 1)
+
+  def test_odd_pkgIds(self):
+    """pkgIds which are not digests of the same size are kept as they are"""
+    index = updaterepod.PackageIndex()
+    index.add('a.rpm', 1, self.PKGID % 1, 100, 1000)
+    index.add('b.rpm', 2, 'abc', 100, 1000)
+    index.add('c.rpm', 3, '%040x' % 3, 100, 1000)
+    self.assertEqual([index.pkgId(href) for href in ('a.rpm', 'b.rpm', 'c.rpm')], [self.PKGID % 1, 'abc', '%040x' % 3])
+
+    # the slot of b.rpm, reused
+    index.remove('b.rpm')
+    index.add('d.rpm', 4, self.PKGID % 4, 100, 1000)
+    self.assertEqual(index.pkgId('d.rpm'), self.PKGID % 4)
+
+if __name__ == '__main__':
+  unittest.main()
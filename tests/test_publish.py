@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+#
+# test_publish.py
+#
+# Checks the metadata published by a daemon: the XML written from the
+# fragments of the packages and the files superseded by atomic publishing
+#
+# Run with: python -m unittest discover -s tests
+#
+
+import os
+import sys
+import imp
+import json
+import time
+import gzip
+import shutil
+import tempfile
+import unittest
+
+BIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin')
+sys.path.insert(0, BIN_DIR)
+
+import updaterepod
+
+# synthetic, yet well-formed, packages
+bench = imp.load_source('updaterepod_bench', os.path.join(BIN_DIR, 'updaterepod-bench.py'))
+
+class PublishTest(unittest.TestCase):
+  def setUp(self):
+    self.workdir = tempfile.mkdtemp(prefix='updaterepod-test.')
+    self.repo_dir = os.path.join(self.workdir, 'repo')
+    self.repodata = os.path.join(self.repo_dir, 'repodata')
+    os.makedirs(self.repo_dir)
+
+    self.generator = bench.PackageGenerator(files = 2, size = 1024)
+    config = {'watch': [self.repo_dir], 'state_dir': os.path.join(self.workdir, 'state'), 'hot_copies': True,
+              'xml_metadata': True, 'atomic_publish': True, 'publish_grace_period': 3600}
+    config_file = os.path.join(self.workdir, 'config.yaml')
+    f = open(config_file, 'w')
+    try:
+      f.write(json.dumps(config))
+    finally:
+      f.close()
+
+    self.daemon = updaterepod.Updaterepo_Daemon(config_file=config_file)
+    self.daemon.watch_repos()
+
+  def tearDown(self):
+    self.daemon.shutdown()
+    self.daemon.notifier.stop()
+    shutil.rmtree(self.workdir)
+
+  def update(self, added = [], removed = []):
+    self.daemon.schedule_update(self.repo_dir, added, removed, [], time.time())
+    self.daemon.workers.join()
+
+  def add(self, *names):
+    for name in names:
+      self.generator.write(self.repo_dir, name)
+    self.update(added=list(names))
+
+  def remove(self, *names):
+    for name in names:
+      os.unlink(os.path.join(self.repo_dir, name))
+    self.update(removed=list(names))
+
+  def referenced(self):
+    return updaterepod.referencedFiles(os.path.join(self.repodata, 'repomd.xml'))
+
+  def xml(self, ftype):
+    """Returns the XML document of a type, as published"""
+    repomd = updaterepod.RepoMD('repoid', os.path.join(self.repodata, 'repomd.xml'))
+    f = gzip.open(os.path.join(self.repo_dir, repomd.getData(ftype).location[1]))
+    try:
+      return f.read()
+    finally:
+      f.close()
+
+  def test_xml(self):
+    """The XML documents list the packages of the databases, the fragments
+       of the packages removed being dropped"""
+    self.add('a-1.0-1.noarch.rpm', 'b-1.0-1.noarch.rpm')
+    self.remove('a-1.0-1.noarch.rpm')
+    self.add('c-1.0-1.noarch.rpm')
+
+    primary = self.xml('primary')
+    self.assertTrue('packages="2"' in primary)
+    self.assertEqual(primary.count('<package type="rpm">'), 2)
+    self.assertFalse('a-1.0-1.noarch.rpm' in primary)
+    for name in ('b-1.0-1.noarch.rpm', 'c-1.0-1.noarch.rpm'):
+      self.assertTrue('href="%s"' % name in primary)
+    self.assertTrue(primary.endswith('</metadata>\n'))
+
+    for (ftype, tag) in (('filelists', 'filelists'), ('other', 'otherdata')):
+      document = self.xml(ftype)
+      self.assertTrue('packages="2"' in document)
+      self.assertEqual(document.count('<package '), 2)
+      self.assertTrue(document.endswith('</%s>\n' % tag))
+
+  def test_superseded(self):
+    """The files superseded are kept for publish_grace_period seconds"""
+    self.add('a-1.0-1.noarch.rpm')
+    first = self.referenced()
+    self.add('b-1.0-1.noarch.rpm')
+    second = self.referenced()
+    self.assertEqual(first & second, set())
+    self.assertTrue(first.issubset(os.listdir(self.repodata)))
+
+    self.daemon.config['publish_grace_period'] = 0
+    time.sleep(0.01)
+    self.add('c-1.0-1.noarch.rpm')
+    names = set(os.listdir(self.repodata))
+    self.assertTrue(self.referenced().issubset(names))
+    self.assertEqual(names & first, set())
+    self.assertEqual(names - self.referenced() - second, set(['repomd.xml']))
+
+if __name__ == '__main__':
+  unittest.main()